@@ -7,7 +7,9 @@ class GPTFConvDataLoader():
         self.datafile = datafile
         self.dictionary = dictionary
         self.total_size = 0
-        self.get_total_size()
+        if datafile is not None:
+            # None when the data is given by load_lines
+            self.get_total_size()
 
         self.src = []
         self.tgt = []
@@ -40,18 +42,34 @@ class GPTFConvDataLoader():
                 continue
             if cnt >= end:
                 break
-            src, tgt = line.split('\t')
-            src = src.strip().split()
-            tgt = tgt.strip().split()
-
-            src_tokens = self.dictionary.index(src)
-            tgt_tokens = self.dictionary.index(tgt)
-            src_tokens = src_tokens + [self.dictionary.eos()]
-            tgt_tokens = tgt_tokens + [self.dictionary.eos()]
-            self.src.append(src_tokens)
-            self.tgt.append(tgt_tokens)
+            self.add_line(line)
         if self.identifier_loader is not None:
             self.identifier_loader.load_data(start, end)
+        self.set_dataset()
+
+    def load_lines(self, lines, identifier_token_lines=None, identifier_text_lines=None):
+        # the same as load_data, from lines in the format of datafile and the identifier files
+        self.reinitialize()
+        for line in lines:
+            self.add_line(line)
+        if self.identifier_loader is not None:
+            self.identifier_loader.load_lines(identifier_token_lines, identifier_text_lines)
+        self.set_dataset()
+
+    def add_line(self, line):
+        src, tgt = line.split('\t')
+        src = src.strip().split()
+        tgt = tgt.strip().split()
+
+        src_tokens = self.dictionary.index(src)
+        tgt_tokens = self.dictionary.index(tgt)
+        src_tokens = src_tokens + [self.dictionary.eos()]
+        tgt_tokens = tgt_tokens + [self.dictionary.eos()]
+        self.src.append(src_tokens)
+        self.tgt.append(tgt_tokens)
+
+    def set_dataset(self):
+        if self.identifier_loader is not None:
             self.dataset = GPTFConvDataset(self.src, self.tgt, self.dictionary,
                                            identifier=self.identifier_loader.identifier_list)
         else:
@@ -11,12 +11,6 @@ class IdentifierDataLoader():
     def load_data(self, start, end):
         self.identifier_list = []
 
-        def get_prefix(tokens, dictionary):
-            prefix = ''
-            for token in tokens:
-                prefix += dictionary[token]
-            return prefix
-
         fp = codecs.open(self.token_file, 'r', 'utf-8')
         cnt = -1
         while True:
@@ -28,31 +22,7 @@ class IdentifierDataLoader():
                 continue
             if cnt >= end:
                 break
-
-            line = line.split('\t')
-            identifiers = {
-                'id': cnt,
-                'tokens': {'': [
-                    self.dictionary.index('$NUMBER$'),
-                    self.dictionary.index('$STRING$'),
-                    self.dictionary.index('_')]},
-                'text': []
-            }
-
-            for identifier in line:
-                token = identifier.strip().split()
-                token = [self.dictionary.index(t) for t in token]
-                if len(token) == 1:
-                    if token[0] not in identifiers['tokens']['']:
-                        identifiers['tokens'][''].append(token[0])
-                else:
-                    for i in range(len(token)):
-                        prefix = get_prefix(token[:i], self.dictionary)
-                        if prefix not in identifiers['tokens']:
-                            identifiers['tokens'][prefix] = []
-                        if token[i] not in identifiers['tokens'][prefix]:
-                            identifiers['tokens'][prefix].append(token[i])
-            self.identifier_list.append(identifiers)
+            self.identifier_list.append(self.parse_tokens(line, cnt))
 
         fp = codecs.open(self.text_file, 'r', 'utf-8')
         cnt = -1
@@ -67,3 +37,42 @@ class IdentifierDataLoader():
                 break
             self.identifier_list[cnt - start]['text'] = line.strip().split()
 
+    def load_lines(self, token_lines, text_lines):
+        # the same as load_data, from lines in the format of token_file and text_file
+        self.identifier_list = [self.parse_tokens(line, cnt) for cnt, line in enumerate(token_lines)]
+        for cnt, line in enumerate(text_lines):
+            self.identifier_list[cnt]['text'] = line.strip().split()
+
+    def parse_tokens(self, line, cnt):
+
+        def get_prefix(tokens, dictionary):
+            prefix = ''
+            for token in tokens:
+                prefix += dictionary[token]
+            return prefix
+
+        line = line.split('\t')
+        identifiers = {
+            'id': cnt,
+            'tokens': {'': [
+                self.dictionary.index('$NUMBER$'),
+                self.dictionary.index('$STRING$'),
+                self.dictionary.index('_')]},
+            'text': []
+        }
+
+        for identifier in line:
+            token = identifier.strip().split()
+            token = [self.dictionary.index(t) for t in token]
+            if len(token) == 1:
+                if token[0] not in identifiers['tokens']['']:
+                    identifiers['tokens'][''].append(token[0])
+            else:
+                for i in range(len(token)):
+                    prefix = get_prefix(token[:i], self.dictionary)
+                    if prefix not in identifiers['tokens']:
+                        identifiers['tokens'][prefix] = []
+                    if token[i] not in identifiers['tokens'][prefix]:
+                        identifiers['tokens'][prefix].append(token[i])
+        return identifiers
+
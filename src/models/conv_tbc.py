@@ -22,3 +22,18 @@ class ConvTBC(nn.Module):
                 # remove future timesteps added by padding
                 output = output[:-self.padding[0], :, :]
         return output
+
+    def incremental_forward(self, x, buffer=None):
+        """
+        x: T x B x C, the newest timesteps of a causal (remove_future) convolution
+        buffer: B x (kernel_size - 1) x C, the input timesteps right before x, None at the first step
+        return the output of the newest timesteps and the updated buffer
+        """
+        assert self.remove_future
+        kernel_size = self.kernel_size[0]
+        if buffer is None:
+            buffer = x.new_zeros(x.size(1), kernel_size - 1, x.size(2))
+        window = torch.cat([buffer.transpose(0, 1), x], dim=0)     # kernel_size - 1 + T, B, C
+        output = torch.conv_tbc(window.contiguous(), self.weight, self.bias, 0)
+        buffer = window[window.size(0) - (kernel_size - 1):].transpose(0, 1).contiguous()
+        return output, buffer
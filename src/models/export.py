@@ -0,0 +1,216 @@
+import os
+import json
+import torch
+import torch.nn as nn
+
+from gpt_conut import GPTCoNuTModel
+
+
+def get_model_sizes(model):
+    # the sizes used to estimate the decoding memory, see GPTModelCuda.estimate_beam_memory
+    config = model.embed_model.config
+    return {
+        'n_head': config.n_head,
+        'n_layer': config.n_layer,
+        'n_embd': config.n_embd,
+        'channels': model.decoder.fc1.out_features,
+        'vocab_size': model.decoder.fc2.out_features,
+        'conv_num': len(model.decoder.convolutions),
+    }
+
+
+class EncoderExport(nn.Module):
+    """
+    The encoder as one graph: (src_tokens, src_with_prev_context[, ctx_tokens]) ->
+    (src_tokens, encoder_a, encoder_b, encoder_padding_mask), encoder_a is already transposed for the decoder
+    """
+    def __init__(self, model):
+        super(EncoderExport, self).__init__()
+        self.model = model
+
+    def forward(self, src_tokens, src_with_prev_context, ctx_tokens=None):
+        if isinstance(self.model, GPTCoNuTModel):
+            encoder_out = self.model.encoder(
+                src_tokens, src_with_prev_context, ctx_tokens, self.model.embed_model, own_length=True
+            )
+        else:
+            encoder_out = self.model.encoder(
+                src_tokens, src_with_prev_context, self.model.embed_model, own_length=True
+            )
+        encoder_a, encoder_b = self.model.decoder._split_encoder_out(encoder_out['encoder_out'])
+        return encoder_out['src_tokens'], encoder_a, encoder_b, encoder_out['encoder_padding_mask']
+
+
+class PrefixDecoderExport(nn.Module):
+    """
+    The first incremental decoder call, which runs gpt over prev_context (one row for each bug).
+    return the log probabilities of the next token and the incremental state as tensors:
+    position, prefix mask, prefix keys, prefix values and conv buffers (one for each layer)
+    """
+    def __init__(self, model):
+        super(PrefixDecoderExport, self).__init__()
+        self.model = model
+
+    def forward(self, prev_tokens_index, prev_tokens, src_tokens, encoder_a, encoder_b, encoder_padding_mask):
+        state = {}
+        encoder_out = {
+            'src_tokens': src_tokens,
+            'encoder_split': (encoder_a, encoder_b),
+            'encoder_padding_mask': encoder_padding_mask,
+        }
+        logits = self.model.decoder(
+            prev_tokens_index, encoder_out, prev_tokens, self.model.embed_model,
+            incremental_state=state, last_only=True, own_length=True,
+        )[0][:, -1, :]
+        layer_num = self.model.embed_model.config.n_layer
+        return (
+            logits, state['position'], state['prefix']['mask'],
+            tuple(state['prefix']['key_{}'.format(i)] for i in range(layer_num)),
+            tuple(state['prefix']['value_{}'.format(i)] for i in range(layer_num)),
+            tuple(state['conv_buffer_{}'.format(i)] for i in range(len(self.model.decoder.convolutions))),
+        )
+
+
+class StepDecoderExport(nn.Module):
+    """
+    The later incremental decoder calls, which only decode the newest token of each beam (B x 1).
+    the encoder output and the prefix are of the bugs (G rows), the other state is of the beams (B rows),
+    return the log probabilities of the next token, the new position, gpt keys, gpt values and conv buffers
+    """
+    def __init__(self, model):
+        super(StepDecoderExport, self).__init__()
+        self.model = model
+
+    def forward(self, tokens, position, src_tokens, encoder_a, encoder_b, encoder_padding_mask,
+                prefix_mask, prefix_keys, prefix_values, gpt_keys, gpt_values, conv_buffers):
+        state = {'position': position, 'prefix': {'mask': prefix_mask}}
+        for i in range(len(prefix_keys)):
+            state['prefix']['key_{}'.format(i)] = prefix_keys[i]
+            state['prefix']['value_{}'.format(i)] = prefix_values[i]
+            state['gpt_key_{}'.format(i)] = gpt_keys[i]
+            state['gpt_value_{}'.format(i)] = gpt_values[i]
+        for i in range(len(conv_buffers)):
+            state['conv_buffer_{}'.format(i)] = conv_buffers[i]
+        encoder_out = {
+            'src_tokens': src_tokens,
+            'encoder_split': (encoder_a, encoder_b),
+            'encoder_padding_mask': encoder_padding_mask,
+        }
+        logits = self.model.decoder(
+            torch.ones_like(tokens), encoder_out, tokens, self.model.embed_model,
+            incremental_state=state, last_only=True, own_length=True,
+        )[0][:, -1, :]
+        return (
+            logits, state['position'],
+            tuple(state['gpt_key_{}'.format(i)] for i in range(len(gpt_keys))),
+            tuple(state['gpt_value_{}'.format(i)] for i in range(len(gpt_values))),
+            tuple(state['conv_buffer_{}'.format(i)] for i in range(len(conv_buffers))),
+        )
+
+
+def get_example_inputs(model, device, bug_num=2, bug_beam_num=2, src_len=8, ctx_len=12, prev_len=10):
+    """random inputs of the shapes seen in generation, only used to trace the graphs"""
+    vocab_size = len(model.dictionary)
+    src_with_prev_context = torch.randint(4, vocab_size, (bug_num, prev_len + src_len), device=device)
+    src_tokens = torch.zeros(bug_num, prev_len + src_len, device=device).long()
+    src_tokens[:, prev_len:] = 1
+    ctx_tokens = torch.randint(4, vocab_size, (bug_num, ctx_len), device=device)
+    prev_tokens = torch.randint(4, vocab_size, (bug_num, prev_len), device=device)
+    prev_tokens_index = torch.zeros(bug_num, prev_len, device=device).long()
+    prev_tokens_index[:, -1] = 1
+    tokens = torch.randint(4, vocab_size, (bug_num * bug_beam_num, 1), device=device)
+    return src_tokens, src_with_prev_context, ctx_tokens, prev_tokens_index, prev_tokens, tokens
+
+
+def get_module_inputs(encoder, prefix_decoder, example_inputs, conut):
+    """
+    the inputs of the encoder, the first and a later incremental decoder call for example_inputs
+    (see get_example_inputs), the state passed on is computed by encoder and prefix_decoder
+    """
+    src_tokens, src_with_prev_context, ctx_tokens, prev_tokens_index, prev_tokens, tokens = example_inputs
+    bug_beam_num = tokens.size(0) // src_tokens.size(0)
+    encoder_inputs = (src_tokens, src_with_prev_context, ctx_tokens) if conut else \
+        (src_tokens, src_with_prev_context)
+    encoder_out = tuple(encoder(*encoder_inputs))
+
+    prefix_inputs = (prev_tokens_index, prev_tokens) + encoder_out
+    logits, position, prefix_mask, prefix_keys, prefix_values, conv_buffers = prefix_decoder(*prefix_inputs)
+
+    # the beams of each bug, with one token generated before
+    beams = torch.arange(tokens.size(0), device=tokens.device) // bug_beam_num
+    step_inputs = (
+        tokens, position.index_select(0, beams)
+    ) + encoder_out + (
+        prefix_mask, prefix_keys, prefix_values,
+        tuple(key.new_zeros(tokens.size(0), key.size(1), 1, key.size(3)) for key in prefix_keys),
+        tuple(value.new_zeros(tokens.size(0), value.size(1), 1, value.size(3)) for value in prefix_values),
+        tuple(buffer.index_select(0, beams) for buffer in conv_buffers),
+    )
+    return encoder_inputs, prefix_inputs, step_inputs
+
+
+def flatten_outputs(outputs):
+    if torch.is_tensor(outputs):
+        return [outputs]
+    return [tensor for output in outputs for tensor in flatten_outputs(output)]
+
+
+def export_model(model, export_dir, device='cpu'):
+    """
+    trace the encoder, the first and the later incremental decoder calls of a GPT-CoNuT / GPT-FConv model
+    into TorchScript graphs saved in export_dir, with dropout removed (eval mode) and the weights frozen
+    into the graphs. device: the device the graphs run on, it is fixed by tracing.
+    the graphs are checked against the eager modules on inputs of other shapes than the traced ones,
+    so a size frozen into a graph by tracing is caught here instead of in generation
+    """
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    model = model.to(device).eval()
+    conut = isinstance(model, GPTCoNuTModel)
+    modules = [
+        ('encoder', EncoderExport(model).eval()),
+        ('prefix_decoder', PrefixDecoderExport(model).eval()),
+        ('step_decoder', StepDecoderExport(model).eval()),
+    ]
+
+    with torch.no_grad():
+        traced_inputs = get_module_inputs(
+            modules[0][1], modules[1][1], get_example_inputs(model, device), conut
+        )
+        graphs = []
+        for (name, module), inputs in zip(modules, traced_inputs):
+            graphs.append(torch.jit.freeze(torch.jit.trace(module, inputs, check_trace=False)))
+
+        check_inputs = get_module_inputs(
+            modules[0][1], modules[1][1],
+            get_example_inputs(model, device, bug_num=3, bug_beam_num=3, src_len=13, ctx_len=7, prev_len=6), conut
+        )
+        for (name, module), graph, inputs in zip(modules, graphs, check_inputs):
+            for expected, output in zip(flatten_outputs(module(*inputs)), flatten_outputs(graph(*inputs))):
+                if expected.size() != output.size() or not torch.allclose(expected, output, atol=1e-4):
+                    raise Exception('the exported ' + name + ' differs from the eager model on other shapes')
+
+        for (name, _), graph in zip(modules, graphs):
+            torch.jit.save(graph, os.path.join(export_dir, name + '.pt'))
+
+    config = get_model_sizes(model)
+    config['conut'] = conut
+    config['device'] = str(device)
+    with open(os.path.join(export_dir, 'config.json'), 'w') as fp:
+        json.dump(config, fp)
+
+
+class ExportedModel():
+    """the TorchScript graphs written by export_model, run by ExportedModelCuda in beamsearch.py"""
+    def __init__(self, export_dir):
+        with open(os.path.join(export_dir, 'config.json'), 'r') as fp:
+            self.config = json.load(fp)
+        self.conut = self.config['conut']
+        self.device = self.config['device']
+        self.encoder = torch.jit.load(os.path.join(export_dir, 'encoder.pt'), map_location=self.device)
+        self.prefix_decoder = torch.jit.load(os.path.join(export_dir, 'prefix_decoder.pt'), map_location=self.device)
+        self.step_decoder = torch.jit.load(os.path.join(export_dir, 'step_decoder.pt'), map_location=self.device)
+
+    def to(self, device):
+        # the device is fixed when the graphs are traced
+        return self
@@ -44,15 +44,18 @@ class GPTCoNuTModel(nn.Module):
 
     def forward(self, src_tokens, src_tokens_with_pre_context, ctx_tokens,
                 prev_tokens_index, prev_tokens_with_context=None, labels=None):
+        # prev_context is shared by the source and the target, gpt runs over it once for both
+        gpt_prefix = get_gpt_prefix(self.embed_model.transformer, src_tokens, src_tokens_with_pre_context)
         encoder_out = self.encoder(
             src_tokens, src_tokens_with_pre_context,
-            ctx_tokens, share_embed_model=self.embed_model
+            ctx_tokens, share_embed_model=self.embed_model, gpt_prefix=gpt_prefix
         )
         decoder_out = self.decoder(
             prev_tokens_index, encoder_out,
             prev_tokens_with_context,
             share_embed_model=self.embed_model,
             output_lm_logits=True,
+            gpt_prefix=gpt_prefix,
         )
 
         if labels is not None:
@@ -110,15 +113,23 @@ class GPTFConvEncoder(nn.Module):
             layer_in_channels.append(out_channels)
         self.fc2 = linear(in_channels, embed_dim)
 
-    def forward(self, src_tokens, src_tokens_with_prev_context=None, share_embed_model=None):
+    def forward(self, src_tokens, src_tokens_with_prev_context=None, share_embed_model=None, gpt_prefix=None,
+                own_length=False):
+        """
+        gpt_prefix: prev_context already run by gpt (see get_gpt_prefix), then gpt only continues over the source
+        own_length: scale the self attention by the unpadded length of each bug, used in generation
+        """
         assert share_embed_model is not None
-        if src_tokens_with_prev_context is not None:
-            if src_tokens.is_cuda:
-                attention_mask = torch.ones(src_tokens_with_prev_context.size()).cuda().masked_fill_(
-                    src_tokens_with_prev_context == 0, 0).float().cuda()
-            else:
-                attention_mask = torch.ones(src_tokens_with_prev_context.size()).masked_fill_(
-                    src_tokens_with_prev_context == 0, 0).float()
+        if src_tokens_with_prev_context is not None and gpt_prefix is not None:
+            bsz = src_tokens.size(0)
+            src_tokens = src_tokens_with_prev_context.view(-1)[src_tokens.view(-1).eq(1)].view(bsz, -1)  # B, src
+            positions = gpt_prefix['length'].unsqueeze(1) + \
+                torch.arange(src_tokens.size(1), device=src_tokens.device).unsqueeze(0)
+            x = gpt_continue_forward(
+                share_embed_model.transformer, src_tokens, positions, src_tokens.ne(0).float(), gpt_prefix
+            )  # B, src, H
+        elif src_tokens_with_prev_context is not None:
+            attention_mask = src_tokens_with_prev_context.ne(0).float()
             
             embed = share_embed_model.transformer(
                 src_tokens_with_prev_context,
@@ -137,12 +148,7 @@ class GPTFConvEncoder(nn.Module):
             src_tokens = src_tokens_with_pre_context[mask]      # B x src
             src_tokens = src_tokens.view(bsz, -1)               # B, src
         else:
-            if src_tokens.is_cuda:
-                attention_mask = torch.ones(src_tokens.size()).cuda().masked_fill_(
-                    src_tokens == 0, 0).float().cuda()
-            else:
-                attention_mask = torch.ones(src_tokens.size()).masked_fill_(
-                    src_tokens == 0, 0).float()
+            attention_mask = src_tokens.ne(0).float()
             x = share_embed_model.transformer(
                 src_tokens,
                 attention_mask=attention_mask,
@@ -189,7 +195,9 @@ class GPTFConvEncoder(nn.Module):
             # self attention
             if attention is not None:
                 x = x.transpose(0, 1)
-                x_, _ = attention(x, target_embedding, (x.transpose(1, 2).contiguous(), x), encoder_padding_mask.t())
+                x_, _ = attention(
+                    x, target_embedding, (x.transpose(1, 2).contiguous(), x), encoder_padding_mask.t(), own_length
+                )
                 x = torch.cat([x, x_], dim=2)
                 x = F.glu(x, dim=2)
                 x = x.transpose(0, 1)
@@ -233,19 +241,28 @@ class GPTCoNuTEncoder(nn.Module):
             dictionary, embed_dim, max_positions, ctx_convolutions, dropout,
         )
 
-    def forward(self, src_tokens, src_tokens_with_prev_context, ctx_tokens, share_embed_model=None):
+    def forward(self, src_tokens, src_tokens_with_prev_context, ctx_tokens, share_embed_model=None, gpt_prefix=None,
+                own_length=False):
         # encode the buggy lines
         src_output = self.src_encoder.forward(
             src_tokens,
             src_tokens_with_prev_context=src_tokens_with_prev_context,
             share_embed_model=share_embed_model,
+            gpt_prefix=gpt_prefix,
+            own_length=own_length,
         )
         # encode the context lines
         ctx_output = self.context_encoder.forward(
             ctx_tokens,
             src_tokens_with_prev_context=None,
             share_embed_model=share_embed_model,
+            own_length=own_length,
         )
+        return self.merge_outputs(src_output, ctx_output)
+
+    @staticmethod
+    def merge_outputs(src_output, ctx_output):
+        # the decoder attends to the buggy lines and the context lines as one sequence
         if src_output['encoder_padding_mask'] is None or ctx_output['encoder_padding_mask'] is None:
             encoder_padding_mask = None
         else:
@@ -295,39 +312,64 @@ class GPTFConvDecoder(nn.Module):
         self.fc2 = linear(in_channels, len(dictionary))
 
     def forward(self, prev_tokens_index, encoder_out_dict,
-                prev_tokens_with_context=None, share_embed_model=None, output_lm_logits=False):
+                prev_tokens_with_context=None, share_embed_model=None, output_lm_logits=False,
+                incremental_state=None, last_only=False, vocab=None, gpt_prefix=None, own_length=False):
+        """
+        incremental_state: a dict of B x ... tensors used in generation, only the newest position
+        is decoded and the earlier positions are kept in the rolling buffers of the convolutions,
+        it can start from the prev_context run by the encoder, see get_prefix_state
+        gpt_prefix: prev_context already run by gpt (see get_gpt_prefix), then gpt only continues over the target
+        last_only: only output the distribution of the last position (B x 1 x V), used in generation
+        vocab: the candidate tokens of the beams, see sparse_output, None to project onto the whole dictionary
+        own_length: scale the attention by the unpadded length of each bug, used in generation (see AttentionLayer)
+        """
         src_tokens = encoder_out_dict['src_tokens']
-        encoder_out = encoder_out_dict['encoder_out']
         encoder_padding_mask = encoder_out_dict['encoder_padding_mask']
-        encoder_a, encoder_b = self._split_encoder_out(encoder_out)
+        if 'encoder_split' in encoder_out_dict:
+            # already split by the exported encoder, see export.py
+            encoder_a, encoder_b = encoder_out_dict['encoder_split']
+        else:
+            encoder_a, encoder_b = self._split_encoder_out(encoder_out_dict['encoder_out'])
 
         assert prev_tokens_with_context is not None
-        if prev_tokens_index.is_cuda:
-            attention_mask = torch.ones(prev_tokens_with_context.size()).cuda().masked_fill_(
-                prev_tokens_with_context == 0, 0).float().cuda()
+        if incremental_state is not None and 'origin' in incremental_state:
+            # decode the positions from incremental_state['start'] on, see get_positional_state
+            x = gpt_positional_forward(share_embed_model.transformer, prev_tokens_with_context, incremental_state)
+            lm_logits = None
+        elif incremental_state is not None:
+            # only embed the newest token, the gpt keys/values of the earlier tokens are cached
+            x = self._incremental_embed(
+                prev_tokens_index, prev_tokens_with_context, share_embed_model, incremental_state
+            )  # B, 1, H
+            lm_logits = None
+            if output_lm_logits:
+                lm_logits = share_embed_model.lm_head(x)
+                lm_logits = F.log_softmax(lm_logits, dim=-1)
         else:
-            attention_mask = torch.ones(prev_tokens_with_context.size()).masked_fill_(
-                prev_tokens_with_context == 0, 0).float()
-
-        # get the embedding of the decoded sequence from gpt
-        embed = share_embed_model.transformer(
-            prev_tokens_with_context,
-            attention_mask=attention_mask,
-        )[0]  # B, context_tgt, H
-        lm_logits = None
-        if output_lm_logits:
-            lm_logits = share_embed_model.lm_head(embed)
-            lm_logits = F.log_softmax(lm_logits, dim=-1)    # B, context_tgt, H
-        bsz = embed.size(0)
-        mask = prev_tokens_index.view(-1)  # B x context_tgt
-        mask = mask.eq(1)
+            if gpt_prefix is not None:
+                embed = gpt_continue_rows(share_embed_model.transformer, prev_tokens_with_context, gpt_prefix)
+            else:
+                attention_mask = prev_tokens_with_context.ne(0).float()
+
+                # get the embedding of the decoded sequence from gpt
+                embed = share_embed_model.transformer(
+                    prev_tokens_with_context,
+                    attention_mask=attention_mask,
+                )[0]  # B, context_tgt, H
+            lm_logits = None
+            if output_lm_logits:
+                lm_logits = share_embed_model.lm_head(embed)
+                lm_logits = F.log_softmax(lm_logits, dim=-1)    # B, context_tgt, H
+            bsz = embed.size(0)
+            mask = prev_tokens_index.view(-1)  # B x context_tgt
+            mask = mask.eq(1)
 
-        embed = embed.view(-1, embed.size(-1))  # B x context_tgt, H
+            embed = embed.view(-1, embed.size(-1))  # B x context_tgt, H
 
-        # take out the target part / exclude context before
-        x = embed[mask, :]  # B x tgt, H
+            # take out the target part / exclude context before
+            x = embed[mask, :]  # B x tgt, H
 
-        x = x.view(bsz, -1, x.size(1))  # B, tgt, H
+            x = x.view(bsz, -1, x.size(1))  # B, tgt, H
 
         x = self.embed_norm(x)
         x = F.dropout(x, p=self.dropout, training=self.training)
@@ -343,20 +385,26 @@ class GPTFConvDecoder(nn.Module):
         copy_scores = None
         num_attn_layers = len(self.attentions)
         residuals = [x]
-        for conv, attention, res_layer, norm in zip(self.convolutions, self.attentions,
-                                                    self.residuals, self.norms):
+        for i, (conv, attention, res_layer, norm) in enumerate(zip(self.convolutions, self.attentions,
+                                                                   self.residuals, self.norms)):
             if res_layer > 0:
                 residual = residuals[-res_layer]
             else:
                 residual = None
 
             x = F.dropout(x, p=self.dropout, training=self.training)
-            x = conv(x)
+            if incremental_state is not None and 'origin' in incremental_state:
+                x = self._positional_conv(i, conv, x, incremental_state)
+            elif incremental_state is not None:
+                key = 'conv_buffer_{}'.format(i)
+                x, incremental_state[key] = conv.incremental_forward(x, incremental_state.get(key))
+            else:
+                x = conv(x)
             x = F.glu(x, dim=2)
 
             # attention     T x B x C -> B x T x C
             x = x.transpose(0, 1)
-            x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b), encoder_padding_mask)
+            x, attn_scores = attention(x, target_embedding, (encoder_a, encoder_b), encoder_padding_mask, own_length)
             copy_scores = attn_scores
             attn_scores = attn_scores / num_attn_layers
             if avg_attn_scores is None:
@@ -373,26 +421,177 @@ class GPTFConvDecoder(nn.Module):
         # T x B x C -> B x T x C
         x = x.transpose(0, 1)
 
+        if last_only:
+            # the vocabulary projection and copy scores of the other positions are not needed
+            x = x[:, -1:, :]
+            target_embedding = target_embedding[:, -1:, :]
+            copy_scores = copy_scores[:, -1:, :]
+
         # B x T x [C + E]
         h = torch.cat([x, target_embedding], dim=-1)
         p_gen = F.sigmoid(self.fcg(h))
 
-        # project back to size of vocabulary
-        # B x T x C
-        x = self.fc2(x)
+        if vocab is not None:
+            x = self.sparse_output(x, p_gen, copy_scores, src_tokens, vocab)
+        else:
+            # project back to size of vocabulary
+            # B x T x C
+            x = self.fc2(x)
 
-        x = F.softmax(x, dim=-1)
+            x = F.softmax(x, dim=-1)
 
-        x = x * p_gen
+            x = x * p_gen
 
-        x = x.scatter_add(
-            2, src_tokens.unsqueeze(1).repeat(1, x.size(1), 1),
-            copy_scores * (1 - p_gen)
-        )
+            x = scatter_copy_scores(x, src_tokens, copy_scores * (1 - p_gen))
 
         x = torch.log(x + 1e-32)
         return x, avg_attn_scores, lm_logits
 
+    def sparse_output(self, x, p_gen, copy_scores, src_tokens, vocab):
+        """
+        The output distribution over the candidate tokens of each bug only (B x T x K), fc2 only projects onto them.
+        vocab: {'tokens': G x K, 'mask': G x K}, the candidate tokens (padded, mask is False on padding)
+        shared by B / G contiguous beams (B % G == 0). the softmax is taken over the candidates, so they get the
+        probabilities of the whole dictionary renormalized over them (the same if the other tokens get none),
+        and the copy scores of the source tokens which are not candidates are dropped
+        """
+        bsz, tgt_len = x.size(0), x.size(1)
+        group_num = vocab['tokens'].size(0)
+        weight, bias = self.fc2.weight, self.fc2.bias
+        if callable(weight):
+            # int8 quantized fc2, gather from its weight dequantized once
+            if not hasattr(self, 'fc2_dequantized'):
+                self.fc2_dequantized = (weight().dequantize(), bias())
+            weight, bias = self.fc2_dequantized
+        weight = weight[vocab['tokens']]    # G, K, C
+        bias = bias[vocab['tokens']]        # G, K
+
+        # G, B / G x T, K
+        x = torch.baddbmm(bias.unsqueeze(1), x.reshape(group_num, -1, x.size(-1)), weight.transpose(1, 2))
+        x = x.masked_fill(~vocab['mask'].unsqueeze(1), float('-inf'))
+        x = F.softmax(x, dim=-1) * p_gen.reshape(group_num, -1, 1)
+
+        # the copy score of a source token goes to the candidate of the same token, G x S x K
+        copy_index = src_tokens.unsqueeze(2).eq(vocab['tokens'].unsqueeze(1)) & vocab['mask'].unsqueeze(1)
+        copy_scores = (copy_scores * (1 - p_gen)).reshape(group_num, -1, copy_scores.size(-1))
+        x = torch.baddbmm(x, copy_scores, copy_index.type_as(x))
+        return x.view(bsz, tgt_len, -1)
+
+    def _incremental_embed(self, prev_tokens_index, prev_tokens_with_context, share_embed_model, incremental_state):
+        """
+        The first call runs gpt over prev_context (one row for each bug) and caches its keys/values
+        in incremental_state['prefix'], which is then shared by all the beams of the bug.
+        Later calls only get the newest token of each beam (the last column of prev_tokens_with_context),
+        its position follows incremental_state['position'], and its keys/values are appended to the cache.
+        """
+        if 'prefix_embed' in incremental_state:
+            # the first call after get_prefix_state, the prefix was run by the encoder
+            return incremental_state.pop('prefix_embed')
+        if 'prefix' not in incremental_state:
+            # the newest token is the last one read by the decoder
+            positions = torch.arange(prev_tokens_index.size(1), device=prev_tokens_index.device)
+            last = (prev_tokens_index * positions.unsqueeze(0)).max(1)[0].unsqueeze(1)  # B, 1
+            incremental_state['position'] = last
+
+            attention_mask = prev_tokens_with_context.ne(0).float()
+            embed, keys, values = gpt_prefix_forward(
+                share_embed_model.transformer, prev_tokens_with_context, attention_mask
+            )
+            incremental_state['prefix'] = {'mask': attention_mask}
+            for i in range(len(keys)):
+                incremental_state['prefix']['key_{}'.format(i)] = keys[i]
+                incremental_state['prefix']['value_{}'.format(i)] = values[i]
+            return embed.gather(1, last.unsqueeze(-1).expand(-1, -1, embed.size(-1)))
+
+        position = incremental_state['position'] + 1
+        incremental_state['position'] = position
+        return gpt_step_forward(
+            share_embed_model.transformer, prev_tokens_with_context[:, -1:], position, incremental_state
+        )
+
+    @staticmethod
+    def get_prefix_state(gpt_prefix):
+        """
+        the incremental_state of the first decoder call (one beam for each bug) from the prev_context run by
+        the encoder, instead of running gpt over prev_context again
+        """
+        last = (gpt_prefix['length'] - 1).unsqueeze(1)  # B, 1
+        hidden = gpt_prefix['hidden']
+        incremental_state = {
+            'position': last,
+            'prefix': {'mask': gpt_prefix['mask']},
+            'prefix_embed': hidden.gather(1, last.unsqueeze(-1).expand(-1, -1, hidden.size(-1))),
+        }
+        for key in gpt_prefix:
+            if key.startswith('key_') or key.startswith('value_'):
+                incremental_state['prefix'][key] = gpt_prefix[key]
+        return incremental_state
+
+    @staticmethod
+    def get_positional_state(incremental_state):
+        """
+        Turn the incremental_state after the first call into a state which keeps the gpt keys/values and the
+        convolution inputs of every decoded position instead of appending / rolling them, so each row can go
+        on from any position it has decoded (e.g. after some speculative tokens are rejected).
+        Before each call state['start'] (B) is set to the position of the first token fed to each row,
+        position 0 is the last token of prev_context and position t the t-th generated token,
+        the positions from start on are overwritten.
+        """
+        position = incremental_state['position']
+        prefix = incremental_state['prefix']
+        state = {'origin': position, 'prefix': prefix, 'start': position.new_ones(position.size(0))}
+        i = 0
+        while 'key_{}'.format(i) in prefix:
+            key = prefix['key_{}'.format(i)]
+            state['gpt_key_{}'.format(i)] = key.new_zeros(position.size(0), key.size(1), 0, key.size(3))
+            state['gpt_value_{}'.format(i)] = key.new_zeros(position.size(0), key.size(1), 0, key.size(3))
+            i += 1
+        i = 0
+        while 'conv_buffer_{}'.format(i) in incremental_state:
+            # the kernel_size - 1 inputs before position 0 are zeros, the buffer ends with the input of position 0
+            buffer = incremental_state['conv_buffer_{}'.format(i)]
+            state['conv_input_{}'.format(i)] = torch.cat(
+                [buffer.new_zeros(buffer.size(0), 1, buffer.size(2)), buffer], dim=1
+            )
+            i += 1
+        return state
+
+    @staticmethod
+    def _positional_conv(i, conv, x, state):
+        """
+        The causal convolution of the positions from state['start'] on (x: T x B x C), the inputs of every position
+        are kept in state['conv_input_i'] (B x (kernel_size - 1 + positions) x C, the first kernel_size - 1 are zeros)
+        """
+        kernel_size = conv.kernel_size[0]
+        key = 'conv_input_{}'.format(i)
+        start = state['start'].unsqueeze(1)
+        inputs = pad_positions(state[key], kernel_size + int(start.max()) + x.size(0) - 1, dim=1)
+        window = torch.arange(kernel_size - 1, device=x.device).unsqueeze(0) + start
+        window = inputs.gather(1, window.unsqueeze(-1).expand(-1, -1, x.size(2)))
+        output, _ = conv.incremental_forward(x, window)
+        index = torch.arange(x.size(0), device=x.device).unsqueeze(0) + start + kernel_size - 1
+        state[key] = inputs.scatter(1, index.unsqueeze(-1).expand(-1, -1, x.size(2)), x.transpose(0, 1))
+        return output
+
+    @staticmethod
+    def reorder_incremental_state(incremental_state, new_order):
+        """Select (and repeat) the beams kept in incremental_state, new_order: the index of the kept beams."""
+        for key in incremental_state:
+            if key == 'prefix':
+                continue
+            incremental_state[key] = incremental_state[key].index_select(
+                0, new_order.to(incremental_state[key].device)
+            )
+
+    @staticmethod
+    def reorder_incremental_prefix(incremental_state, new_order):
+        """Select the cached prefix of the bugs still being decoded, new_order: the index of the kept bugs."""
+        if 'prefix' not in incremental_state:
+            return
+        prefix = incremental_state['prefix']
+        for key in prefix:
+            prefix[key] = prefix[key].index_select(0, new_order.to(prefix[key].device))
+
     def _split_encoder_out(self, encoder_out):
         """Split and transpose encoder outputs."""
         # transpose only once to speed up attention layers
@@ -413,12 +612,21 @@ class AttentionLayer(nn.Module):
 
         self.bmm = torch.bmm
 
-    def forward(self, x, target_embedding, encoder_out, encoder_padding_mask):
+    def forward(self, x, target_embedding, encoder_out, encoder_padding_mask, own_length=False):
+        """
+        x, target_embedding: B x T x C, encoder_out: (G x C x S, G x S x C), encoder_padding_mask: G x S
+        the encoder output of a bug can be shared by its B / G contiguous beams (B % G == 0), it is broadcast
+        over them instead of being repeated
+        own_length: scale by the unpadded length of each bug instead of S, so the output in generation
+        does not depend on the bugs it is padded with, training scales by S
+        """
         residual = x
+        bsz, tgt_len = x.size(0), x.size(1)
+        group_num = encoder_out[0].size(0)
         x = (self.in_projection(x) + target_embedding) * math.sqrt(0.5)
         #print(x.size(), encoder_out[0].size(), encoder_out[1].size())
-        # B x L x C, B x C x L
-        x = self.bmm(x, encoder_out[0])
+        # G x (B / G x T) x C, G x C x L
+        x = self.bmm(x.reshape(group_num, -1, x.size(-1)), encoder_out[0])
 
         x = x.float().masked_fill(
             encoder_padding_mask.unsqueeze(1),
@@ -428,16 +636,252 @@ class AttentionLayer(nn.Module):
         sz = x.size()
         x = F.softmax(x.view(sz[0] * sz[1], sz[2]), dim=1)
         x = x.view(sz)
-        attn_scores = x
+        attn_scores = x.view(bsz, tgt_len, -1)
 
         x = self.bmm(x, encoder_out[1])
-        s = encoder_out[1].size(1)
-        x = x * (s * math.sqrt(1.0 / s))
+        if own_length:
+            s = (~encoder_padding_mask).type_as(x).sum(dim=1).view(group_num, 1, 1)
+            x = x * (s * s.rsqrt())
+        else:
+            s = encoder_out[1].size(1)
+            x = x * (s * math.sqrt(1.0 / s))
+        x = x.view(bsz, tgt_len, -1)
 
         x = (self.out_projection(x) + residual) * math.sqrt(0.5)
         return x, attn_scores
 
 
+def gpt_qkv(attn, hidden):
+    """Query, key and value of an OpenAI GPT attention layer, B x T x E -> B x H x T x D."""
+    x = attn.c_attn(hidden)
+    query, key, value = x.split(attn.split_size, dim=2)
+    return [t.view(t.size(0), t.size(1), attn.n_head, -1).transpose(1, 2) for t in (query, key, value)]
+
+
+def gpt_block_output(block, hidden, a):
+    """The rest of an OpenAI GPT block after the attention weighted sum a (B x H x T x D)."""
+    a = a.transpose(1, 2).contiguous().view(hidden.size())
+    a = block.attn.resid_dropout(block.attn.c_proj(a))
+    n = block.ln_1(hidden + a)
+    m = block.mlp(n)
+    return block.ln_2(n + m)
+
+
+def gpt_prefix_forward(transformer, input_ids, attention_mask):
+    """
+    The same as transformer(input_ids, attention_mask=attention_mask)[0],
+    but also return the keys/values (B x H x T x D) of every layer so decoding can continue from them
+    """
+    position_ids = torch.arange(input_ids.size(1), device=input_ids.device).unsqueeze(0)
+    hidden = transformer.tokens_embed(input_ids) + transformer.positions_embed(position_ids)
+    hidden = transformer.drop(hidden)
+
+    future_mask = torch.ones(input_ids.size(1), input_ids.size(1), device=input_ids.device).triu(1).bool()
+    padding_mask = (1.0 - attention_mask).unsqueeze(1).unsqueeze(2) * -10000.0  # B, 1, 1, T
+    keys, values = [], []
+    for block in transformer.h:
+        query, key, value = gpt_qkv(block.attn, hidden)
+        w = torch.matmul(query, key.transpose(-1, -2))
+        if block.attn.scale:
+            w = w / math.sqrt(value.size(-1))
+        w = w.masked_fill(future_mask, -1e4) + padding_mask
+        w = block.attn.attn_dropout(F.softmax(w, dim=-1))
+        hidden = gpt_block_output(block, hidden, torch.matmul(w, value))
+        keys.append(key)
+        values.append(value)
+    return hidden, keys, values
+
+
+def get_gpt_prefix(transformer, src_tokens, src_tokens_with_prev_context):
+    """
+    Run the OpenAI GPT transformer over prev_context, the tokens of src_tokens_with_prev_context before the source
+    (src_tokens is 1 on the source), which the source and the target rows both start with.
+    return {'length': B, the length of prev_context, 'mask': B x P, 'hidden': B x P x E, 'key_i'/'value_i'}
+    """
+    length = src_tokens.cumsum(1).eq(0).sum(1)
+    prefix_len = int(length.max())
+    input_ids = src_tokens_with_prev_context[:, : prefix_len]
+    positions = torch.arange(prefix_len, device=input_ids.device).unsqueeze(0)
+    mask = (positions < length.unsqueeze(1)).float() * input_ids.ne(0).float()
+    hidden, keys, values = gpt_prefix_forward(transformer, input_ids, mask)
+    gpt_prefix = {'length': length, 'mask': mask, 'hidden': hidden}
+    for i in range(len(keys)):
+        gpt_prefix['key_{}'.format(i)] = keys[i]
+        gpt_prefix['value_{}'.format(i)] = values[i]
+    return gpt_prefix
+
+
+def gpt_continue_forward(transformer, input_ids, position_ids, attention_mask, gpt_prefix):
+    """
+    Run the OpenAI GPT transformer over input_ids (B x T, at position_ids) following the prefix of each row
+    (see get_gpt_prefix), the same as running it over the prefix and input_ids together
+    """
+    prefix_len = gpt_prefix['mask'].size(1)
+    prefix_mask = (1.0 - gpt_prefix['mask']).unsqueeze(1).unsqueeze(2) * -10000.0  # B, 1, 1, P
+    padding_mask = (1.0 - attention_mask).unsqueeze(1).unsqueeze(2) * -10000.0    # B, 1, 1, T
+    future_mask = torch.ones(input_ids.size(1), input_ids.size(1), device=input_ids.device).triu(1).bool()
+
+    hidden = transformer.tokens_embed(input_ids) + transformer.positions_embed(position_ids)
+    hidden = transformer.drop(hidden)
+    for i, block in enumerate(transformer.h):
+        query, key, value = gpt_qkv(block.attn, hidden)  # B, H, T, D
+        w_prefix = torch.matmul(query, gpt_prefix['key_{}'.format(i)].transpose(-1, -2))
+        w = torch.matmul(query, key.transpose(-1, -2))
+        if block.attn.scale:
+            w_prefix = w_prefix / math.sqrt(value.size(-1))
+            w = w / math.sqrt(value.size(-1))
+        w = torch.cat([w_prefix + prefix_mask, w.masked_fill(future_mask, -1e4) + padding_mask], dim=-1)
+        w = block.attn.attn_dropout(F.softmax(w, dim=-1))
+        a = torch.matmul(w[..., : prefix_len], gpt_prefix['value_{}'.format(i)]) + \
+            torch.matmul(w[..., prefix_len:], value)
+        hidden = gpt_block_output(block, hidden, a)
+    return hidden
+
+
+def gpt_continue_rows(transformer, input_ids, gpt_prefix):
+    """
+    The same as transformer(input_ids, attention_mask=input_ids.ne(0).float())[0] for rows (B x W) starting with
+    the prefix of get_gpt_prefix, gpt only runs over the tokens after it
+    """
+    width = input_ids.size(1)
+    length = gpt_prefix['length']
+    positions = length.unsqueeze(1) + \
+        torch.arange(width - int(length.min()), device=input_ids.device).unsqueeze(0)  # B, T
+    valid = positions < width
+    positions = positions.clamp(max=width - 1)
+    tokens = input_ids.gather(1, positions) * valid.long()
+    hidden = gpt_continue_forward(transformer, tokens, positions, tokens.ne(0).float(), gpt_prefix)
+
+    # the prefix hidden states followed by the continued ones, the positions past a row go to an extra column
+    rows = F.pad(gpt_prefix['hidden'], (0, 0, 0, width + 1 - gpt_prefix['hidden'].size(1)))
+    index = torch.where(valid, positions, torch.full_like(positions, width))
+    rows = rows.scatter(1, index.unsqueeze(-1).expand(-1, -1, hidden.size(-1)), hidden)
+    return rows[:, : width].contiguous()
+
+
+def gpt_step_forward(transformer, input_ids, position_ids, incremental_state):
+    """
+    Run the OpenAI GPT transformer over the newest token of each beam (input_ids, position_ids: B x 1).
+    The beams attend to incremental_state['prefix'] (G x ..., B % G == 0, the B / G beams of a prefix are
+    contiguous) without copying it, and to the keys/values of their own generated tokens, which are appended
+    to incremental_state['gpt_key_i'] / ['gpt_value_i'] (B x H x step x D)
+    """
+    prefix = incremental_state['prefix']
+    group_num = prefix['mask'].size(0)
+    bsz = input_ids.size(0)
+    padding_mask = ((1.0 - prefix['mask']) * -10000.0).view(group_num, 1, 1, 1, -1)  # G, 1, 1, 1, P
+
+    hidden = transformer.tokens_embed(input_ids) + transformer.positions_embed(position_ids)
+    hidden = transformer.drop(hidden)
+    for i, block in enumerate(transformer.h):
+        query, key, value = gpt_qkv(block.attn, hidden)  # B, H, 1, D
+        key_name, value_name = 'gpt_key_{}'.format(i), 'gpt_value_{}'.format(i)
+        if key_name in incremental_state:
+            key = torch.cat([incremental_state[key_name], key], dim=2)
+            value = torch.cat([incremental_state[value_name], value], dim=2)
+        incremental_state[key_name], incremental_state[value_name] = key, value
+
+        # G, B / G, H, 1, P, the prefix keys are broadcast over the beams of each group
+        query = query.reshape(group_num, bsz // group_num, *query.size()[1:])
+        w_prefix = torch.matmul(query, prefix['key_{}'.format(i)].unsqueeze(1).transpose(-1, -2))
+        # G, B / G, H, 1, step
+        w_step = torch.matmul(query, key.reshape(group_num, bsz // group_num, *key.size()[1:]).transpose(-1, -2))
+        w = torch.cat([w_prefix, w_step], dim=-1)
+        if block.attn.scale:
+            w = w / math.sqrt(value.size(-1))
+        w = torch.cat([w[..., : w_prefix.size(-1)] + padding_mask, w[..., w_prefix.size(-1):]], dim=-1)
+        w = block.attn.attn_dropout(F.softmax(w, dim=-1))
+
+        prefix_len = w_prefix.size(-1)
+        a = torch.matmul(w[..., : prefix_len], prefix['value_{}'.format(i)].unsqueeze(1)) + \
+            torch.matmul(w[..., prefix_len:], value.reshape(group_num, bsz // group_num, *value.size()[1:]))
+        a = a.reshape(bsz, *a.size()[2:])  # B, H, 1, D
+        hidden = gpt_block_output(block, hidden, a)
+    return hidden
+
+
+def gpt_positional_forward(transformer, input_ids, state):
+    """
+    Run the OpenAI GPT transformer over the tokens input_ids (B x T) of the positions from state['start'] on
+    (see GPTFConvDecoder.get_positional_state). The rows attend to the prefix of their bug (shared by B / G rows
+    like in gpt_step_forward), to the generated tokens before start and to the new tokens before them,
+    the keys/values of the new tokens are written to state['gpt_key_i'] / ['gpt_value_i'] (B x H x slots x D),
+    the generated token t in slot t - 1
+    """
+    prefix = state['prefix']
+    group_num = prefix['mask'].size(0)
+    bsz, tgt_len = input_ids.size()
+    start = state['start'].unsqueeze(1)  # B, 1
+    offsets = torch.arange(tgt_len, device=input_ids.device).unsqueeze(0)
+    slots = start - 1 + offsets  # B, T
+    slot_num = int(slots.max()) + 1
+    earlier = torch.arange(slot_num, device=input_ids.device).unsqueeze(0) < start - 1
+    slot_mask = ((1.0 - earlier.float()) * -10000.0).view(bsz, 1, 1, -1)  # B, 1, 1, slots
+    padding_mask = ((1.0 - prefix['mask']) * -10000.0).view(group_num, 1, 1, 1, -1)  # G, 1, 1, 1, P
+    future_mask = torch.ones(tgt_len, tgt_len, device=input_ids.device).triu(1).bool()
+
+    hidden = transformer.tokens_embed(input_ids) + transformer.positions_embed(state['origin'] + start + offsets)
+    hidden = transformer.drop(hidden)
+    for i, block in enumerate(transformer.h):
+        query, key, value = gpt_qkv(block.attn, hidden)  # B, H, T, D
+        key_name, value_name = 'gpt_key_{}'.format(i), 'gpt_value_{}'.format(i)
+        slot_keys = pad_positions(state[key_name], slot_num, dim=2)
+        slot_values = pad_positions(state[value_name], slot_num, dim=2)
+
+        # G, B / G, H, T, P, the prefix keys are broadcast over the rows of each group
+        grouped = query.reshape(group_num, bsz // group_num, *query.size()[1:])
+        w_prefix = torch.matmul(grouped, prefix['key_{}'.format(i)].unsqueeze(1).transpose(-1, -2))
+        w_slots = torch.matmul(query, slot_keys.transpose(-1, -2))
+        w_new = torch.matmul(query, key.transpose(-1, -2))
+        if block.attn.scale:
+            w_prefix = w_prefix / math.sqrt(value.size(-1))
+            w_slots = w_slots / math.sqrt(value.size(-1))
+            w_new = w_new / math.sqrt(value.size(-1))
+        w_prefix = (w_prefix + padding_mask).reshape(bsz, *w_prefix.size()[2:])
+        w = torch.cat([w_prefix, w_slots + slot_mask, w_new.masked_fill(future_mask, -1e4)], dim=-1)
+        w = block.attn.attn_dropout(F.softmax(w, dim=-1))
+
+        prefix_len = w_prefix.size(-1)
+        a = torch.matmul(
+            w[..., : prefix_len].reshape(group_num, bsz // group_num, *w.size()[1: -1], prefix_len),
+            prefix['value_{}'.format(i)].unsqueeze(1),
+        ).reshape(bsz, *query.size()[1:])
+        a = a + torch.matmul(w[..., prefix_len: prefix_len + slot_num], slot_values) + \
+            torch.matmul(w[..., prefix_len + slot_num:], value)
+
+        index = slots.view(bsz, 1, tgt_len, 1).expand(-1, key.size(1), -1, key.size(3))
+        state[key_name] = slot_keys.scatter(2, index, key)
+        state[value_name] = slot_values.scatter(2, index, value)
+        hidden = gpt_block_output(block, hidden, a)
+    return hidden
+
+
+def pad_positions(tensor, size, dim):
+    """
+    tensor padded with zeros or cut to size along dim, the positions cut are left from a longer call
+    whose tokens were then rejected, they are overwritten before being read again
+    """
+    if tensor.size(dim) >= size:
+        return tensor.narrow(dim, 0, size)
+    shape = list(tensor.size())
+    shape[dim] = size - tensor.size(dim)
+    return torch.cat([tensor, tensor.new_zeros(shape)], dim=dim)
+
+
+def scatter_copy_scores(x, src_tokens, copy_scores):
+    """
+    Add the copy scores (B x T x S) to the probabilities x (B x T x V) of the source tokens (G x S),
+    the source tokens of a bug are shared by its B / G contiguous rows (B % G == 0)
+    """
+    group_num = src_tokens.size(0)
+    x = x.reshape(group_num, -1, x.size(-1))
+    x = x.scatter_add(
+        2, src_tokens.unsqueeze(1).expand(-1, x.size(1), -1),
+        copy_scores.reshape(group_num, -1, copy_scores.size(-1))
+    )
+    return x.view(copy_scores.size(0), copy_scores.size(1), -1)
+
+
 def extend_conv_spec(convolutions):
     """
     Extends convolutional spec that is a list of tuples of 2 or 3 parameters
@@ -1,6 +1,6 @@
 import torch.nn as nn
 
-from gpt_conut import GPTFConvEncoder, GPTFConvDecoder
+from gpt_conut import GPTFConvEncoder, GPTFConvDecoder, get_gpt_prefix
 
 
 class GPTFConvModel(nn.Module):
@@ -38,15 +38,18 @@ class GPTFConvModel(nn.Module):
 
     def forward(self, src_tokens, src_tokens_with_pre_context,
                 prev_tokens_index, prev_tokens_with_context=None, labels=None):
+        # prev_context is shared by the source and the target, gpt runs over it once for both
+        gpt_prefix = get_gpt_prefix(self.embed_model.transformer, src_tokens, src_tokens_with_pre_context)
         encoder_out = self.encoder(
             src_tokens, src_tokens_with_pre_context,
-            share_embed_model=self.embed_model
+            share_embed_model=self.embed_model, gpt_prefix=gpt_prefix
         )
         decoder_out = self.decoder(
             prev_tokens_index, encoder_out,
             prev_tokens_with_context,
             share_embed_model=self.embed_model,
             output_lm_logits=True,
+            gpt_prefix=gpt_prefix,
         )
 
         if labels is not None:
@@ -0,0 +1,29 @@
+import torch
+import torch.nn as nn
+
+
+def conv1d_to_linear(module):
+    """
+    Replace the Conv1D layers of the transformers GPT blocks (x @ W + b, W: in x out) by the equivalent
+    nn.Linear, so dynamic quantization picks them up together with the other linear layers
+    """
+    for name, child in module.named_children():
+        if type(child).__name__ == 'Conv1D':
+            m = nn.Linear(child.weight.size(0), child.weight.size(1))
+            m.weight.data = child.weight.data.t().contiguous()
+            m.bias.data = child.bias.data.clone()
+            setattr(module, name, m)
+        else:
+            conv1d_to_linear(child)
+    return module
+
+
+def quantize_model(model):
+    """
+    int8 dynamic quantization of every nn.Linear of a GPT-CoNuT / GPT-FConv model
+    (fc1/fc2, the attention projections and the GPT blocks), for generation on cpu.
+    the convolutions and embeddings stay in float
+    """
+    model = model.to('cpu').eval()
+    conv1d_to_linear(model.embed_model)
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
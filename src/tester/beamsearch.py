@@ -1,14 +1,19 @@
 import re
 import os
 import math
+import string
 import torch
 import torch.nn as nn
 import sys
 
 BEAM_SEARCH_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
 sys.path.append(BEAM_SEARCH_DIR + '../models/')
-from gpt_conut import GPTCoNuTModel
+from gpt_conut import GPTCoNuTModel, GPTCoNuTEncoder, GPTFConvDecoder, get_gpt_prefix
 from gpt_fconv import GPTFConvModel
+from export import ExportedModel, get_model_sizes
+from identifier_trie import IdentifierTrie
+from encoder_cache import get_model_hash, merge_cached_outputs
+from profiler import NULL_PHASE
 
 
 def get_statement_length(seq):
@@ -19,34 +24,48 @@ def get_statement_length(seq):
     return len(s.strip().split())
 
 
-def add_token_to_string(string, symbol):
-    if symbol in ['CaMeL', '_', '.']:
-        return string + symbol
-    elif string[-5:] == 'CaMeL' or string[-1:] in ['_', '.'] or string[-2:] == '@@':
-        return string + symbol
-    else:
-        return string + ' ' + symbol
+JAVA_KEYWORDS = [
+    'abstract', 'assert', 'boolean', 'break', 'byte', 'case', 'catch', 'char', 'class', 'const',
+    'continue', 'default', 'do', 'double', 'else', 'enum', 'extends', 'final', 'finally', 'float',
+    'for', 'goto', 'if', 'implements', 'import', 'instanceof', 'int', 'interface', 'long', 'native',
+    'new', 'package', 'private', 'protected', 'public', 'return', 'short', 'static', 'strictfp', 'super',
+    'switch', 'synchronized', 'this', 'throw', 'throws', 'transient', 'try', 'void', 'volatile', 'while',
+    'true', 'false', 'null', '$NUMBER$', '$STRING$',
+]
 
 
-class GPTCoNuTModelCuda(nn.Module):
-    def __init__(self, model, beam_size):
-        super(GPTCoNuTModelCuda, self).__init__()
-        self.model = model.cuda()
+# the polynomial hash of the rendered statements, used to find duplicated beams
+HASH_BASE = 131
+HASH_MOD = 2 ** 31 - 1
+
+
+class GPTModelCuda(nn.Module):
+    def __init__(self, model, beam_size, device='cuda', memory_budget=None, encoder_cache=None):
+        super(GPTModelCuda, self).__init__()
+        self.device = torch.device(device)
+        self.model = model.to(self.device)
         self.beam_size = beam_size
         self.split_size = beam_size
         self.split_size_list = [self.split_size]
+        # the memory (MB) a decode chunk may use, None to choose the chunk size by the decoded length
+        self.memory_budget = memory_budget
+        # shrunk after running out of memory, so the later steps use smaller chunks
+        self.memory_scale = 1.0
+        # an EncoderCache shared by the bugs (and runs) with the same tokens, None to always encode
+        self.encoder_cache = encoder_cache
+        self.model_hash = None
 
     def forward(self):
         pass
 
-    def encoder_out_to_cuda(self, encoder_out):
+    def encoder_out_to_device(self, encoder_out):
         return {
-            'src_tokens': encoder_out['src_tokens'].cuda(),
+            'src_tokens': encoder_out['src_tokens'].to(self.device),
             'encoder_out': (
-                encoder_out['encoder_out'][0].cuda(),
-                encoder_out['encoder_out'][1].cuda(),
+                encoder_out['encoder_out'][0].to(self.device),
+                encoder_out['encoder_out'][1].to(self.device),
             ),
-            'encoder_padding_mask': encoder_out['encoder_padding_mask'].cuda(),
+            'encoder_padding_mask': encoder_out['encoder_padding_mask'].to(self.device),
         }
 
     def encoder_out_to_cpu(self, encoder_out):
@@ -59,629 +78,891 @@ class GPTCoNuTModelCuda(nn.Module):
             'encoder_padding_mask': encoder_out['encoder_padding_mask'].to('cpu'),
         }
 
-    def encode(self, src_tokens, src_with_prev_context, ctx_tokens):
-        encoder_out = self.model.encoder(
-            src_tokens.cuda(),
-            src_with_prev_context.cuda(),
-            ctx_tokens.cuda(),
-            self.model.embed_model,
-        )
-        return self.encoder_out_to_cpu(encoder_out)
+    def select_encoder_out(self, encoder_out, bug_ids):
+        # pick the encoder output of the bugs
+        return {
+            'src_tokens': encoder_out['src_tokens'].index_select(0, bug_ids),
+            'encoder_out': (
+                encoder_out['encoder_out'][0].index_select(0, bug_ids),
+                encoder_out['encoder_out'][1].index_select(0, bug_ids),
+            ),
+            'encoder_padding_mask': encoder_out['encoder_padding_mask'].index_select(0, bug_ids),
+        }
 
-    def decode(self, prev_tokens_index, encoder_out, prev_tokens):
+    def encode_cached(self, name, encoder, src_tokens, src_with_prev_context=None):
+        """
+        the output of encoder (a GPTFConvEncoder) for the bugs, only the bugs not in encoder_cache are encoded,
+        one at a time so the output cached for a bug (trimmed to its length) does not depend on the bugs it
+        happened to be encoded with, and it can be reused in any batch
+        """
+        if self.model_hash is None:
+            self.model_hash = get_model_hash(self.model)
+        keys, values, misses = [], [], []
+        for b in range(src_tokens.size(0)):
+            if src_with_prev_context is not None:
+                key = self.encoder_cache.get_key(self.model_hash, name, src_with_prev_context[b], src_tokens[b])
+            else:
+                key = self.encoder_cache.get_key(self.model_hash, name, src_tokens[b])
+            keys.append(key)
+            values.append(self.encoder_cache.get(key))
+            if values[-1] is None:
+                misses.append(b)
+        for b in misses:
+            encoder_out = encoder(
+                src_tokens[b: b + 1].to(self.device),
+                src_with_prev_context[b: b + 1].to(self.device) if src_with_prev_context is not None else None,
+                self.model.embed_model,
+                own_length=True,
+            )
+            encoder_out = self.encoder_out_to_cpu(encoder_out)
+            length = int(encoder_out['src_tokens'][0].ne(0).sum())
+            values[b] = (
+                encoder_out['src_tokens'][0, : length],
+                encoder_out['encoder_out'][0][0, : length],
+                encoder_out['encoder_out'][1][0, : length],
+            )
+            self.encoder_cache.put(keys[b], values[b])
+        return merge_cached_outputs(values)
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        self.model.decoder.reorder_incremental_state(incremental_state, new_order)
+
+    def reorder_incremental_prefix(self, incremental_state, new_order):
+        self.model.decoder.reorder_incremental_prefix(incremental_state, new_order)
+
+    def get_splits(self, beam_num, bug_beam_num):
+        """
+        split the beams (bug_beam_num beams for each bug, contiguous) into chunks of at most split_size beams,
+        a chunk either holds whole bugs or part of the beams of one bug
+        return a list of (start beam, end beam, start bug, end bug)
+        """
+        splits = []
+        if self.split_size >= bug_beam_num:
+            split_size = self.split_size // bug_beam_num * bug_beam_num
+            for start in range(0, beam_num, split_size):
+                end = min(beam_num, start + split_size)
+                splits.append((start, end, start // bug_beam_num, end // bug_beam_num))
+        else:
+            for bug_start in range(0, beam_num, bug_beam_num):
+                bug = bug_start // bug_beam_num
+                for start in range(bug_start, bug_start + bug_beam_num, self.split_size):
+                    end = min(bug_start + bug_beam_num, start + self.split_size)
+                    splits.append((start, end, bug, bug + 1))
+        return splits
+
+    def get_model_sizes(self):
+        return get_model_sizes(self.model)
+
+    def estimate_beam_memory(self, ctx_len, tgt_len, src_len, incremental):
+        """
+        a rough estimation of the bytes one beam needs in one decoding step (float32)
+        ctx_len: the length gpt attends to, tgt_len: the number of decoded positions, src_len: the encoder length
+        """
+        sizes = self.get_model_sizes()
+        if incremental:
+            # the attention of the newest token, and the cached keys/values which are copied when appended
+            gpt = sizes['n_head'] * ctx_len * 2 + sizes['n_layer'] * 4 * sizes['n_embd'] * ctx_len + \
+                8 * sizes['n_embd']
+        else:
+            # the attention of every position, the hidden states, queries, keys, values and mlp of a layer
+            gpt = sizes['n_head'] * ctx_len * ctx_len * 2 + 8 * sizes['n_embd'] * ctx_len
+        decoder = tgt_len * (sizes['conv_num'] * 4 * sizes['channels'] + 2 * src_len)
+        output = 3 * sizes['vocab_size']
+        return 4 * (gpt + decoder + output)
+
+    def get_split_size(self, prev_tokens_index, prev_tokens, encoder_out, incremental_state):
+        beam_num = prev_tokens_index.size(0)
         step = int(torch.sum(prev_tokens_index[0]))
         ctx_len = prev_tokens.size(1)
-        if step * ctx_len <= 3000:
-            self.split_size = min(self.beam_size, 200)
+        if self.memory_budget is not None:
+            incremental = incremental_state is not None and 'prefix' in incremental_state
+            if incremental:
+                ctx_len = incremental_state['prefix']['mask'].size(1)
+                if 'gpt_key_0' in incremental_state:
+                    ctx_len += incremental_state['gpt_key_0'].size(2)
+            beam_memory = self.estimate_beam_memory(
+                ctx_len, 1 if incremental else step, encoder_out['src_tokens'].size(1), incremental
+            )
+            if incremental and 'origin' in incremental_state:
+                # the positional state decodes several positions of each beam at once
+                beam_memory *= prev_tokens.size(1)
+            split_size = self.memory_budget * 1024 * 1024 * self.memory_scale // beam_memory
+        elif self.device.type == 'cpu':
+            # nothing to shuttle between devices, decode all the beams at once
+            split_size = beam_num * self.memory_scale
+        elif step * ctx_len <= 3000:
+            split_size = 200 * self.memory_scale
         elif step * ctx_len <= 5000:
-            self.split_size = min(self.beam_size, 100)
+            split_size = 100 * self.memory_scale
         elif step * ctx_len <= 10000:
-            self.split_size = min(self.beam_size, 50)
-        else:
-            self.split_size = min(self.beam_size, 20)
-        split_num = self.beam_size // self.split_size
-        self.split_size_list = [self.split_size] * split_num
-        if self.beam_size % self.split_size != 0:
-            self.split_size_list += [self.beam_size % self.split_size]
-        if prev_tokens_index.size(0) == 1:
-            return self.model.decoder(
-                prev_tokens_index.cuda(),
-                self.encoder_out_to_cuda(encoder_out),
-                prev_tokens.cuda(),
-                self.model.embed_model,
-            )[0].to('cpu')
+            split_size = 50 * self.memory_scale
         else:
-            assert prev_tokens_index.size(0) == sum(self.split_size_list)
-            decoder_out = []
-            split_encoder_out = {
-                'src_tokens': encoder_out['src_tokens'][:self.split_size, ...].cuda(),
-                'encoder_out': (
-                    encoder_out['encoder_out'][0][:self.split_size, ...].cuda(),
-                    encoder_out['encoder_out'][1][:self.split_size, ...].cuda(),
-                ),
-                'encoder_padding_mask': encoder_out['encoder_padding_mask'][:self.split_size, ...].cuda(),
-            }
-            for i in range(len(self.split_size_list)):
-                if i == len(self.split_size_list) - 1:
-                    split_encoder_out = {
-                        'src_tokens': split_encoder_out['src_tokens'][:self.split_size_list[-1], ...],
-                        'encoder_out': (
-                            split_encoder_out['encoder_out'][0][:self.split_size_list[-1], ...],
-                            split_encoder_out['encoder_out'][1][:self.split_size_list[-1], ...],
-                        ),
-                        'encoder_padding_mask': split_encoder_out['encoder_padding_mask'][:self.split_size_list[-1], ...],
+            split_size = 20 * self.memory_scale
+        return max(1, min(beam_num, int(split_size)))
+
+    def decode(self, prev_tokens_index, encoder_out, prev_tokens, beam_bug_ids, incremental_state=None, vocab=None):
+        """
+        prev_tokens_index, prev_tokens: N x L, the beams of all the bugs in the batch, grouped by bug
+        encoder_out: the encoder output of the bugs, beam_bug_ids maps each beam to its bug
+        vocab: the candidate tokens of the bugs still being decoded (G x K), None to use the whole dictionary
+        incremental_state: the decoder state of the N beams, updated in place, None to decode the whole prefix
+        return the logits of the last decoded position, N x V (N x K over the candidates with vocab)
+        """
+        self.split_size = self.get_split_size(prev_tokens_index, prev_tokens, encoder_out, incremental_state)
+        while True:
+            try:
+                return self.decode_splits(
+                    prev_tokens_index, encoder_out, prev_tokens, beam_bug_ids, incremental_state, vocab
+                )
+            except RuntimeError as e:
+                if 'out of memory' not in str(e) or self.split_size == 1:
+                    raise
+                # incremental_state is only updated after all the chunks succeed, retry with smaller chunks
+                self.split_size = self.split_size // 2
+                self.memory_scale /= 2
+                print('out of memory, retry with split_size', self.split_size)
+                if self.device.type == 'cuda':
+                    torch.cuda.empty_cache()
+
+    def decode_splits(self, prev_tokens_index, encoder_out, prev_tokens, beam_bug_ids, incremental_state, vocab):
+        beam_num = prev_tokens_index.size(0)
+        bug_beam_num = int(beam_bug_ids.eq(beam_bug_ids[0]).sum())
+        splits = self.get_splits(beam_num, bug_beam_num)
+        self.split_size_list = [end - start for start, end, _, _ in splits]
+
+        decoder_out = []
+        split_states = []
+        for start, end, bug_start, bug_end in splits:
+            # one encoder output for each bug of the chunk, broadcast over its beams by the decoder
+            split_encoder_out = self.encoder_out_to_device(
+                self.select_encoder_out(encoder_out, beam_bug_ids[start: end: bug_beam_num])
+            )
+            split_state = None
+            if incremental_state is not None:
+                split_state = {
+                    key: value[start: end] for key, value in incremental_state.items() if key != 'prefix'
+                }
+                if 'prefix' in incremental_state:
+                    # the cached prev_context of the bugs in this chunk, shared by their beams
+                    split_state['prefix'] = {
+                        key: value[bug_start: bug_end] for key, value in incremental_state['prefix'].items()
                     }
-                logits = self.model.decoder(
-                    prev_tokens_index[sum(self.split_size_list[: i]) : sum(self.split_size_list[: i + 1]), ...].cuda(),
-                    split_encoder_out,
-                    prev_tokens[sum(self.split_size_list[: i]) : sum(self.split_size_list[: i + 1]), ...].cuda(),
-                    self.model.embed_model,
-                )[0]
-                logits = logits[:, -1, :]  # beam, L, V -> beam, V
-                decoder_out.append(logits.to('cpu'))
+            split_vocab = None
+            if vocab is not None:
+                split_vocab = {key: value[bug_start: bug_end].to(self.device) for key, value in vocab.items()}
+            logits = self.decode_chunk(
+                prev_tokens_index[start: end, ...].to(self.device),
+                split_encoder_out,
+                prev_tokens[start: end, ...].to(self.device),
+                split_state,
+                split_vocab,
+            )
+            decoder_out.append(logits.to('cpu'))
+            split_states.append(split_state)
+        if incremental_state is not None:
+            for key in list(incremental_state):
+                if key != 'prefix' and key not in split_states[0]:
+                    # used up by the decoder, e.g. prefix_embed
+                    del incremental_state[key]
+            for key in split_states[0]:
+                if key != 'prefix':
+                    incremental_state[key] = torch.cat([state[key] for state in split_states], dim=0)
+            if 'prefix' not in incremental_state:
+                incremental_state['prefix'] = {
+                    key: torch.cat([state['prefix'][key] for state in split_states], dim=0)
+                    for key in split_states[0]['prefix']
+                }
         logits = torch.cat(decoder_out, dim=0)
-        # logits = logits.to('cpu')
         return logits
 
+    def decode_chunk(self, prev_tokens_index, encoder_out, prev_tokens, incremental_state, vocab):
+        # the logits of the last position of the beams in one chunk, beam x V,
+        # or of every fed position (beam x T x V) with a positional state, see get_positional_state
+        positional = incremental_state is not None and 'origin' in incremental_state
+        logits = self.model.decoder(
+            prev_tokens_index,
+            encoder_out,
+            prev_tokens,
+            self.model.embed_model,
+            incremental_state=incremental_state,
+            last_only=not positional,
+            vocab=vocab,
+            own_length=True,
+        )[0]
+        if positional:
+            return logits
+        return logits[:, -1, :]  # beam, 1, V -> beam, V
 
-class GPTFConvModelCuda(nn.Module):
-    def __init__(self, model, beam_size):
-        super(GPTFConvModelCuda, self).__init__()
-        self.model = model.cuda()
-        self.beam_size = beam_size
-        self.split_size = beam_size
-        self.split_size_list = [self.split_size]
-
-    def forward(self):
-        pass
 
-    def encoder_out_to_cuda(self, encoder_out):
-        return {
-            'src_tokens': encoder_out['src_tokens'].cuda(),
-            'encoder_out': (
-                encoder_out['encoder_out'][0].cuda(),
-                encoder_out['encoder_out'][1].cuda(),
-            ),
-            'encoder_padding_mask': encoder_out['encoder_padding_mask'].cuda(),
-        }
+class GPTCoNuTModelCuda(GPTModelCuda):
+    def encode(self, src_tokens, src_with_prev_context, ctx_tokens):
+        if self.encoder_cache is not None:
+            # the context lines are cached on their own, the mutants of one method share them
+            return GPTCoNuTEncoder.merge_outputs(
+                self.encode_cached('src', self.model.encoder.src_encoder, src_tokens, src_with_prev_context),
+                self.encode_cached('ctx', self.model.encoder.context_encoder, ctx_tokens),
+            )
+        src_tokens, src_with_prev_context = src_tokens.to(self.device), src_with_prev_context.to(self.device)
+        gpt_prefix = get_gpt_prefix(self.model.embed_model.transformer, src_tokens, src_with_prev_context)
+        encoder_out = self.model.encoder(
+            src_tokens,
+            src_with_prev_context,
+            ctx_tokens.to(self.device),
+            self.model.embed_model,
+            gpt_prefix=gpt_prefix,
+            own_length=True,
+        )
+        encoder_out = self.encoder_out_to_cpu(encoder_out)
+        # kept on the device, the decoder starts from it, see BeamSearch.generate
+        encoder_out['gpt_prefix'] = gpt_prefix
+        return encoder_out
 
-    def encoder_out_to_cpu(self, encoder_out):
-        return {
-            'src_tokens': encoder_out['src_tokens'].to('cpu'),
-            'encoder_out': (
-                encoder_out['encoder_out'][0].to('cpu'),
-                encoder_out['encoder_out'][1].to('cpu'),
-            ),
-            'encoder_padding_mask': encoder_out['encoder_padding_mask'].to('cpu'),
-        }
 
+class GPTFConvModelCuda(GPTModelCuda):
     def encode(self, src_tokens, src_with_prev_context):
+        if self.encoder_cache is not None:
+            return self.encode_cached('src', self.model.encoder, src_tokens, src_with_prev_context)
+        src_tokens, src_with_prev_context = src_tokens.to(self.device), src_with_prev_context.to(self.device)
+        gpt_prefix = get_gpt_prefix(self.model.embed_model.transformer, src_tokens, src_with_prev_context)
         encoder_out = self.model.encoder(
-            src_tokens.cuda(),
-            src_with_prev_context.cuda(),
+            src_tokens,
+            src_with_prev_context,
             self.model.embed_model,
+            gpt_prefix=gpt_prefix,
+            own_length=True,
         )
-        return self.encoder_out_to_cpu(encoder_out)
-
-    def decode(self, prev_tokens_index, encoder_out, prev_tokens):
-        step = int(torch.sum(prev_tokens_index[0]))
-        ctx_len = prev_tokens.size(1)
-        if step * ctx_len <= 3000:
-            self.split_size = min(self.beam_size, 200)
-        elif step * ctx_len <= 5000:
-            self.split_size = min(self.beam_size, 100)
-        elif step * ctx_len <= 10000:
-            self.split_size = min(self.beam_size, 50)
-        else:
-            self.split_size = min(self.beam_size, 20)
-        split_num = self.beam_size // self.split_size
-        self.split_size_list = [self.split_size] * split_num
-        if self.beam_size % self.split_size != 0:
-            self.split_size_list += [self.beam_size % self.split_size]
-        if prev_tokens_index.size(0) == 1:
-            return self.model.decoder(
-                prev_tokens_index.cuda(),
-                self.encoder_out_to_cuda(encoder_out),
-                prev_tokens.cuda(),
-                self.model.embed_model,
-            )[0].to('cpu')
-        else:
-            assert prev_tokens_index.size(0) == sum(self.split_size_list)
-            decoder_out = []
-            split_encoder_out = {
-                'src_tokens': encoder_out['src_tokens'][:self.split_size, ...].cuda(),
-                'encoder_out': (
-                    encoder_out['encoder_out'][0][:self.split_size, ...].cuda(),
-                    encoder_out['encoder_out'][1][:self.split_size, ...].cuda(),
-                ),
-                'encoder_padding_mask': encoder_out['encoder_padding_mask'][:self.split_size, ...].cuda(),
-            }
-            for i in range(len(self.split_size_list)):
-                if i == len(self.split_size_list) - 1:
-                    split_encoder_out = {
-                        'src_tokens': split_encoder_out['src_tokens'][:self.split_size_list[-1], ...],
-                        'encoder_out': (
-                            split_encoder_out['encoder_out'][0][:self.split_size_list[-1], ...],
-                            split_encoder_out['encoder_out'][1][:self.split_size_list[-1], ...],
-                        ),
-                        'encoder_padding_mask': split_encoder_out['encoder_padding_mask'][:self.split_size_list[-1], ...],
-                    }
-                logits = self.model.decoder(
-                    prev_tokens_index[sum(self.split_size_list[: i]) : sum(self.split_size_list[: i + 1]), ...].cuda(),
-                    split_encoder_out,
-                    prev_tokens[sum(self.split_size_list[: i]) : sum(self.split_size_list[: i + 1]), ...].cuda(),
-                    self.model.embed_model,
-                )[0]
-                logits = logits[:, -1, :]  # beam, L, V -> beam, V
-                decoder_out.append(logits.to('cpu'))
-        logits = torch.cat(decoder_out, dim=0)
-        # logits = logits.to('cpu')
+        encoder_out = self.encoder_out_to_cpu(encoder_out)
+        encoder_out['gpt_prefix'] = gpt_prefix
+        return encoder_out
+
+
+class ExportedModelCuda(GPTModelCuda):
+    """
+    runs the TorchScript graphs of an ExportedModel (see export.py) instead of the eager modules,
+    the incremental state is kept in the same dict as the eager decoder uses
+    """
+    def encode(self, src_tokens, src_with_prev_context, ctx_tokens=None):
+        inputs = (src_tokens.to(self.device), src_with_prev_context.to(self.device))
+        if self.model.conut:
+            inputs += (ctx_tokens.to(self.device),)
+        src_tokens, encoder_a, encoder_b, encoder_padding_mask = self.model.encoder(*inputs)
+        # encoder_a is already transposed for the decoder
+        return self.encoder_out_to_cpu({
+            'src_tokens': src_tokens,
+            'encoder_out': (encoder_a, encoder_b),
+            'encoder_padding_mask': encoder_padding_mask,
+        })
+
+    def reorder_incremental_state(self, incremental_state, new_order):
+        GPTFConvDecoder.reorder_incremental_state(incremental_state, new_order)
+
+    def reorder_incremental_prefix(self, incremental_state, new_order):
+        GPTFConvDecoder.reorder_incremental_prefix(incremental_state, new_order)
+
+    def get_model_sizes(self):
+        return self.model.config
+
+    def decode_chunk(self, prev_tokens_index, encoder_out, prev_tokens, incremental_state, vocab):
+        assert incremental_state is not None, 'the exported decoder only decodes incrementally'
+        assert vocab is None, 'the exported decoder projects onto the whole dictionary, sparse_vocab is not supported'
+        encoder_inputs = (encoder_out['src_tokens'],) + encoder_out['encoder_out'] + \
+            (encoder_out['encoder_padding_mask'],)
+        layer_num = self.model.config['n_layer']
+        conv_num = self.model.config['conv_num']
+        if 'prefix' not in incremental_state:
+            logits, position, prefix_mask, keys, values, buffers = self.model.prefix_decoder(
+                prev_tokens_index, prev_tokens, *encoder_inputs
+            )
+            incremental_state['position'] = position
+            incremental_state['prefix'] = {'mask': prefix_mask}
+            for i in range(layer_num):
+                incremental_state['prefix']['key_{}'.format(i)] = keys[i]
+                incremental_state['prefix']['value_{}'.format(i)] = values[i]
+            for i in range(conv_num):
+                incremental_state['conv_buffer_{}'.format(i)] = buffers[i]
+            return logits
+
+        prefix = incremental_state['prefix']
+        if 'gpt_key_0' not in incremental_state:
+            # no generated token is cached yet
+            key = prefix['key_0']
+            empty = key.new_zeros(prev_tokens.size(0), key.size(1), 0, key.size(3))
+            for i in range(layer_num):
+                incremental_state['gpt_key_{}'.format(i)] = empty
+                incremental_state['gpt_value_{}'.format(i)] = empty
+        logits, position, keys, values, buffers = self.model.step_decoder(
+            prev_tokens[:, -1:], incremental_state['position'], *encoder_inputs,
+            prefix['mask'],
+            tuple(prefix['key_{}'.format(i)] for i in range(layer_num)),
+            tuple(prefix['value_{}'.format(i)] for i in range(layer_num)),
+            tuple(incremental_state['gpt_key_{}'.format(i)] for i in range(layer_num)),
+            tuple(incremental_state['gpt_value_{}'.format(i)] for i in range(layer_num)),
+            tuple(incremental_state['conv_buffer_{}'.format(i)] for i in range(conv_num)),
+        )
+        incremental_state['position'] = position
+        for i in range(layer_num):
+            incremental_state['gpt_key_{}'.format(i)] = keys[i]
+            incremental_state['gpt_value_{}'.format(i)] = values[i]
+        for i in range(conv_num):
+            incremental_state['conv_buffer_{}'.format(i)] = buffers[i]
         return logits
 
 
 class BeamSearch():
-    def __init__(self, model, dictionary, beam_size=10):
+    def __init__(self, model, dictionary, beam_size=10, incremental=True, device='cuda', num_threads=None,
+                 sparse_vocab=False, memory_budget=None, dedup=False, early_stop=False, max_hypothesis=None,
+                 encoder_cache=None):
         self.dictionary = dictionary
-        if isinstance(model, GPTCoNuTModel):
-            self.model = GPTCoNuTModelCuda(model, beam_size)
-        elif isinstance(model, GPTFConvModel):
-            self.model = GPTFConvModelCuda(model, beam_size)
+        # an EncoderCache for the encoder outputs of the eager models, None to always encode
+        self.encoder_cache = encoder_cache
+        # stop a bug once none of its beams can beat the worst hypothesis it has (see get_early_stopped),
+        # and the number of hypothesis a bug is finished with, None for beam_size
+        self.early_stop = early_stop
+        self.max_hypothesis = max_hypothesis
+        # the steps saved by early_stop for each bug of the last sample
+        self.saved_steps = []
+        # a StepProfiler timing the phases of the search (see phase), None to not profile
+        self.profiler = None
+        # merge the beams and hypotheses rendering the same statement, only the best one is kept
+        self.dedup = dedup
+        # with identifiers, only project onto the tokens each bug may generate (see get_candidate_vocab)
+        self.sparse_vocab = sparse_vocab
+        # decode only the newest position at each step, with the decoder state kept for every beam
+        self.incremental = incremental
+        # the number of threads used by torch on cpu, None to keep the default of torch
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        # a list of models is decoded in lockstep as an ensemble, each model keeps its own encoder output
+        self.models = []
+        for m in (model if isinstance(model, (list, tuple)) else [model]):
+            if isinstance(m, GPTCoNuTModel):
+                self.models.append(GPTCoNuTModelCuda(m, beam_size, device, memory_budget, encoder_cache))
+            elif isinstance(m, GPTFConvModel):
+                self.models.append(GPTFConvModelCuda(m, beam_size, device, memory_budget, encoder_cache))
+            elif isinstance(m, ExportedModel):
+                # the graphs run on the device they are exported for
+                self.models.append(ExportedModelCuda(m, beam_size, m.device, memory_budget))
+        self.model = self.models[0]
         self.beam_size = beam_size
         self.max_step = 128
+        self.length_penalty = {
+            -50: -6.5446, -49: -6.7353, -48: -6.5446, -47: -6.4651, -46: -6.5255,
+            -45: -6.5624, -44: -6.2495, -43: -6.4651, -42: -6.1886, -41: -6.4025,
+            -40: -6.2033, -39: -6.2622, -38: -6.1274, -37: -6.2537, -36: -6.0743,
+            -35: -6.0758, -34: -6.031, -33: -5.927, -32: -5.866, -31: -5.9582,
+            -30: -5.64, -29: -5.7394, -28: -5.6764, -27: -5.5039, -26: -5.3938,
+            -25: -5.4417, -24: -5.3806, -23: -5.299, -22: -5.1481, -21: -5.1686,
+            -20: -5.0302, -19: -4.9543, -18: -4.8488, -17: -4.6396, -16: -4.6334,
+            -15: -4.5676, -14: -4.4454, -13: -4.2981, -12: -4.1142, -11: -4.048,
+            -10: -3.7681, -9: -3.5306, -8: -3.834, -7: -3.1647, -6: -3.011,
+            -5: -2.9796, -4: 0.0, -3: 0.0, -2: 0.0, -1: 0.0, 0: 0.0
+        }
+        # the penalty indexed by the distance to the length of the source statement
+        self.length_penalty_table = torch.FloatTensor([self.length_penalty[-d] for d in range(51)])
+
+        # the statement length counts the words of the generated tokens, CaMeL, _ and . join the tokens
+        # around them, a token ending with @@ joins the next one, eos and pad are not words
+        self.joiner = torch.BoolTensor([s in ['CaMeL', '_', '.'] for s in dictionary.symbols])
+        self.bpe = torch.BoolTensor([s[-2:] == '@@' for s in dictionary.symbols])
+        self.word = torch.ones(len(dictionary), dtype=torch.bool)
+        self.word[[dictionary.eos(), dictionary.pad()]] = False
+
+        # the tokens any bug may generate besides its identifiers
+        self.common_tokens = [dictionary.eos(), dictionary.unk()] + [
+            i for i, symbol in enumerate(dictionary.symbols)
+            if symbol in JAVA_KEYWORDS or (symbol and all(c in string.punctuation for c in symbol))
+        ]
+
+        # the hash of the text each token adds to the statement (without @@), and HASH_BASE ** its length
+        piece_hash, piece_power = [], []
+        for i, symbol in enumerate(dictionary.symbols):
+            piece = '' if i in [dictionary.eos(), dictionary.pad()] else symbol.replace('@@', '')
+            h = 0
+            for c in piece:
+                h = (h * HASH_BASE + ord(c)) % HASH_MOD
+            piece_hash.append(h)
+            piece_power.append(pow(HASH_BASE, len(piece), HASH_MOD))
+        self.piece_hash = torch.LongTensor(piece_hash)
+        self.piece_power = torch.LongTensor(piece_power)
 
     @staticmethod
-    def get_prefix(token, dictionary):
-        prefixs, texts = [], []
-        prefix, text = '', ''
-        stop = False
-        for i in range(len(token) - 1, -1, -1):
-            cur = dictionary[token[i]]
-            if cur not in ['CaMeL', '_', '0', '1', '$NUMBER$']:
-                if not stop:
-                    stop = True
-                    prefix = cur + prefix
-                    text = cur + text
-                    prefixs.append(prefix)
-                    if text[-2:] != '@@':
-                        texts.append(text.replace('@@', ''))
-                    else:
-                        texts.append(text)
-                else:
-                    if cur[-2:] == '@@':
-                        prefix = cur + prefix
-                        text = cur + text
-                        prefixs.append(prefix)
-                        if text[-2:] != '@@':
-                            texts.append(text.replace('@@', ''))
-                        else:
-                            texts.append(text)
-                    else:
-                        return prefixs, texts
-            else:
-                stop = False
-                prefix = cur + prefix
-                if cur != 'CaMeL':
-                    text = cur + text
-                prefixs.append(prefix)
-                if text[-2:] != '@@':
-                    texts.append(text.replace('@@', ''))
-                else:
-                    texts.append(text)
-        prefixs.append(prefix)
-        if text[-2:] != '@@':
-            texts.append(text.replace('@@', ''))
-        else:
-            texts.append(text)
-        return prefixs, texts
-
-    def generate_gpt_fconv(self, sample):
-        self.model.eval()
-        hypothesis = []
+    def get_prev_tokens_index(prev_lens, step, width):
+        # the decoder reads the last token of prev_context and the step tokens generated so far
+        positions = torch.arange(width).unsqueeze(0)
+        start = (prev_lens - 1).unsqueeze(1)
+        return ((positions >= start) & (positions <= start + step)).long()
+
+    def get_candidate_vocab(self, sample, identifiers):
+        """
+        the tokens each bug may generate under the identifier constraint: its identifier tokens, java keywords,
+        operators and the tokens of the buggy line which can be copied
+        return {'tokens': bsz x K, padded with pad, 'mask': bsz x K, False on padding}
+        """
         src_tokens = sample['net_input']['src_tokens']
         src_with_prev_context = sample['net_input']['src_with_prev_context']
-        identifiers = sample['identifier']
-
-        self.max_step = max(100, int(torch.sum(src_tokens[0])))
-        encoder_out = self.model.encode(
-            src_tokens,
-            src_with_prev_context,
-        )
-
-        prev_tokens_index = sample['target_index']
-        prev_tokens_with_context = sample['target_with_prev_context']
-
-        mask = prev_tokens_index.eq(0)
-        prev_tokens_index = prev_tokens_index[mask].unsqueeze(0)
-        prev_tokens_index = torch.cat([prev_tokens_index, torch.ones(1, 1).long()], dim=-1)
-        prev_tokens_with_context = prev_tokens_with_context[:, : prev_tokens_index.size(1)]
-        prev_len = prev_tokens_index.size(1)
-
-        self.max_step += prev_tokens_index.size(1)
-        bsz = src_tokens.size(0)  # bsz = 1
-        tokens = torch.zeros(bsz * self.beam_size, self.max_step - prev_len).long()
-        scores = torch.zeros(bsz * self.beam_size, self.max_step - prev_len)
-        final_scores = torch.zeros(bsz * self.beam_size)
-        tokens_string = ['' for _ in range(tokens.size(0))]
-
-        prev_tokens_index = prev_tokens_index.repeat(bsz * self.beam_size, 1)
-        prev_tokens_with_context = prev_tokens_with_context.repeat(bsz * self.beam_size, 1)
-        tokens = torch.cat([prev_tokens_with_context, tokens], dim=1)
-
-        if identifiers is not None:
-            for k in identifiers[0]['tokens']:
-                identifiers[0]['tokens'][k] += [self.dictionary.pad(),
-                                                self.dictionary.unk(),
-                                                self.dictionary.eos()]
-                identifiers[0]['tokens'][k] = torch.LongTensor(identifiers[0]['tokens'][k])
-
-        length_penalty = {-50: -6.5446, -49: -6.7353, -48: -6.5446, -47: -6.4651, -46: -6.5255,
-                          -45: -6.5624, -44: -6.2495, -43: -6.4651, -42: -6.1886, -41: -6.4025,
-                          -40: -6.2033, -39: -6.2622, -38: -6.1274, -37: -6.2537, -36: -6.0743,
-                          -35: -6.0758, -34: -6.031, -33: -5.927, -32: -5.866, -31: -5.9582,
-                          -30: -5.64, -29: -5.7394, -28: -5.6764, -27: -5.5039, -26: -5.3938,
-                          -25: -5.4417, -24: -5.3806, -23: -5.299, -22: -5.1481, -21: -5.1686,
-                          -20: -5.0302, -19: -4.9543, -18: -4.8488, -17: -4.6396, -16: -4.6334,
-                          -15: -4.5676, -14: -4.4454, -13: -4.2981, -12: -4.1142, -11: -4.048,
-                          -10: -3.7681, -9: -3.5306, -8: -3.834, -7: -3.1647, -6: -3.011,
-                          -5: -2.9796, -4: 0.0, -3: 0.0, -2: 0.0, -1: 0.0, 0: 0.0}
-
-        for step in range(0, self.max_step - prev_len):
-            if step == 0:
-                logits = self.model.decode(
-                    prev_tokens_index[:bsz, :],
-                    encoder_out,
-                    tokens[:bsz, :step + prev_len],
-                )
-                logits = logits[:, -1, :]  # 1, V
-                logits[:, self.dictionary.pad()] = -math.inf
-                if identifiers is not None:
-                    logits += 100
-                lprobs, indices = logits.topk(k=self.beam_size, dim=1)
-                tokens[:, prev_len + step: prev_len + step + 1] = indices.transpose(0, 1)
-                prev_tokens_index = torch.cat([prev_tokens_index, torch.ones(self.beam_size, 1).long()], dim=-1)
-                scores[:, step: step + 1] = lprobs.transpose(0, 1)
-                final_scores = scores[:, step]
-                for i, string in enumerate(tokens_string):
-                    symbol = ''
-                    if int(tokens[i, prev_len + step]) != self.dictionary.eos() and \
-                            int(tokens[i, prev_len + step]) != self.dictionary.pad():
-                        symbol = self.dictionary[int(tokens[i, prev_len + step])]
-                    tokens_string[i] = add_token_to_string(string, symbol)
-                continue
-            if step == 1:
-                # bsz * beam, L
-                split_size = int(self.model.split_size)
-                encoder_out['src_tokens'] = encoder_out['src_tokens']. \
-                    repeat(split_size, 1)
-                encoder_out['encoder_out'] = (
-                    encoder_out['encoder_out'][0].repeat(split_size, 1, 1),
-                    encoder_out['encoder_out'][1].repeat(split_size, 1, 1),
-                )
-                encoder_out['encoder_padding_mask'] = encoder_out['encoder_padding_mask']. \
-                    repeat(split_size, 1)
-
-            logits = self.model.decode(
-                prev_tokens_index,
-                encoder_out,
-                tokens[:, :prev_len + step],
+        vocab = []
+        for b, identifier in enumerate(identifiers):
+            tokens = set(self.common_tokens)
+            for candidates in identifier['tokens'].values():
+                tokens.update(candidates)
+            tokens.update(src_with_prev_context[b][src_tokens[b].eq(1)].tolist())
+            tokens.discard(self.dictionary.pad())
+            vocab.append(sorted(tokens))
+
+        size = max(len(tokens) for tokens in vocab)
+        candidate_vocab = {
+            'tokens': torch.zeros(len(vocab), size).long().fill_(self.dictionary.pad()),
+            'mask': torch.zeros(len(vocab), size, dtype=torch.bool),
+        }
+        for b, tokens in enumerate(vocab):
+            candidate_vocab['tokens'][b, : len(tokens)] = torch.LongTensor(tokens)
+            candidate_vocab['mask'][b, : len(tokens)] = True
+        return candidate_vocab
+
+    def encode(self, model, sample):
+        model.eval()
+        if isinstance(model, GPTCoNuTModelCuda) or (isinstance(model, ExportedModelCuda) and model.model.conut):
+            return model.encode(
+                sample['net_input']['src_tokens'],
+                sample['net_input']['src_with_prev_context'],
+                sample['net_input']['ctx_tokens'],
             )
-            logits[:, self.dictionary.pad()] = -math.inf
-
-            if identifiers is not None:
-                for i in range(tokens.size(0)):
-                    src_length = int(sample['src_statement_length'][0])
-                    cur_length = len(tokens_string[i].strip().split())
-                    if cur_length > src_length:
-                        gap = max(-50, src_length - cur_length)
-                    else:
-                        gap = max(-50, cur_length - src_length)
-                    if cur_length < src_length:
-                        logits[i, self.dictionary.eos()] += length_penalty[gap]
-                    else:
-                        logits[i, self.dictionary.eos()] -= length_penalty[gap]
-
-                    if identifiers[0]['text'] == []:
-                        continue
+        return model.encode(
+            sample['net_input']['src_tokens'],
+            sample['net_input']['src_with_prev_context'],
+        )
 
-                    prefixs, texts = BeamSearch.get_prefix(
-                        tokens[i][prev_len: prev_len + step],
-                        self.dictionary
-                    )
-                    prefixs.reverse()
-                    texts.reverse()
-                    tmp = None
-                    for prefix, text in zip(prefixs, texts):
-                        if prefix in identifiers[0]['tokens']:
-                            if prefix != '' and prefix[-5:] != 'CaMeL' and prefix[-1] != '_' and \
-                                    text in identifiers[0]['text']:
-                                tmp = set(identifiers[0]['tokens'][prefix].tolist()) | \
-                                      set(identifiers[0]['tokens'][''].tolist())
-                                tmp = torch.LongTensor(list(tmp))
-                            else:
-                                tmp = identifiers[0]['tokens'][prefix]
-                            break
-                        if text in identifiers[0]['text']:
-                            break
-                    if tmp is None:
-                        prefix = ''
-                        tmp = identifiers[0]['tokens'][prefix]
-                    logits[i, tmp] += 100
-            lprobs, indices = logits.topk(k=self.beam_size, dim=1)  # beam, beam
-            lprobs = lprobs.t().contiguous().view(-1)  # beam x beam
-            indices = indices.t().contiguous().view(-1)
-            cand_final_scores = lprobs + final_scores.repeat(self.beam_size)
-            cand_final_scores, sort_order = cand_final_scores.sort(descending=True)
-            lprobs = lprobs.index_select(0, sort_order)
-            indices = indices.index_select(0, sort_order)
-
-            # choose finished beam
-            eos_mask = indices[: self.beam_size].eq(self.dictionary.eos())
-            eos_lprobs = lprobs[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            eos_cand_final_scores = cand_final_scores[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            eos_sort_order = sort_order[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            if eos_cand_final_scores.size(0) > 0:
-                eos_beam_ids = eos_sort_order % self.beam_size  # N_eos
-                eos_beam_ids = eos_beam_ids.long()
-                eos_beam = tokens[eos_beam_ids, prev_len:]  # N_eos, L
-                eos_beam[:, step] = self.dictionary.eos()
-                eos_beam_scores = scores[eos_beam_ids, :]
-                eos_beam_scores[:, step] = eos_lprobs
-                for i in range(eos_beam.size(0)):
-                    hypothesis.append(
-                        {
-                            'hypo': eos_beam[i, : step + 1],
-                            'score': eos_beam_scores[i, 1: step + 1],
-                            'final_score': float(eos_cand_final_scores[i]) / (1 + step),
-                        })
-                if len(hypothesis) >= self.beam_size:
-                    hypothesis = hypothesis[: self.beam_size]
-                    break
+    def generate_gpt_fconv(self, sample):
+        return self.generate_ensemble(sample)
 
-            # choose next beam
-            cand_mask = ~indices.eq(self.dictionary.eos())
-            cand_final_scores = cand_final_scores.masked_select(mask=cand_mask)[: self.beam_size]
-            sort_order = sort_order.masked_select(mask=cand_mask)[: self.beam_size]
-            lprobs = lprobs.masked_select(mask=cand_mask)[: self.beam_size]
-            indices = indices.masked_select(mask=cand_mask)[: self.beam_size]
-            cand_beam_ids = sort_order % self.beam_size
-            cand_beam_ids = cand_beam_ids.long()
-
-            new_tokens_string = []
-            for i in range(cand_beam_ids.size(0)):
-                symbol = ''
-                if int(indices[i]) not in [self.dictionary.eos(), self.dictionary.pad()]:
-                    symbol = self.dictionary[int(indices[i])]
-                new_tokens_string.append(
-                    add_token_to_string(tokens_string[int(cand_beam_ids[i])], symbol)
-                )
-            tokens_string = new_tokens_string
+    def generate_gpt_conut(self, sample):
+        return self.generate_ensemble(sample)
+
+    def generate_ensemble(self, sample):
+        # the sample needs ctx_tokens if any of the models is GPT-CoNuT
+        with self.phase('encode'):
+            encoder_outs = [self.encode(model, sample) for model in self.models]
+        return self.generate(sample, encoder_outs)
+
+    def phase(self, name):
+        # the context timing the phase name of the search with the profiler, which does nothing without it
+        return self.profiler.phase(name) if self.profiler is not None else NULL_PHASE
+
+    def decode(self, prev_tokens_index, encoder_outs, prev_tokens, beam_bug_ids, incremental_states, vocab):
+        """the log probabilities of the ensemble, the probabilities of the models are averaged"""
+        lprobs = [
+            model.decode(prev_tokens_index, encoder_out, prev_tokens, beam_bug_ids, incremental_state, vocab)
+            for model, encoder_out, incremental_state in zip(self.models, encoder_outs, incremental_states)
+        ]
+        if len(lprobs) == 1:
+            return lprobs[0]
+        return torch.logsumexp(torch.stack(lprobs, dim=0), dim=0) - math.log(len(lprobs))
+
+    def reorder_incremental_state(self, incremental_states, new_order):
+        if self.incremental:
+            for model, incremental_state in zip(self.models, incremental_states):
+                model.reorder_incremental_state(incremental_state, new_order)
+
+    def reorder_incremental_prefix(self, incremental_states, new_order):
+        if self.incremental:
+            for model, incremental_state in zip(self.models, incremental_states):
+                model.reorder_incremental_prefix(incremental_state, new_order)
+
+    def extend_hash(self, beam_hash, beam_glue, beam_lengths, tokens):
+        """
+        the hash of the statements (rendered like the statement length counts them, with @@ removed) after
+        adding the tokens, beam_glue and beam_lengths are the state before the tokens, all of the same shape
+        """
+        space = self.word[tokens] & ~self.joiner[tokens] & ~beam_glue & beam_lengths.gt(0)
+        beam_hash = torch.where(space, (beam_hash * HASH_BASE + ord(' ')) % HASH_MOD, beam_hash)
+        return (beam_hash * self.piece_power[tokens] + self.piece_hash[tokens]) % HASH_MOD
 
-            tokens = tokens[cand_beam_ids, :]
-            tokens[:, prev_len + step] = indices
+    @staticmethod
+    def add_hypothesis(hypothesis, hypothesis_hash, key, hypo):
+        """
+        append hypo to the hypothesis of its bug, with dedup (key is its rendered hash) a hypothesis rendering
+        the same statement as an earlier one is not added, the better final_score of the two is kept
+        """
+        if key is not None:
+            if key in hypothesis_hash:
+                if hypo['final_score'] > hypothesis_hash[key]['final_score']:
+                    hypothesis_hash[key].update(hypo)
+                return
+            hypothesis_hash[key] = hypo
+        hypothesis.append(hypo)
 
-            scores = scores[cand_beam_ids, :]
-            scores[:, step] = lprobs
-            final_scores = cand_final_scores
-            prev_tokens_index = torch.cat([prev_tokens_index,
-                                           torch.ones(self.beam_size, 1).long()], dim=-1)
-
-        if len(hypothesis) < self.beam_size:
-            current_num = len(hypothesis)
-            for i in range(self.beam_size - current_num):
-                tokens[i, -1] = self.dictionary.eos()
-                hypothesis.append({
-                    'hypo': tokens[i],
-                    'score': scores[i, 1:],
-                    'final_score': float(final_scores[i]) / (self.max_step - prev_len),
-                })
-
-        hypothesis.sort(key=lambda e: e['final_score'], reverse=True)
-        return hypothesis
+    @staticmethod
+    def get_duplicates(keys):
+        """keys: n x C, True at the candidates whose key is already taken by an earlier candidate of the row"""
+        width = keys.size(1)
+        sorted_keys, sort_index = (keys * width + torch.arange(width).unsqueeze(0)).sort(dim=1)
+        sorted_keys = sorted_keys - sort_index
+        duplicate = torch.zeros_like(keys, dtype=torch.bool)
+        duplicate[:, 1:] = sorted_keys[:, 1:].eq(sorted_keys[:, :-1])
+        return torch.zeros_like(duplicate).scatter_(1, sort_index, duplicate)
+
+    def get_early_stopped(self, hypothesis, active, final_scores, step, max_steps, bonus, beam_lengths, src_lengths):
+        """
+        the bugs (index in active) none of whose beams can beat the worst hypothesis it already has.
+        a beam with score c at step s ending with eos at step t gets at most (c + bonus * (t - s) + e) / (1 + t),
+        each later step adds a log probability (<= 0) and the identifier bonus (bonus of each bug, 100 or 0),
+        and e is the largest length penalty of the eos over the statement lengths the beam can reach by then
+        (at most one more word a step, src_lengths is None without the length penalty), or it is filled at the
+        maximum steps with (c + bonus * (last - s)) / (1 + last). the bound is the largest one over every t
+        """
+        n = len(active)
+        last = torch.LongTensor([max_steps[b] - 1 for b in active])
+        if int(last.max()) <= step:
+            return []
+        scores = final_scores.view(n, -1, 1)
+        steps = torch.arange(step + 1, int(last.max()) + 1)    # T, the steps the eos may come at
+        gain = bonus.view(n, 1, 1) * (steps - step).view(1, 1, -1)
+        if src_lengths is not None:
+            # the statement length when the eos comes at t is at most beam_lengths + t - s - 1
+            lengths = beam_lengths.view(n, -1, 1) + torch.arange(steps.size(0)).view(1, 1, -1)
+            src_lengths = src_lengths.view(n, -1, 1)
+            penalty = self.length_penalty_table[(lengths - src_lengths).abs().clamp(max=50)]
+            gain = gain + torch.where(lengths < src_lengths, penalty, -penalty).cummax(dim=2)[0]
+        bound = (scores + gain) / (1 + steps).float()
+        bound = bound.masked_fill((steps.view(1, -1) > last.view(-1, 1)).unsqueeze(1), -math.inf)
+        bound = bound.view(n, -1).max(dim=1)[0]
+        fill = (scores.view(n, -1).max(dim=1)[0] + bonus * (last - step)) / (1 + last).float()
+        bound = torch.max(bound, fill)
+
+        stopped = []
+        for j, b in enumerate(active):
+            if hypothesis[b] and float(bound[j]) < min(h['final_score'] for h in hypothesis[b]):
+                stopped.append(j)
+        return stopped
 
-    def generate_gpt_conut(self, sample):
-        self.model.eval()
-        hypothesis = []
+    @staticmethod
+    def backtrack(history, rows):
+        """
+        history: the (tokens, parents, scores) of the beams at each step, parents index the beams of the step before
+        return the tokens and scores of the paths ending at the beams rows of the last step, len(rows) x len(history)
+        """
+        tokens, scores = [], []
+        for step_tokens, step_parents, step_scores in reversed(history):
+            tokens.append(step_tokens.index_select(0, rows))
+            scores.append(step_scores.index_select(0, rows))
+            rows = step_parents.index_select(0, rows)
+        return torch.stack(tokens[::-1], dim=1), torch.stack(scores[::-1], dim=1)
+
+    def get_decoder_tokens(self, prev_tokens, history, beam_bug_ids, beam_prev_lens, width):
+        # prev_context of each beam followed by the tokens it has generated, N x width
+        tokens = prev_tokens.index_select(0, beam_bug_ids)[:, : width]
+        if history:
+            generated, _ = self.backtrack(history, torch.arange(beam_bug_ids.size(0)))
+            positions = beam_prev_lens.unsqueeze(1) + torch.arange(len(history)).unsqueeze(0)
+            tokens.scatter_(1, positions, generated)
+        return tokens
+
+    def get_prev_tokens(self, sample):
+        """
+        length of prev_context and maximum decoding steps of each bug,
+        and prev_context of each bug followed by room for the tokens to generate (bsz x (prev_len + max_step))
+        """
         src_tokens = sample['net_input']['src_tokens']
-        ctx_tokens = sample['net_input']['ctx_tokens']
         src_with_prev_context = sample['net_input']['src_with_prev_context']
-        identifiers = sample['identifier']
-
-        self.max_step = max(100, int(torch.sum(src_tokens[0])))
-        encoder_out = self.model.encode(
-            src_tokens,
-            src_with_prev_context,
-            ctx_tokens,
-        )
-
-        prev_tokens_index = sample['target_index']
-        prev_tokens_with_context = sample['target_with_prev_context']
-
-        mask = prev_tokens_index.eq(0)
-        prev_tokens_index = prev_tokens_index[mask].unsqueeze(0)
-        prev_tokens_index = torch.cat([prev_tokens_index, torch.ones(1, 1).long()], dim=-1)
-        prev_tokens_with_context = prev_tokens_with_context[:, : prev_tokens_index.size(1)]
-        prev_len = prev_tokens_index.size(1)
-
-        self.max_step += prev_tokens_index.size(1)
-        bsz = src_tokens.size(0)  # bsz = 1
-        tokens = torch.zeros(bsz * self.beam_size, self.max_step - prev_len).long()
-        scores = torch.zeros(bsz * self.beam_size, self.max_step - prev_len)
-        final_scores = torch.zeros(bsz * self.beam_size)
-        tokens_string = ['' for _ in range(tokens.size(0))]
+        prev_lens, max_steps = [], []
+        for b in range(src_tokens.size(0)):
+            prev_lens.append(sample['target_index'][b].tolist().index(1) + 1)
+            src_len = int(src_with_prev_context[b][src_tokens[b].eq(1)].ne(self.dictionary.pad()).sum())
+            max_steps.append(max(100, src_len))
+        self.max_step = max(max_steps)
+
+        prev_tokens = torch.zeros(src_tokens.size(0), max(prev_lens) + self.max_step).long()
+        for b in range(src_tokens.size(0)):
+            prev_tokens[b, : prev_lens[b]] = sample['target_with_prev_context'][b, : prev_lens[b]]
+        return prev_lens, max_steps, prev_tokens
+
+    def get_incremental_states(self, encoder_outs, prev_lens):
+        # the decoder state of each model at step 0, one row for each bug
+        incremental_states = []
+        for encoder_out in encoder_outs:
+            gpt_prefix = encoder_out.pop('gpt_prefix', None)
+            if not self.incremental:
+                incremental_states.append(None)
+            elif gpt_prefix is not None and gpt_prefix['length'].tolist() == prev_lens:
+                # prev_context was already run by gpt in the encoder, the decoder starts from it
+                incremental_states.append(GPTFConvDecoder.get_prefix_state(gpt_prefix))
+            else:
+                incremental_states.append({})
+        return incremental_states
 
-        prev_tokens_index = prev_tokens_index.repeat(bsz * self.beam_size, 1)
-        prev_tokens_with_context = prev_tokens_with_context.repeat(bsz * self.beam_size, 1)
-        tokens = torch.cat([prev_tokens_with_context, tokens], dim=1)
+    @staticmethod
+    def get_beam_tokens(vocab, beam_num):
+        """the token of each column of the logits of beam_num beams with the candidate vocab, beam_num x K"""
+        if vocab is None:
+            return None
+        return vocab['tokens'].repeat_interleave(beam_num // vocab['tokens'].size(0), dim=0)
 
+    @staticmethod
+    def column_tokens(columns, beam_tokens):
+        """the tokens of the columns (N x C) of the logits of the beams, see get_beam_tokens"""
+        return columns if beam_tokens is None else beam_tokens.gather(1, columns)
+
+    def constrain(self, logits, sample, step, beam_bug_ids, beam_lengths, trie, trie_state, beam_tokens=None):
+        """
+        the identifier constraint and the length penalty, added to logits in place: the tokens a beam may
+        generate get a bonus of 100, the eos is penalized by the distance to the length of the source statement
+        beam_tokens: the token of each column of logits (see get_beam_tokens), None if they are the whole dictionary
+        """
+        eos = self.dictionary.eos()
+        if beam_tokens is None:
+            logits[:, self.dictionary.pad()] = -math.inf
+        else:
+            logits.masked_fill_(beam_tokens.eq(self.dictionary.pad()), -math.inf)
+        if step == 0:
+            logits += 100
+        else:
+            src_lengths = sample['src_statement_length'][:, 0].index_select(0, beam_bug_ids)
+            penalty = self.length_penalty_table[(beam_lengths - src_lengths).abs().clamp(max=50)]
+            penalty = torch.where(beam_lengths < src_lengths, penalty, -penalty)
+            mask = trie.get_mask(trie_state, beam_bug_ids)
+            if beam_tokens is None:
+                logits[:, eos] += penalty
+            else:
+                logits += beam_tokens.eq(eos).type_as(logits) * penalty.unsqueeze(1)
+                mask = mask.gather(1, beam_tokens)
+            logits += mask.type_as(logits) * 100
+
+    def generate(self, sample, encoder_outs):
+        """
+        beam search for all the bugs in the sample at once, each bug keeps beam_size beams
+        encoder_outs: the encoder output of each model
+        return a list of hypothesis (sorted by final_score) for each bug
+        """
+        src_tokens = sample['net_input']['src_tokens']
+        identifiers = sample['identifier']
+        bsz = src_tokens.size(0)
+        for model in self.models:
+            model.memory_scale = 1.0
+        beam_size = self.beam_size
+        max_hypothesis = self.max_hypothesis or beam_size
+        self.saved_steps = [0 for _ in range(bsz)]
+        eos = self.dictionary.eos()
+        pad = self.dictionary.pad()
+        prev_lens, max_steps, prev_tokens = self.get_prev_tokens(sample)
+
+        trie, vocab = None, None
         if identifiers is not None:
-            for k in identifiers[0]['tokens']:
-                identifiers[0]['tokens'][k] += [self.dictionary.pad(),
-                                                self.dictionary.unk(),
-                                                self.dictionary.eos()]
-                identifiers[0]['tokens'][k] = torch.LongTensor(identifiers[0]['tokens'][k])
-
-        length_penalty = {-50: -6.5446, -49: -6.7353, -48: -6.5446, -47: -6.4651, -46: -6.5255,
-                          -45: -6.5624, -44: -6.2495, -43: -6.4651, -42: -6.1886, -41: -6.4025,
-                          -40: -6.2033, -39: -6.2622, -38: -6.1274, -37: -6.2537, -36: -6.0743,
-                          -35: -6.0758, -34: -6.031, -33: -5.927, -32: -5.866, -31: -5.9582,
-                          -30: -5.64, -29: -5.7394, -28: -5.6764, -27: -5.5039, -26: -5.3938,
-                          -25: -5.4417, -24: -5.3806, -23: -5.299, -22: -5.1481, -21: -5.1686,
-                          -20: -5.0302, -19: -4.9543, -18: -4.8488, -17: -4.6396, -16: -4.6334,
-                          -15: -4.5676, -14: -4.4454, -13: -4.2981, -12: -4.1142, -11: -4.048,
-                          -10: -3.7681, -9: -3.5306, -8: -3.834, -7: -3.1647, -6: -3.011,
-                          -5: -2.9796, -4: 0.0, -3: 0.0, -2: 0.0, -1: 0.0, 0: 0.0}
-
-        for step in range(0, self.max_step - prev_len):
-            if step == 0:
-                logits = self.model.decode(
-                    prev_tokens_index[:bsz, :],
-                    encoder_out,
-                    tokens[:bsz, :step + prev_len],
-                )
-                logits = logits[:, -1, :]  # 1, V
-                logits[:, self.dictionary.pad()] = -math.inf
-                if identifiers is not None:
-                    logits += 100
-                lprobs, indices = logits.topk(k=self.beam_size, dim=1)
-                tokens[:, prev_len + step: prev_len + step + 1] = indices.transpose(0, 1)
-                prev_tokens_index = torch.cat([prev_tokens_index, torch.ones(self.beam_size, 1).long()], dim=-1)
-                scores[:, step: step + 1] = lprobs.transpose(0, 1)
-                final_scores = scores[:, step]
-                for i, string in enumerate(tokens_string):
-                    symbol = ''
-                    if int(tokens[i, prev_len + step]) != self.dictionary.eos() and \
-                            int(tokens[i, prev_len + step]) != self.dictionary.pad():
-                        symbol = self.dictionary[int(tokens[i, prev_len + step])]
-                    tokens_string[i] = add_token_to_string(string, symbol)
-                continue
-            if step == 1:
-                # bsz * beam, L
-                split_size = int(self.model.split_size)
-                encoder_out['src_tokens'] = encoder_out['src_tokens']. \
-                    repeat(split_size, 1)
-                encoder_out['encoder_out'] = (
-                    encoder_out['encoder_out'][0].repeat(split_size, 1, 1),
-                    encoder_out['encoder_out'][1].repeat(split_size, 1, 1),
+            trie = IdentifierTrie(identifiers, self.dictionary)
+            if self.sparse_vocab:
+                vocab = self.get_candidate_vocab(sample, identifiers)
+
+        hypothesis = [[] for _ in range(bsz)]
+        hypothesis_hash = [{} for _ in range(bsz)]     # the rendered hash of each hypothesis, with dedup
+        active = list(range(bsz))       # bugs still being searched, in the order of their beams
+
+        # state of the beams of the last step, at step 0 there is one beam for each bug,
+        # the generated tokens are only kept as backpointers in history
+        history = []
+        final_scores = torch.zeros(bsz)
+        beam_lengths = torch.zeros(bsz).long()
+        beam_glue = torch.zeros(bsz, dtype=torch.bool)
+        beam_hash = torch.zeros(bsz).long()
+        beam_bug_ids = torch.arange(bsz)
+        beam_prev_lens = torch.LongTensor(prev_lens)
+        incremental_states = self.get_incremental_states(encoder_outs, prev_lens)
+        if trie is not None:
+            trie_state, trie_joinable = trie.initial_state(beam_bug_ids)
+
+        for step in range(0, self.max_step):
+            if self.incremental and step > 0:
+                # the earlier positions are kept in incremental_state, only the newest token is fed
+                prev_tokens_index = torch.ones(beam_bug_ids.size(0), 1).long()
+                decoder_tokens = history[-1][0].unsqueeze(1)
+            else:
+                width = int(beam_prev_lens.max()) + step
+                prev_tokens_index = self.get_prev_tokens_index(beam_prev_lens, step, width)
+                decoder_tokens = self.get_decoder_tokens(prev_tokens, history, beam_bug_ids, beam_prev_lens, width)
+            if self.profiler is not None:
+                self.profiler.step(active)
+            with self.phase('decode'):
+                logits = self.decode(
+                    prev_tokens_index,
+                    encoder_outs,
+                    decoder_tokens,
+                    beam_bug_ids,
+                    incremental_states,
+                    vocab,
                 )
-                encoder_out['encoder_padding_mask'] = encoder_out['encoder_padding_mask']. \
-                    repeat(split_size, 1)
-
-            logits = self.model.decode(
-                prev_tokens_index,
-                encoder_out,
-                tokens[:, :prev_len + step],
-            )
-            logits[:, self.dictionary.pad()] = -math.inf
+            beam_tokens = self.get_beam_tokens(vocab, logits.size(0))
+            with self.phase('constrain'):
+                if trie is not None:
+                    self.constrain(logits, sample, step, beam_bug_ids, beam_lengths, trie, trie_state, beam_tokens)
+                else:
+                    logits[:, pad] = -math.inf
 
-            if identifiers is not None:
-                for i in range(tokens.size(0)):
-                    src_length = int(sample['src_statement_length'][0])
-                    cur_length = len(tokens_string[i].strip().split())
-                    if cur_length > src_length:
-                        gap = max(-50, src_length - cur_length)
-                    else:
-                        gap = max(-50, cur_length - src_length)
-                    if cur_length < src_length:
-                        logits[i, self.dictionary.eos()] += length_penalty[gap]
-                    else:
-                        logits[i, self.dictionary.eos()] -= length_penalty[gap]
+            n = len(active)
+            with self.phase('topk'):
+                lprobs, indices = logits.topk(k=beam_size, dim=1)  # n x beam (x 1 at step 0), beam
+                indices = self.column_tokens(indices, beam_tokens)
 
-                    if not identifiers[0]['text']:
-                        continue
+            if step == 0:
+                # expand each bug into beam_size beams
+                lprobs = lprobs.view(-1)
+                indices = indices.view(-1)
+                cand_final_scores = lprobs
+                cand_beam_ids = torch.arange(n).repeat_interleave(beam_size)
+            else:
+                lprobs = lprobs.view(n, beam_size, beam_size).transpose(1, 2).contiguous().view(n, -1)
+                indices = indices.view(n, beam_size, beam_size).transpose(1, 2).contiguous().view(n, -1)
+                cand_final_scores = lprobs + final_scores.view(n, 1, beam_size).repeat(1, beam_size, 1).view(n, -1)
+                with self.phase('topk'):
+                    cand_final_scores, sort_order = cand_final_scores.sort(dim=1, descending=True)
+                lprobs = lprobs.gather(1, sort_order)
+                indices = indices.gather(1, sort_order)
+                cand_beam_ids = sort_order % beam_size + (torch.arange(n) * beam_size).unsqueeze(1)
+                if self.dedup:
+                    cand_hash = self.extend_hash(
+                        beam_hash[cand_beam_ids], beam_glue[cand_beam_ids], beam_lengths[cand_beam_ids], indices
+                    )
 
-                    prefixs, texts = BeamSearch.get_prefix(
-                        tokens[i][prev_len: prev_len + step],
-                        self.dictionary
+                # choose finished beam
+                with self.phase('eos'):
+                    eos_positions = indices[:, : beam_size].eq(eos).nonzero()  # N_eos x 2, (bug, candidate)
+                    finished = []
+                    if eos_positions.size(0) > 0:
+                        eos_bugs, eos_order = eos_positions[:, 0], eos_positions[:, 1]
+                        eos_tokens, eos_scores = self.backtrack(history, cand_beam_ids[eos_bugs, eos_order])
+                        eos_lprobs = lprobs[eos_bugs, eos_order]
+                        eos_cand_final_scores = cand_final_scores[eos_bugs, eos_order]
+                        if self.dedup:
+                            eos_hash = cand_hash[eos_bugs, eos_order]
+                        for i in range(eos_positions.size(0)):
+                            j = int(eos_bugs[i])
+                            b = active[j]
+                            if j in finished:
+                                continue
+                            self.add_hypothesis(
+                                hypothesis[b], hypothesis_hash[b], int(eos_hash[i]) if self.dedup else None,
+                                {
+                                    'hypo': torch.cat([eos_tokens[i], torch.LongTensor([eos])]),
+                                    'score': torch.cat([eos_scores[i, 1:], eos_lprobs[i: i + 1]]),
+                                    'final_score': float(eos_cand_final_scores[i]) / (1 + step),
+                                })
+                            if len(hypothesis[b]) >= max_hypothesis:
+                                finished.append(j)
+
+                # choose next beam, the first beam_size candidates of each bug which are not eos
+                cand_mask = ~indices.eq(eos)
+                positions = torch.arange(cand_mask.size(1)).unsqueeze(0)
+                if self.dedup:
+                    # candidates rendering the same statement and joining the next token the same way are merged
+                    keys = cand_hash * 2 + (self.joiner[indices] | self.bpe[indices]).long()
+                    cand_mask &= ~self.get_duplicates(torch.where(cand_mask, keys, -1 - positions))
+                with self.phase('topk'):
+                    _, keep = (positions + (~cand_mask).long() * cand_mask.size(1)).topk(
+                        k=beam_size, dim=1, largest=False
                     )
-                    prefixs.reverse()
-                    texts.reverse()
-
-                    tmp = None
-                    for prefix, text in zip(prefixs, texts):
-                        if prefix in identifiers[0]['tokens']:
-                            if prefix != '' and prefix[-5:] != 'CaMeL' and prefix[-1] != '_' and \
-                                    text in identifiers[0]['text']:
-                                tmp = set(identifiers[0]['tokens'][prefix].tolist()) | \
-                                      set(identifiers[0]['tokens'][''].tolist())
-                                tmp = torch.LongTensor(list(tmp))
-                            else:
-                                tmp = identifiers[0]['tokens'][prefix]
-                            break
-                        if text in identifiers[0]['text']:
-                            break
-                    if tmp is None:
-                        prefix = ''
-                        tmp = identifiers[0]['tokens'][prefix]
-                    logits[i, tmp] += 100
-
-            lprobs, indices = logits.topk(k=self.beam_size, dim=1)  # beam, beam
-            lprobs = lprobs.t().contiguous().view(-1)  # beam x beam
-            indices = indices.t().contiguous().view(-1)
-            cand_final_scores = lprobs + final_scores.repeat(self.beam_size)
-            cand_final_scores, sort_order = cand_final_scores.sort(descending=True)
-            lprobs = lprobs.index_select(0, sort_order)
-            indices = indices.index_select(0, sort_order)
-
-            # choose finished beam
-            eos_mask = indices[: self.beam_size].eq(self.dictionary.eos())
-            eos_lprobs = lprobs[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            eos_cand_final_scores = cand_final_scores[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            eos_sort_order = sort_order[: self.beam_size].masked_select(mask=eos_mask)  # N_eos
-            if eos_cand_final_scores.size(0) > 0:
-                eos_beam_ids = eos_sort_order % self.beam_size  # N_eos
-                eos_beam_ids = eos_beam_ids.long()
-                eos_beam = tokens[eos_beam_ids, prev_len:]  # N_eos, L
-                eos_beam[:, step] = self.dictionary.eos()
-                eos_beam_scores = scores[eos_beam_ids, :]
-                eos_beam_scores[:, step] = eos_lprobs
-                for i in range(eos_beam.size(0)):
-                    hypothesis.append(
-                        {
-                            'hypo': eos_beam[i, : step + 1],
-                            'score': eos_beam_scores[i, 1: step + 1],
-                            'final_score': float(eos_cand_final_scores[i]) / (1 + step),
-                        })
-                if len(hypothesis) >= self.beam_size:
-                    hypothesis = hypothesis[: self.beam_size]
+                cand_final_scores = cand_final_scores.gather(1, keep)
+                lprobs = lprobs.gather(1, keep)
+                indices = indices.gather(1, keep)
+                cand_beam_ids = cand_beam_ids.gather(1, keep)
+
+                # drop the bugs which have got enough hypothesis
+                if finished:
+                    alive = [j for j in range(n) if j not in finished]
+                    active = [active[j] for j in alive]
+                    alive = torch.LongTensor(alive)
+                    self.reorder_incremental_prefix(incremental_states, alive)
+                    if vocab is not None:
+                        vocab = {key: value.index_select(0, alive) for key, value in vocab.items()}
+                    cand_final_scores = cand_final_scores.index_select(0, alive)
+                    lprobs = lprobs.index_select(0, alive)
+                    indices = indices.index_select(0, alive)
+                    cand_beam_ids = cand_beam_ids.index_select(0, alive)
+                cand_final_scores = cand_final_scores.view(-1)
+                lprobs = lprobs.view(-1)
+                indices = indices.view(-1)
+                cand_beam_ids = cand_beam_ids.view(-1)
+                if not active:
                     break
 
-            # choose next beam
-            cand_mask = ~indices.eq(self.dictionary.eos())
-            cand_final_scores = cand_final_scores.masked_select(mask=cand_mask)[: self.beam_size]
-            sort_order = sort_order.masked_select(mask=cand_mask)[: self.beam_size]
-            lprobs = lprobs.masked_select(mask=cand_mask)[: self.beam_size]
-            indices = indices.masked_select(mask=cand_mask)[: self.beam_size]
-            cand_beam_ids = sort_order % self.beam_size
-            cand_beam_ids = cand_beam_ids.long()
-
-            new_tokens_string = []
-            for i in range(cand_beam_ids.size(0)):
-                symbol = ''
-                if int(indices[i]) not in [self.dictionary.eos(), self.dictionary.pad()]:
-                    symbol = self.dictionary[int(indices[i])]
-                new_tokens_string.append(
-                    add_token_to_string(tokens_string[int(cand_beam_ids[i])], symbol)
-                )
-            tokens_string = new_tokens_string
-
-            tokens = tokens[cand_beam_ids, :]
-            tokens[:, prev_len + step] = indices
-
-            scores = scores[cand_beam_ids, :]
-            scores[:, step] = lprobs
+            history.append((indices, cand_beam_ids, lprobs))
+            beam_bug_ids = beam_bug_ids.index_select(0, cand_beam_ids)
+            beam_prev_lens = beam_prev_lens.index_select(0, cand_beam_ids)
             final_scores = cand_final_scores
-            prev_tokens_index = torch.cat([prev_tokens_index,
-                                           torch.ones(self.beam_size, 1).long()], dim=-1)
-
-        if len(hypothesis) < self.beam_size:
-            current_num = len(hypothesis)
-            for i in range(self.beam_size - current_num):
-                tokens[i, -1] = self.dictionary.eos()
-                hypothesis.append({
-                    'hypo': tokens[i],
-                    'score': scores[i, 1:],
-                    'final_score': float(final_scores[i]) / (self.max_step - prev_len),
-                })
-
-        hypothesis.sort(key=lambda e: e['final_score'], reverse=True)
+            self.reorder_incremental_state(incremental_states, cand_beam_ids)
+
+            beam_lengths = beam_lengths.index_select(0, cand_beam_ids)
+            beam_glue = beam_glue.index_select(0, cand_beam_ids)
+            if self.dedup:
+                beam_parent_hash = beam_hash.index_select(0, cand_beam_ids)
+                beam_hash = self.extend_hash(beam_parent_hash, beam_glue, beam_lengths, indices)
+            new_word = self.word[indices] & ((~self.joiner[indices] & ~beam_glue) | beam_lengths.eq(0))
+            beam_lengths = beam_lengths + new_word.long()
+            beam_glue = self.joiner[indices] | self.bpe[indices]
+            with self.phase('constrain'):
+                if trie is not None:
+                    trie_state, trie_joinable = trie.next_state(
+                        trie_state.index_select(0, cand_beam_ids), trie_joinable.index_select(0, cand_beam_ids),
+                        beam_bug_ids, indices,
+                    )
+
+            stopped = []
+            if self.early_stop:
+                # the identifier bonus each later step can add for the beams of each bug
+                bonus, src_lengths = torch.zeros(len(active)), None
+                if trie is not None:
+                    bonus = trie.constrained[active].float() * 100
+                    src_lengths = sample['src_statement_length'][:, 0].index_select(0, beam_bug_ids)
+                stopped = self.get_early_stopped(
+                    hypothesis, active, final_scores, step, max_steps, bonus, beam_lengths, src_lengths
+                )
+                for j in stopped:
+                    self.saved_steps[active[j]] = max_steps[active[j]] - 1 - step
+
+            # the bugs reaching their maximum steps are filled with the alive beams
+            if stopped or any(step == max_steps[b] - 1 for b in active):
+                alive, fill_rows = [], []
+                for j, b in enumerate(active):
+                    if j in stopped:
+                        continue
+                    elif step < max_steps[b] - 1:
+                        alive.append(j)
+                    else:
+                        fill_rows += range(j * beam_size, j * beam_size + beam_size)
+                with self.phase('eos'):
+                    fill_rows = torch.LongTensor(fill_rows)
+                    fill_tokens, fill_scores = self.backtrack(history, fill_rows)
+                    for i in range(fill_rows.size(0)):
+                        b = active[int(fill_rows[i]) // beam_size]
+                        if len(hypothesis[b]) >= max_hypothesis:
+                            continue
+                        hypo = fill_tokens[i]
+                        hypo[-1] = eos
+                        # the last token is replaced by eos, the hypothesis renders what its parent renders
+                        self.add_hypothesis(
+                            hypothesis[b], hypothesis_hash[b],
+                            int(beam_parent_hash[fill_rows[i]]) if self.dedup else None,
+                            {
+                                'hypo': hypo,
+                                'score': fill_scores[i, 1:],
+                                'final_score': float(final_scores[fill_rows[i]]) / max_steps[b],
+                            })
+                active = [active[j] for j in alive]
+                if not active:
+                    break
+                alive = torch.LongTensor(alive)
+                rows = (alive.unsqueeze(1) * beam_size + torch.arange(beam_size).unsqueeze(0)).view(-1)
+                history[-1] = tuple(t.index_select(0, rows) for t in history[-1])
+                beam_lengths = beam_lengths.index_select(0, rows)
+                beam_glue = beam_glue.index_select(0, rows)
+                beam_hash = beam_hash.index_select(0, rows)
+                beam_bug_ids = beam_bug_ids.index_select(0, rows)
+                beam_prev_lens = beam_prev_lens.index_select(0, rows)
+                final_scores = final_scores.index_select(0, rows)
+                if trie is not None:
+                    trie_state = trie_state.index_select(0, rows)
+                    trie_joinable = trie_joinable.index_select(0, rows)
+                self.reorder_incremental_state(incremental_states, rows)
+                self.reorder_incremental_prefix(incremental_states, alive)
+                if vocab is not None:
+                    vocab = {key: value.index_select(0, alive) for key, value in vocab.items()}
+
+        for b in range(bsz):
+            hypothesis[b].sort(key=lambda e: e['final_score'], reverse=True)
         return hypothesis
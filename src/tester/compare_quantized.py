@@ -0,0 +1,90 @@
+import time
+import sys
+import os
+
+COMPARE_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(COMPARE_DIR)
+sys.path.append(COMPARE_DIR + '../models/')
+sys.path.append(COMPARE_DIR + '../dataloader/')
+from gpt_conut_data_loader import GPTCoNuTDataLoader
+from gpt_fconv_data_loader import GPTFConvDataLoader
+from identifier_data_loader import IdentifierDataLoader
+from dictionary import Dictionary
+from gpt_conut import GPTCoNuTModel
+from generator import Generator, load_model, load_quantized_model
+
+
+def get_patches(dictionary, hypothesis):
+    return [dictionary.string(h['hypo']).replace('@@ ', '') for h in hypothesis]
+
+
+def run(generator, dictionary, indices):
+    # the patch list of each bug and the seconds taken
+    start = time.time()
+    patches = []
+    for i in indices:
+        for _, hypothesis in generator.generate_batch([i]):
+            patches.append(get_patches(dictionary, hypothesis))
+    return patches, time.time() - start
+
+
+def compare_quantized(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, beam_size,
+                      bug_num=None, quantized_file=None, num_threads=None):
+    """
+    run the float and the int8 quantized model on cpu over the same bugs, print for each bug
+    how many of the float patches the quantized model also generates and whether the top-1 patch is the same,
+    and the time taken by each model
+    """
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    float_model = load_model(dictionary, model_file)
+    quantized_model = load_quantized_model(dictionary, model_file, quantized_file)
+    identifier_loader = IdentifierDataLoader(
+        dictionary, identifier_token_file, identifier_txt_file
+    )
+    if isinstance(float_model, GPTCoNuTModel):
+        data_loader = GPTCoNuTDataLoader(
+            input_file, dictionary,
+            identifier_loader=identifier_loader
+        )
+    else:
+        data_loader = GPTFConvDataLoader(
+            input_file, dictionary,
+            identifier_loader=identifier_loader
+        )
+    data_loader.load_data(0, data_loader.total_size)
+    indices = list(range(data_loader.total_size if bug_num is None else min(bug_num, data_loader.total_size)))
+
+    float_generator = Generator(
+        float_model, dictionary, data_loader, beam_size=beam_size, device='cpu', num_threads=num_threads
+    )
+    quantized_generator = Generator(
+        quantized_model, dictionary, data_loader, beam_size=beam_size, device='cpu', num_threads=num_threads
+    )
+    float_patches, float_time = run(float_generator, dictionary, indices)
+    quantized_patches, quantized_time = run(quantized_generator, dictionary, indices)
+
+    overlap, top1 = 0., 0
+    for i, float_list, quantized_list in zip(indices, float_patches, quantized_patches):
+        common = len(set(float_list) & set(quantized_list)) / max(len(set(float_list)), 1)
+        same = len(float_list) > 0 and len(quantized_list) > 0 and float_list[0] == quantized_list[0]
+        overlap += common
+        top1 += int(same)
+        print(i, 'overlap:', round(common, 4), 'top-1 same:', same)
+
+    print('bugs:', len(indices))
+    print('average overlap:', round(overlap / max(len(indices), 1), 4))
+    print('same top-1:', top1, '/', len(indices))
+    print('float time:', round(float_time, 2), 's, int8 time:', round(quantized_time, 2), 's, speedup:',
+          round(float_time / max(quantized_time, 1e-6), 2))
+
+
+if __name__ == "__main__":
+    vocab_file = COMPARE_DIR + '../../data/vocabulary/vocabulary.txt'
+    input_file = COMPARE_DIR + '../../candidate_patches/QuixBugs/quixbugs_bpe.txt'
+    identifier_txt_file = COMPARE_DIR + '../../candidate_patches/QuixBugs/identifier.txt'
+    identifier_token_file = COMPARE_DIR + '../../candidate_patches/QuixBugs/identifier.tokens'
+    beam_size = 100
+
+    model_file = COMPARE_DIR + '../../data/models/gpt_conut_1.pt'
+    compare_quantized(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, beam_size,
+                      bug_num=10)
@@ -0,0 +1,118 @@
+import os
+import hashlib
+import torch
+from collections import OrderedDict
+
+
+def update_hash(h, name, value):
+    # the bytes of a state entry: tensors, the (weight, bias) of the packed params of quantized layers, dtypes
+    if torch.is_tensor(value):
+        value = value.dequantize() if value.is_quantized else value
+        h.update(value.detach().cpu().contiguous().numpy().tobytes())
+    elif isinstance(value, (tuple, list)):
+        for v in value:
+            update_hash(h, name, v)
+    elif hasattr(value, 'unpack'):
+        update_hash(h, name, value.unpack())
+    elif value is None or isinstance(value, (torch.dtype, bool, int, float, str)):
+        h.update(repr(value).encode('utf-8'))
+    else:
+        raise Exception('cannot hash {} of type {}'.format(name, type(value).__name__))
+
+
+def get_model_hash(model):
+    # content hash of the weights, so the outputs cached for one checkpoint are never used for another
+    h = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        update_hash(h, name, value)
+    return h.hexdigest()
+
+
+class EncoderCache():
+    """
+    Content addressed cache of the encoder output of single bugs, keyed by the model hash and the token ids.
+    The outputs are kept in an in-memory LRU of capacity entries and, with cache_dir, also on disk,
+    so they are reused across bugs, generation calls and runs.
+    """
+    def __init__(self, capacity=1024, cache_dir=None):
+        self.capacity = capacity
+        self.cache_dir = cache_dir
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if cache_dir is not None and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def get_key(model_hash, name, tokens, mask=None):
+        """
+        tokens: the token ids of one bug (padding is stripped), mask: the positions of the source in tokens
+        name: which encoder, e.g. 'src' or 'ctx'
+        """
+        length = int(tokens.ne(0).sum())
+        h = hashlib.sha1()
+        h.update('{}-{}'.format(model_hash, name).encode('utf-8'))
+        h.update(str(tokens[: length].tolist()).encode('utf-8'))
+        if mask is not None:
+            h.update(str(mask[: length].tolist()).encode('utf-8'))
+        return h.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.pt')
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return self.memory[key]
+        if self.cache_dir is not None and os.path.exists(self.get_path(key)):
+            value = torch.load(self.get_path(key), map_location='cpu')
+            self.put(key, value, save=False)
+            self.disk_hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value, save=True):
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+        if save and self.cache_dir is not None:
+            path = self.get_path(key)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            # written aside and renamed, so a reader never sees a partial file
+            torch.save(value, path + '.{}'.format(os.getpid()))
+            os.replace(path + '.{}'.format(os.getpid()), path)
+
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / total if total > 0 else 0.,
+        }
+
+
+def merge_cached_outputs(values):
+    """
+    values: the (src_tokens, x, y) cached for each bug, padded again into the output of GPTFConvEncoder,
+    the padding is masked by encoder_padding_mask
+    """
+    length = max(tokens.size(0) for tokens, _, _ in values)
+    src_tokens = torch.zeros(len(values), length).long()
+    x = values[0][1].new_zeros(len(values), length, values[0][1].size(-1))
+    y = values[0][2].new_zeros(len(values), length, values[0][2].size(-1))
+    for b, (tokens, x_b, y_b) in enumerate(values):
+        src_tokens[b, : tokens.size(0)] = tokens
+        x[b, : tokens.size(0)] = x_b
+        y[b, : tokens.size(0)] = y_b
+    return {
+        'src_tokens': src_tokens,
+        'encoder_out': (x, y),
+        'encoder_padding_mask': src_tokens.eq(0),
+    }
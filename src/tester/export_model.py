@@ -0,0 +1,30 @@
+import sys
+import os
+
+EXPORT_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(EXPORT_DIR)
+sys.path.append(EXPORT_DIR + '../models/')
+sys.path.append(EXPORT_DIR + '../dataloader/')
+from dictionary import Dictionary
+from export import export_model
+from generator import load_model
+
+
+def export_gpt_model(vocab_file, model_file, export_dir, device='cpu'):
+    # export_dir can then be given as the model_file of generate_gpt_conut / generate_gpt_fconv / generate_ensemble
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    model = load_model(dictionary, model_file)
+    export_model(model, export_dir, device)
+    print('exported', model_file, 'to', export_dir)
+
+
+if __name__ == "__main__":
+    vocab_file = EXPORT_DIR + '../../data/vocabulary/vocabulary.txt'
+
+    model_file = EXPORT_DIR + '../../data/models/gpt_conut_1.pt'
+    export_dir = EXPORT_DIR + '../../data/models/gpt_conut_1-cuda/'
+    export_gpt_model(vocab_file, model_file, export_dir, device='cuda')
+
+    model_file = EXPORT_DIR + '../../data/models/gpt_fconv_1.pt'
+    export_dir = EXPORT_DIR + '../../data/models/gpt_fconv_1-cuda/'
+    export_gpt_model(vocab_file, model_file, export_dir, device='cuda')
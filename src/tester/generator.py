@@ -1,4 +1,8 @@
+import io
+import time
 import codecs
+import multiprocessing
+import shutil
 import torch
 import sys
 import os
@@ -13,84 +17,369 @@ from identifier_data_loader import IdentifierDataLoader
 from dictionary import Dictionary
 from gpt_conut import GPTCoNuTModel
 from gpt_fconv import GPTFConvModel
+from quantization import quantize_model
+from export import ExportedModel
 from beamsearch import BeamSearch
+from sampling import SamplingSearch
+from profiler import StepProfiler
 
 
 class Generator():
-    def __init__(self, model, dictionary, data_loader, beam_size=10):
+    def __init__(self, model, dictionary, data_loader, beam_size=10, batch_size=1, device='cuda', num_threads=None,
+                 sparse_vocab=False, memory_budget=None, dedup=False,
+                 early_stop=False, max_hypothesis=None, encoder_cache=None,
+                 sampling=False, temperature=1.0, top_p=0.95, draft_model=None, draft_tokens=4, profile=None):
         self.model = model
         self.dictionary = dictionary
         self.data_loader = data_loader
         self.beam_size = beam_size
-        self.beamsearch = BeamSearch(model, dictionary, beam_size)
+        self.batch_size = batch_size
+        # with sampling, beam_size samples are drawn for each bug instead of the beam search (see SamplingSearch)
+        # draft_model: speculative decoding of the samples, see SamplingSearch.generate_speculative
+        assert draft_model is None or sampling, 'speculative decoding draws samples, it needs sampling'
+        search = SamplingSearch if sampling else BeamSearch
+        kwargs = dict(
+            temperature=temperature, top_p=top_p, draft_model=draft_model, draft_tokens=draft_tokens
+        ) if sampling else {}
+        self.beamsearch = search(
+            model, dictionary, beam_size, device=device, num_threads=num_threads, sparse_vocab=sparse_vocab,
+            memory_budget=memory_budget, dedup=dedup, early_stop=early_stop, max_hypothesis=max_hypothesis,
+            encoder_cache=encoder_cache, **kwargs
+        )
+        # the path the timings of the phases of the search are written to by generate (see StepProfiler),
+        # a .csv of the bugs or else a .json of the summary and the bugs, None to not profile
+        self.profile = profile
+        if profile is not None:
+            self.beamsearch.profiler = StepProfiler(synchronize=str(device).startswith('cuda'))
+        # the steps early_stop saved in the bugs generated since generate was called
+        self.saved_steps = 0
         print(self.model, beam_size)
 
-    def generate(self, output_path):
-        wp = codecs.open(output_path, 'w', 'utf-8')
-        self.data_loader.load_data(0, self.data_loader.total_size)
-        for i in range(self.data_loader.total_size):
-            # it will crash the gpu
-            # if i == 7 and "jacksonxml-1f-mutants-allin" in output_path:
-            #     continue
-            # if i == 79 and "codec-1f-mutants-allin" in output_path:
-            #     continue
-            # if i == 71 and "chart-1f-mutants-allin" in output_path:
-                # continue
-            # if i == 10 and "codec-1f-mutants-allin" in output_path:
-            #     continue
-            print(i, '/', self.data_loader.total_size)
-            try:
-                data = self.data_loader.dataset[i]
-                if True:
-                    self.beamsearch.beam_size = self.beam_size
-                    sample = self.data_loader.dataset.collater([data])
-                    with torch.no_grad():
-                        if isinstance(self.model, GPTCoNuTModel):
-                            hypothesis = self.beamsearch.generate_gpt_conut(sample)
-                        elif isinstance(self.model, GPTFConvModel):
-                            hypothesis = self.beamsearch.generate_gpt_fconv(sample)
-                # except Exception as e:
-                #    print(e)
-                #    continue
-                id = str(sample['id'].item())
-                wp.write('S-{}\t'.format(id))
-                wp.write(self.dictionary.string(data['source']) + '\n')
-                wp.write('T-{}\t'.format(id))
-                wp.write(self.dictionary.string(data['target']) + '\n')
-                for h in hypothesis:
-                    wp.write('H-{}\t{}\t'.format(id, str(h['final_score'])))
-                    wp.write(self.dictionary.string(h['hypo']) + '\n')
-                    wp.write('P-{}\t'.format(id))
-                    wp.write(' '.join(str(round(s.item(), 4)) for s in h['score']) + '\n')
-            except:
-                import traceback
-                traceback.print_exc()
-                print('[ERROR] {}/{} FAIL!'.format(i, self.data_loader.total_size))
+    def generate_batch(self, indices):
+        # beam search for several bugs at once, return the data and hypothesis of each bug
+        samples = [self.data_loader.dataset[i] for i in indices]
+        self.beamsearch.beam_size = self.beam_size
+        sample = self.data_loader.dataset.collater(samples)
+        profiler = self.beamsearch.profiler
+        if profiler is not None:
+            profiler.start([s['id'] for s in samples], self.beam_size)
+        with torch.no_grad():
+            if isinstance(self.model, (list, tuple)):
+                hypothesis = self.beamsearch.generate_ensemble(sample)
+            elif isinstance(self.model, GPTCoNuTModel):
+                hypothesis = self.beamsearch.generate_gpt_conut(sample)
+            elif isinstance(self.model, GPTFConvModel):
+                hypothesis = self.beamsearch.generate_gpt_fconv(sample)
+            elif isinstance(self.model, ExportedModel):
+                hypothesis = self.beamsearch.generate_ensemble(sample)
+        if profiler is not None:
+            profiler.finish(hypothesis, self.beamsearch.saved_steps)
+        self.saved_steps += sum(self.beamsearch.saved_steps)
+        return list(zip(samples, hypothesis))
+
+    def write_hypothesis(self, wp, data, hypothesis):
+        id = str(data['id'])
+        wp.write('S-{}\t'.format(id))
+        wp.write(self.dictionary.string(data['source']) + '\n')
+        wp.write('T-{}\t'.format(id))
+        wp.write(self.dictionary.string(data['target']) + '\n')
+        for h in hypothesis:
+            wp.write('H-{}\t{}\t'.format(id, str(h['final_score'])))
+            wp.write(self.dictionary.string(h['hypo']) + '\n')
+            wp.write('P-{}\t'.format(id))
+            wp.write(' '.join(str(round(s.item(), 4)) for s in h['score']) + '\n')
+
+    def generate(self, output_path, start=0, end=None, resume=False):
+        """
+        the bugs [start, end) of the data file, written with their index in the whole file as id.
+        after each bug, its id and the size of the output so far are appended to output_path + '.journal',
+        with resume the bugs in the journal are skipped and the output is cut back to the last of them
+        """
+        if end is None:
+            end = self.data_loader.total_size
+        end = min(end, self.data_loader.total_size)
+        journal_path = output_path + '.journal'
+        finished, size = set(), 0
+        if resume and os.path.exists(output_path):
+            finished, size = self.read_journal(journal_path)
+            wp = open(output_path, 'r+b')
+            # drop what was written after the last finished bug
+            wp.truncate(size)
+            wp.seek(size)
+            journal = open(journal_path, 'a')
+        else:
+            wp = open(output_path, 'wb')
+            journal = open(journal_path, 'w')
+        self.data_loader.load_data(start, end)
+        remaining = [i for i in range(end - start) if i + start not in finished]
+        if finished:
+            print('resume,', len(finished), 'bugs already finished')
+        profiler = self.beamsearch.profiler
+        if profiler is not None:
+            profiler.id_offset = start
+        # the distinct patches generated per second, to compare the beam search with sampling
+        patch_num, start_time = 0, time.time()
+        self.saved_steps = 0
+        for i in range(0, len(remaining), self.batch_size):
+            indices = remaining[i: i + self.batch_size]
+            print(start + indices[0], '/', self.data_loader.total_size)
+            for data, hypothesis in self.try_generate_batch(indices):
+                patch_num += len(set(self.dictionary.string(h['hypo']) for h in hypothesis))
+                data = dict(data, id=data['id'] + start)
+                buffer = io.StringIO()
+                with self.beamsearch.phase('string'):
+                    # counted in the batch just generated
+                    self.write_hypothesis(buffer, data, hypothesis)
+                wp.write(buffer.getvalue().encode('utf-8'))
+                wp.flush()
+                os.fsync(wp.fileno())
+                # a bug is only finished once its output is on disk, a partial line is ignored by read_journal
+                journal.write('{}\t{}\n'.format(data['id'], wp.tell()))
+                journal.flush()
+                os.fsync(journal.fileno())
         wp.close()
+        journal.close()
+        seconds = time.time() - start_time
+        print('unique patches', patch_num, 'in', round(seconds, 2), 's,',
+              round(patch_num / seconds, 2) if seconds > 0 else 0, 'per second')
+        if self.beamsearch.early_stop:
+            print('early stop saved', self.saved_steps, 'steps')
+        if self.beamsearch.encoder_cache is not None:
+            print('encoder cache', self.beamsearch.encoder_cache.stats())
+        if profiler is not None:
+            profiler.save(self.profile)
+            print('profile', profiler.summary()['phases'])
 
+    @staticmethod
+    def read_journal(journal_path):
+        # the ids of the finished bugs and the size of the output after the last of them
+        finished, size = set(), 0
+        if not os.path.exists(journal_path):
+            return finished, size
+        fp = open(journal_path, 'r')
+        for line in fp.readlines():
+            if not line.endswith('\n'):
+                break
+            id, offset = line.strip().split('\t')
+            finished.add(int(id))
+            size = int(offset)
+        fp.close()
+        return finished, size
 
-def generate_gpt_conut(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size):
-    dictionary = Dictionary(vocab_file, min_cnt=0)
-    print(len(dictionary))
-    loaded = torch.load(
-        model_file, map_location='cpu'
-    )
-    config = loaded['config']
+    def try_generate_batch(self, indices):
+        # generate_batch, the bugs which fail are printed and left out
+        try:
+            return self.generate_batch(indices)
+        except:
+            import traceback
+            traceback.print_exc()
+            results = []
+            if len(indices) == 1:
+                print('[ERROR] {}/{} FAIL!'.format(indices[0], len(self.data_loader.dataset)))
+            else:
+                # retry the bugs one by one, so a single failing bug does not lose the whole batch
+                for i in indices:
+                    try:
+                        results += self.generate_batch([i])
+                    except:
+                        traceback.print_exc()
+                        print('[ERROR] {}/{} FAIL!'.format(i, len(self.data_loader.dataset)))
+            return results
+
+
+def build_model(dictionary, config):
+    # GPT-CoNuT or GPT-FConv, told apart by the config saved with the model
     gpt_config = config['embed_model_config']
     gpt_config.attn_pdrop = 0
     gpt_config.embd_pdrop = 0
     gpt_config.resid_pdrop = 0
     gpt_model = OpenAIGPTLMHeadModel(gpt_config)
-    model = GPTCoNuTModel(
-        dictionary=dictionary, embed_dim=config['embed_dim'],
-        max_positions=config['max_positions'],
-        src_encoder_convolutions=config['src_encoder_convolutions'],
-        ctx_encoder_convolutions=config['ctx_encoder_convolutions'],
-        decoder_convolutions=config['decoder_convolutions'],
-        dropout=0, embed_model=gpt_model,
+    if 'ctx_encoder_convolutions' in config:
+        model = GPTCoNuTModel(
+            dictionary=dictionary, embed_dim=config['embed_dim'],
+            max_positions=config['max_positions'],
+            src_encoder_convolutions=config['src_encoder_convolutions'],
+            ctx_encoder_convolutions=config['ctx_encoder_convolutions'],
+            decoder_convolutions=config['decoder_convolutions'],
+            dropout=0, embed_model=gpt_model,
+        )
+    else:
+        model = GPTFConvModel(
+            dictionary=dictionary, embed_dim=config['embed_dim'],
+            max_positions=config['max_positions'],
+            encoder_convolutions=config['encoder_convolutions'],
+            decoder_convolutions=config['decoder_convolutions'],
+            dropout=0, embed_model=gpt_model,
+        )
+    return model
+
+
+def load_model(dictionary, model_file):
+    if os.path.isdir(model_file):
+        # the TorchScript graphs written by export_model.py
+        return ExportedModel(model_file)
+    if model_file.endswith('.slim'):
+        return load_slim_model(dictionary, model_file)
+    # the checkpoint pickles its config (the OpenAIGPTConfig), which weights_only loading refuses
+    loaded = torch.load(
+        model_file, map_location='cpu', weights_only=False
     )
+    model = build_model(dictionary, loaded['config'])
+    model.load_state_dict(loaded['model'])
+    return model
+
+
+def save_slim_model(model, slim_file):
+    # inference only: the config and every parameter / buffer (tied ones under each of their names), no optimizer
+    tensors = {}
+    for name, param in model.named_parameters(remove_duplicate=False):
+        tensors[name] = param.data
+    for name, buffer in model.named_buffers(remove_duplicate=False):
+        if buffer is not None:
+            tensors[name] = buffer
+    torch.save({'config': model.config(), 'tensors': tensors}, slim_file)
 
+
+def set_tensor(model, name, tensor, parameters):
+    # parameters: the Parameter of each loaded tensor, so tied parameters (one storage) stay one Parameter
+    module_name, _, tensor_name = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if tensor_name in module._parameters:
+        key = (tensor.data_ptr(), tensor.size(), tensor.stride())
+        if key not in parameters:
+            parameters[key] = torch.nn.Parameter(tensor, requires_grad=False)
+        module._parameters[tensor_name] = parameters[key]
+    else:
+        module._buffers[tensor_name] = tensor
+
+
+def load_slim_model(dictionary, slim_file):
+    """
+    load a model written by save_slim_model, its tensors are memory-mapped from the file instead of being
+    read and copied, so it loads in milliseconds and the pages are shared by the processes loading the same file
+    """
+    loaded = torch.load(
+        slim_file, map_location='cpu', mmap=True, weights_only=False
+    )
+    with torch.device('meta'):
+        # neither allocated nor initialized, every tensor is replaced by the mapped one
+        model = build_model(dictionary, loaded['config'])
+    parameters = {}
+    for name, tensor in loaded['tensors'].items():
+        set_tensor(model, name, tensor, parameters)
+    return model.eval()
+
+
+def load_quantized_model(dictionary, model_file, quantized_file=None):
+    # int8 dynamic quantized model for cpu, cached in quantized_file (model_file + '.int8' by default)
+    if quantized_file is None:
+        quantized_file = model_file + '.int8'
+    if os.path.exists(quantized_file):
+        loaded = torch.load(
+            quantized_file, map_location='cpu', weights_only=False
+        )
+        model = quantize_model(build_model(dictionary, loaded['config']))
+        model.load_state_dict(loaded['model'])
+        return model
+    loaded = torch.load(
+        model_file, map_location='cpu', weights_only=False
+    )
+    model = build_model(dictionary, loaded['config'])
     model.load_state_dict(loaded['model'])
+    model = quantize_model(model)
+    # written aside and renamed, the shards of generate_sharded may build it at the same time
+    torch.save({'config': loaded['config'], 'model': model.state_dict()}, quantized_file + '.{}'.format(os.getpid()))
+    os.replace(quantized_file + '.{}'.format(os.getpid()), quantized_file)
+    return model
+
+
+def generate_sharded(generate_fn, inputs, output_file, beam_size, shards, kwargs):
+    """
+    run generate_fn (generate_gpt_conut, generate_gpt_fconv or generate_ensemble) in shards processes,
+    each over a contiguous range of the bugs with num_threads threads (by default the cpu count // shards),
+    and merge their outputs into output_file in bug id order
+    inputs: (vocab_file, model_file(s), input_file, identifier_txt_file, identifier_token_file)
+    """
+    fp = codecs.open(inputs[2], 'r', 'utf-8')
+    total_size = len(fp.readlines())
+    fp.close()
+    if kwargs.get('num_threads') is None:
+        kwargs = dict(kwargs, num_threads=max(1, multiprocessing.cpu_count() // shards))
+    profile = kwargs.get('profile')
+
+    context = multiprocessing.get_context('spawn')
+    processes, shard_files = [], []
+    for i in range(shards):
+        start, end = total_size * i // shards, total_size * (i + 1) // shards
+        if start == end:
+            continue
+        shard_file = output_file + '.shard{}'.format(i)
+        shard_kwargs = dict(kwargs, shard=(start, end))
+        if profile is not None:
+            # each shard writes its own profile, e.g. profile.shard0.json
+            root, ext = os.path.splitext(profile)
+            shard_kwargs['profile'] = root + '.shard{}'.format(i) + ext
+        process = context.Process(
+            target=generate_fn, args=inputs + (shard_file, beam_size), kwargs=shard_kwargs,
+        )
+        process.start()
+        processes.append(process)
+        shard_files.append(shard_file)
+    for process in processes:
+        process.join()
+    failed = [f for f, process in zip(shard_files, processes) if process.exitcode != 0]
+    if failed:
+        raise Exception('shards failed: ' + ', '.join(failed))
+
+    wp = open(output_file, 'wb')
+    for shard_file in shard_files:
+        with open(shard_file, 'rb') as fp:
+            shutil.copyfileobj(fp, wp)
+    wp.close()
+    # the shards are kept until the merge is done, so a failed run can be resumed
+    for shard_file in shard_files:
+        os.remove(shard_file)
+        if os.path.exists(shard_file + '.journal'):
+            os.remove(shard_file + '.journal')
+
+
+def generate_patches(model, dictionary, data_loader, output_file, beam_size, batch_size=1, device='cuda',
+                     num_threads=None, sparse_vocab=False, memory_budget=None, dedup=False, early_stop=False,
+                     max_hypothesis=None, shard=None, resume=False, encoder_cache=None, sampling=False,
+                     temperature=1.0, top_p=0.95, draft_model_file=None, draft_tokens=4, profile=None):
+    """
+    the options shared by generate_gpt_conut, generate_gpt_fconv and generate_ensemble (see Generator),
+    shard: the range [start, end) of the bugs generated, None for all of them
+    """
+    generator = Generator(
+        model, dictionary, data_loader, beam_size=beam_size, batch_size=batch_size,
+        device=device, num_threads=num_threads, sparse_vocab=sparse_vocab, memory_budget=memory_budget,
+        dedup=dedup, early_stop=early_stop, max_hypothesis=max_hypothesis, encoder_cache=encoder_cache,
+        sampling=sampling, temperature=temperature, top_p=top_p,
+        draft_model=load_model(dictionary, draft_model_file) if draft_model_file is not None else None,
+        draft_tokens=draft_tokens, profile=profile,
+    )
+    print('start generate')
+    start, end = shard if shard is not None else (0, None)
+    generator.generate(output_file, start, end, resume)
+
+
+def generate_gpt_conut(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size,
+                       quantize=False, quantized_file=None, shards=1, **options):
+    # options: see generate_patches
+    if shards > 1:
+        return generate_sharded(
+            generate_gpt_conut, (vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file),
+            output_file, beam_size, shards, dict(options, quantize=quantize, quantized_file=quantized_file),
+        )
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    print(len(dictionary))
+    if quantize:
+        # int8 kernels only run on cpu
+        model = load_quantized_model(dictionary, model_file, quantized_file)
+        options = dict(options, device='cpu')
+    else:
+        model = load_model(dictionary, model_file)
     identifier_loader = IdentifierDataLoader(
         dictionary, identifier_token_file, identifier_txt_file
     )
@@ -98,31 +387,25 @@ def generate_gpt_conut(vocab_file, model_file, input_file, identifier_txt_file,
         input_file, dictionary,
         identifier_loader=identifier_loader
     )
-    generator = Generator(model, dictionary, data_loader, beam_size=beam_size)
-    print('start generate')
-    generator.generate(output_file)
+    generate_patches(model, dictionary, data_loader, output_file, beam_size, **options)
 
 
-def generate_gpt_fconv(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size):
+def generate_gpt_fconv(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size,
+                       quantize=False, quantized_file=None, shards=1, **options):
+    # options: see generate_patches
+    if shards > 1:
+        return generate_sharded(
+            generate_gpt_fconv, (vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file),
+            output_file, beam_size, shards, dict(options, quantize=quantize, quantized_file=quantized_file),
+        )
     dictionary = Dictionary(vocab_file, min_cnt=0)
     print(len(dictionary))
-    loaded = torch.load(
-        model_file, map_location='cpu'
-    )
-    config = loaded['config']
-    gpt_config = config['embed_model_config']
-    gpt_config.attn_pdrop = 0
-    gpt_config.embd_pdrop = 0
-    gpt_config.resid_pdrop = 0
-    gpt_model = OpenAIGPTLMHeadModel(gpt_config)
-    model = GPTFConvModel(
-        dictionary=dictionary, embed_dim=config['embed_dim'],
-        max_positions=config['max_positions'],
-        encoder_convolutions=config['encoder_convolutions'],
-        decoder_convolutions=config['decoder_convolutions'],
-        dropout=0, embed_model=gpt_model,
-    )
-    model.load_state_dict(loaded['model'])
+    if quantize:
+        # int8 kernels only run on cpu
+        model = load_quantized_model(dictionary, model_file, quantized_file)
+        options = dict(options, device='cpu')
+    else:
+        model = load_model(dictionary, model_file)
     identifier_loader = IdentifierDataLoader(
         dictionary, identifier_token_file, identifier_txt_file
     )
@@ -130,9 +413,35 @@ def generate_gpt_fconv(vocab_file, model_file, input_file, identifier_txt_file,
         input_file, dictionary,
         identifier_loader=identifier_loader
     )
-    generator = Generator(model, dictionary, data_loader, beam_size=beam_size)
-    print('start generate')
-    generator.generate(output_file)
+    generate_patches(model, dictionary, data_loader, output_file, beam_size, **options)
+
+
+def generate_ensemble(vocab_file, model_files, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size,
+                      shards=1, **options):
+    # options: see generate_patches
+    if shards > 1:
+        return generate_sharded(
+            generate_ensemble, (vocab_file, model_files, input_file, identifier_txt_file, identifier_token_file),
+            output_file, beam_size, shards, options,
+        )
+    # one beam search over all the models (GPT-CoNuT and/or GPT-FConv), their probabilities averaged at each step
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    print(len(dictionary))
+    models = [load_model(dictionary, model_file) for model_file in model_files]
+    identifier_loader = IdentifierDataLoader(
+        dictionary, identifier_token_file, identifier_txt_file
+    )
+    if any(isinstance(model, GPTCoNuTModel) or (isinstance(model, ExportedModel) and model.conut) for model in models):
+        data_loader = GPTCoNuTDataLoader(
+            input_file, dictionary,
+            identifier_loader=identifier_loader
+        )
+    else:
+        data_loader = GPTFConvDataLoader(
+            input_file, dictionary,
+            identifier_loader=identifier_loader
+        )
+    generate_patches(models, dictionary, data_loader, output_file, beam_size, **options)
 
 
 if __name__ == "__main__":
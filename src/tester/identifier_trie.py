@@ -0,0 +1,148 @@
+import bisect
+import torch
+
+
+# tokens that glue the tokens around them into one identifier
+JOINERS = ['CaMeL', '_', '0', '1', '$NUMBER$']
+
+
+def get_text(raw):
+    # the identifier text of the joined tokens (CaMeL left out), e.g. getVal@@ -> getVal@@, getVal@@ue -> getValue
+    if raw[-2:] != '@@':
+        return raw.replace('@@', '')
+    return raw
+
+
+def has_prefix(sorted_strings, s):
+    # whether a string of sorted_strings starts with s
+    i = bisect.bisect_left(sorted_strings, s)
+    return i < len(sorted_strings) and sorted_strings[i].startswith(s)
+
+
+class IdentifierTrie():
+    """
+    Token level automaton over the identifier prefixes given by IdentifierDataLoader, one for each bug
+    of a batch, all numbered in one state space.
+
+    The old constraint walked back from the last generated token over the identifier being generated
+    (tokens joined by CaMeL, _, 0, 1, $NUMBER$ or @@) and took the longest suffix of it which is an
+    identifier prefix (its tokens are allowed) or an identifier text (the root tokens are allowed).
+    Each beam keeps an integer state: the suffixes of the identifier which can still become one of them,
+    so the state of the next token only extends these suffixes. A state and the tokens allowed after it are
+    built the first time a beam reaches it, and the identifier constraint of a step is one batched gather
+    over the states (get_mask) instead of walking back the prefixes and building a set union for every beam.
+    """
+
+    def __init__(self, identifiers, dictionary):
+        self.dictionary = dictionary
+        self.vocab_size = len(dictionary)
+        self.specials = torch.LongTensor([dictionary.pad(), dictionary.unk(), dictionary.eos()])
+        self.joiner = torch.BoolTensor([s in JOINERS for s in dictionary.symbols])
+        self.bpe = torch.BoolTensor([s[-2:] == '@@' for s in dictionary.symbols])
+
+        self.identifiers = identifiers
+        self.prefixes = [sorted(identifier['tokens']) for identifier in identifiers]
+        self.texts = [set(identifier['text']) for identifier in identifiers]
+        self.sorted_texts = [sorted(texts) for texts in self.texts]
+
+        # state -> its bug and suffixes, each suffix is (the joined tokens, the joined tokens without CaMeL)
+        self.state_bug = []
+        self.state_suffixes = []
+        self.states = {}        # (bug, suffixes) -> state
+        self.goto = {}          # (state, token, whether the token starts a new identifier) -> state
+        self.span_start = []    # state -> start of its allowed tokens in self.children
+        self.span_len = []      # state -> number of its allowed tokens
+        self.use_root = []      # state -> whether the tokens allowed at root are also allowed
+        self.children = []
+        self.tables = None      # the lists above as tensors, built again when states are added
+
+        self.root_mask = torch.zeros(len(identifiers), self.vocab_size, dtype=torch.bool)
+        self.constrained = torch.BoolTensor([len(identifier['text']) > 0 for identifier in identifiers])
+        for b, identifier in enumerate(identifiers):
+            self.root_mask[b, identifier['tokens']['']] = True
+        self.roots = torch.LongTensor([self.get_state(b, ()) for b in range(len(identifiers))])
+
+    def alive(self, b, suffix):
+        # whether the suffix is an identifier prefix or text, or can become one with more tokens
+        prefix, raw = suffix
+        return has_prefix(self.prefixes[b], prefix) or has_prefix(self.sorted_texts[b], raw) or \
+            has_prefix(self.sorted_texts[b], raw.replace('@@', ''))
+
+    def get_state(self, b, suffixes):
+        """the state of the suffixes (longest first) of bug b, its allowed tokens are found when it is added"""
+        key = (b, suffixes)
+        if key in self.states:
+            return self.states[key]
+        state = len(self.state_bug)
+        self.states[key] = state
+        self.state_bug.append(b)
+        self.state_suffixes.append(suffixes)
+        self.tables = None
+
+        tokens, text = self.identifiers[b]['tokens'], self.texts[b]
+        start = len(self.children)
+        use_root = True
+        for prefix, raw in suffixes:
+            if prefix in tokens:
+                use_root = prefix[-5:] != 'CaMeL' and prefix[-1] != '_' and get_text(raw) in text
+                self.children += tokens[prefix]
+                break
+            if get_text(raw) in text:
+                break
+        self.use_root.append(use_root)
+        self.span_start.append(start)
+        self.span_len.append(len(self.children) - start)
+        return state
+
+    def step(self, state, token, new_identifier):
+        key = (state, token, new_identifier)
+        if key not in self.goto:
+            b = self.state_bug[state]
+            symbol = self.dictionary[token]
+            piece = '' if symbol == 'CaMeL' else symbol
+            suffixes = () if new_identifier else self.state_suffixes[state]
+            suffixes = tuple(
+                suffix for suffix in [(prefix + symbol, raw + piece) for prefix, raw in suffixes] + [(symbol, piece)]
+                if self.alive(b, suffix)
+            )
+            self.goto[key] = self.get_state(b, suffixes)
+        return self.goto[key]
+
+    def initial_state(self, bug_ids):
+        """The state of beams which have not generated any token, and whether the next token continues it."""
+        return self.roots.index_select(0, bug_ids), torch.ones(bug_ids.size(0), dtype=torch.bool)
+
+    def next_state(self, state, joinable, bug_ids, tokens):
+        """
+        state, joinable: of each beam before the new tokens, bug_ids: the bug of each beam
+        a word token (not in JOINERS) following another word token without @@ starts a new identifier
+        """
+        new_identifier = ~self.joiner[tokens] & ~joinable
+        next_state = [
+            self.step(s, t, n) for s, t, n in zip(state.tolist(), tokens.tolist(), new_identifier.tolist())
+        ]
+        return torch.LongTensor(next_state), self.joiner[tokens] | self.bpe[tokens]
+
+    def get_tables(self):
+        if self.tables is None:
+            self.tables = (
+                torch.LongTensor(self.span_start), torch.LongTensor(self.span_len),
+                torch.BoolTensor(self.use_root), torch.LongTensor(self.children),
+            )
+        return self.tables
+
+    def get_mask(self, state, bug_ids):
+        """The tokens allowed for each beam, N x V bool, all False for bugs without identifier text."""
+        span_start, span_len, use_root, children = self.get_tables()
+        mask = self.root_mask.index_select(0, bug_ids) & use_root[state].unsqueeze(1)
+
+        span_len = span_len[state]
+        rows = torch.arange(state.size(0)).repeat_interleave(span_len)
+        if rows.size(0) > 0:
+            offset = torch.cumsum(span_len, dim=0) - span_len
+            columns = torch.arange(rows.size(0)) - offset.repeat_interleave(span_len) + \
+                span_start[state].repeat_interleave(span_len)
+            mask[rows, children[columns]] = True
+
+        mask[:, self.specials] = True
+        return mask & self.constrained.index_select(0, bug_ids).unsqueeze(1)
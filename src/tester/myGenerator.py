@@ -187,7 +187,8 @@ def recoverOutErr():
     sys.stdout = save_stdout
     sys.stderr = save_stderr
 
-def generatePatchesAllIn(projName: str):
+def generatePatchesAllIn(projName: str, resume=False):
+    # resume: continue from the bugs finished by an earlier run instead of generating the outputs again
     print('****** Patching {} ******'.format(projName))
 
     mutDataDir = mutResultDirPath / (projName + '-mutants-allin')
@@ -202,9 +203,7 @@ def generatePatchesAllIn(projName: str):
     try:
         model_file = TESTER_DIR + '../../data/models/gpt_conut_1.pt'
         output_file = str(mutDataDir / 'gpt_conut_1.txt')
-        if os.path.exists(output_file):
-            os.remove(output_file)
-        generate_gpt_conut(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size)
+        generate_gpt_conut(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size, resume=resume)
     except:
         import traceback
         traceback.print_exc()
@@ -212,9 +211,7 @@ def generatePatchesAllIn(projName: str):
     try:
         model_file = TESTER_DIR + '../../data/models/gpt_fconv_1.pt'
         output_file = str(mutDataDir / 'gpt_fconv_1.txt')
-        if os.path.exists(output_file):
-            os.remove(output_file)
-        generate_gpt_fconv(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size)
+        generate_gpt_fconv(vocab_file, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, beam_size, resume=resume)
     except:
         import traceback
         traceback.print_exc()
@@ -394,9 +391,9 @@ def genPatchedClasses(projPath: Path, projName: str):
     rerank(projPath, projName)
     compilePatches(projPath, projName)
 
-def genPatchedClassesAllIn(projPath: Path, projName: str):
+def genPatchedClassesAllIn(projPath: Path, projName: str, resume=False):
     prepareMutInputAllIn(projPath, projName)
-    generatePatchesAllIn(projName)
+    generatePatchesAllIn(projName, resume)
     generateMeta(projPath, projName, allin=True)
     rerank(projPath, projName, allin=True)
     # compilePatches(projPath, projName)
@@ -0,0 +1,115 @@
+import csv
+import json
+import time
+import torch
+from contextlib import contextmanager, nullcontext
+
+# encode: the encoders, decode: the decoder calls, constrain: the identifier constraint and the length penalty,
+# topk: choosing the candidates (topk / sort, the sampling of SamplingSearch), eos: the finished hypothesis,
+# string: writing the hypothesis of the bugs
+PHASES = ['encode', 'decode', 'constrain', 'topk', 'eos', 'string']
+
+# shared by every phase of a disabled profiler, so profiling costs nothing but a with statement
+NULL_PHASE = nullcontext()
+
+
+class StepProfiler():
+    """
+    Wall time and number of calls of each phase of the beam search, for each batch of bugs, with the beam size,
+    the steps each bug is searched for, the steps early_stop saved it and the number of hypothesis it gets.
+    The bugs of one batch share its phases, their time and calls are reported for each bug of the batch,
+    the time split evenly between them.
+    synchronize: wait for the cuda kernels at the end of each phase, so their time is not counted in a later one
+    """
+    def __init__(self, synchronize=False):
+        self.synchronize = synchronize
+        self.records = []
+        self.record = None
+        # added to the bug ids, the index of the first bug of the data file generated
+        self.id_offset = 0
+
+    def start(self, bug_ids, beam_size):
+        self.record = {
+            'bugs': [int(b) + self.id_offset for b in bug_ids],
+            'beam_size': beam_size,
+            'steps': [0 for _ in bug_ids],
+            'saved_steps': [0 for _ in bug_ids],
+            'hypothesis': None,
+            'seconds': dict((phase, 0.) for phase in PHASES),
+            'calls': dict((phase, 0) for phase in PHASES),
+        }
+        self.records.append(self.record)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.synchronize:
+                torch.cuda.synchronize()
+            self.record['seconds'][name] += time.perf_counter() - start
+            self.record['calls'][name] += 1
+
+    def step(self, active):
+        # active: the bugs (their index in the batch) searched at this step
+        for b in active:
+            self.record['steps'][b] += 1
+
+    def finish(self, hypothesis, saved_steps=None):
+        # a batch which is never finished failed, its bugs are retried one by one in new batches
+        self.record['hypothesis'] = [len(h) for h in hypothesis]
+        if saved_steps:
+            self.record['saved_steps'] = list(saved_steps)
+
+    def get_rows(self):
+        # one row for each bug
+        rows = []
+        for record in self.records:
+            n = len(record['bugs'])
+            for i, id in enumerate(record['bugs']):
+                row = {
+                    'id': id,
+                    'batch_size': n,
+                    'beam_size': record['beam_size'],
+                    'steps': record['steps'][i],
+                    'saved_steps': record['saved_steps'][i],
+                    'hypothesis': record['hypothesis'][i] if record['hypothesis'] is not None else -1,
+                    'failed': record['hypothesis'] is None,
+                }
+                for phase in PHASES:
+                    row[phase + '_seconds'] = round(record['seconds'][phase] / n, 6)
+                    row[phase + '_calls'] = record['calls'][phase]
+                rows.append(row)
+        return rows
+
+    def summary(self):
+        total = dict(
+            (phase, {
+                'seconds': round(sum(record['seconds'][phase] for record in self.records), 6),
+                'calls': sum(record['calls'][phase] for record in self.records),
+            }) for phase in PHASES
+        )
+        return {
+            'batches': len(self.records),
+            'bugs': sum(len(record['bugs']) for record in self.records if record['hypothesis'] is not None),
+            'steps': sum(sum(record['steps']) for record in self.records),
+            'saved_steps': sum(sum(record['saved_steps']) for record in self.records),
+            'hypothesis': sum(sum(record['hypothesis']) for record in self.records if record['hypothesis'] is not None),
+            'phases': total,
+        }
+
+    def save(self, path):
+        # a csv of the rows of the bugs if path ends with .csv, else a json of the summary and the rows
+        rows = self.get_rows()
+        if path.endswith('.csv'):
+            fields = ['id', 'batch_size', 'beam_size', 'steps', 'saved_steps', 'hypothesis', 'failed']
+            for phase in PHASES:
+                fields += [phase + '_seconds', phase + '_calls']
+            with open(path, 'w', newline='') as wp:
+                writer = csv.DictWriter(wp, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as wp:
+                json.dump({'summary': self.summary(), 'bugs': rows}, wp, indent=2)
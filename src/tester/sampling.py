@@ -0,0 +1,392 @@
+import math
+import torch
+import torch.nn.functional as F
+import sys
+import os
+
+SAMPLING_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(SAMPLING_DIR)
+from beamsearch import BeamSearch, GPTCoNuTModelCuda, GPTFConvModelCuda, ExportedModelCuda
+from identifier_trie import IdentifierTrie
+from gpt_conut import GPTCoNuTModel, GPTFConvDecoder
+
+
+class SamplingSearch(BeamSearch):
+    """
+    Draws beam_size independent samples for each bug instead of keeping beam_size beams, with the same
+    identifier constraint and length penalty as the beam search. Each row only samples its own next token,
+    so there is no sort over the beam x beam candidates, and the samples of the same patch are merged.
+    temperature: the logits are divided by it, top_p: nucleus sampling, only the most likely tokens whose
+    probability reaches top_p are sampled from, 1 to sample from all of them
+    draft_model: a small GPT-FConv (or GPT-CoNuT) model for speculative decoding (see generate_speculative),
+    which proposes draft_tokens tokens for each row before the model is called
+    """
+    def __init__(self, model, dictionary, beam_size=10, temperature=1.0, top_p=0.95, seed=None,
+                 draft_model=None, draft_tokens=4, **kwargs):
+        super(SamplingSearch, self).__init__(model, dictionary, beam_size, **kwargs)
+        self.temperature = temperature
+        self.top_p = top_p
+        self.generator = torch.Generator()
+        if seed is not None:
+            self.generator.manual_seed(seed)
+        self.draft = None
+        self.draft_tokens = draft_tokens
+        if draft_model is not None:
+            assert len(self.models) == 1 and not isinstance(self.model, ExportedModelCuda) and self.incremental, \
+                'speculative decoding needs one eager model decoded incrementally'
+            draft_cuda = GPTCoNuTModelCuda if isinstance(draft_model, GPTCoNuTModel) else GPTFConvModelCuda
+            self.draft = draft_cuda(draft_model, beam_size, self.model.device, self.model.memory_budget)
+        # the tokens sampled and the model calls of the last sample, with the draft model
+        self.sampled_tokens, self.model_calls = 0, 0
+
+    def get_probs(self, logits):
+        """the distribution the tokens are sampled from, logits: N x V"""
+        probs = F.softmax(logits.float() / self.temperature, dim=1)
+        if self.top_p >= 1:
+            return probs
+        sorted_probs, order = probs.sort(dim=1, descending=True)
+        # the tokens after the probability before them reaches top_p, the most likely token is always kept
+        sorted_probs = sorted_probs.masked_fill(sorted_probs.cumsum(dim=1) - sorted_probs >= self.top_p, 0)
+        probs = torch.zeros_like(probs).scatter_(1, order, sorted_probs)
+        return probs / probs.sum(dim=1, keepdim=True)
+
+    def sample_tokens(self, logits, num):
+        """logits: N x V, return num tokens sampled for each row, N x num"""
+        return torch.multinomial(self.get_probs(logits), num, replacement=True, generator=self.generator)
+
+    def constrain_rows(self, logits, sample, step, beam_bug_ids, constraint, trie, beam_tokens=None):
+        # the identifier constraint and the length penalty (see BeamSearch.constrain) added to logits in place
+        if trie is not None:
+            self.constrain(logits, sample, step, beam_bug_ids, constraint[0], trie, constraint[2], beam_tokens)
+        else:
+            logits[:, self.dictionary.pad()] = -math.inf
+
+    @staticmethod
+    def initial_constraint(beam_bug_ids, trie):
+        trie_state, trie_joinable = trie.initial_state(beam_bug_ids) if trie is not None else (None, None)
+        bsz = beam_bug_ids.size(0)
+        return torch.zeros(bsz).long(), torch.zeros(bsz, dtype=torch.bool), trie_state, trie_joinable
+
+    @staticmethod
+    def select_constraint(constraint, rows):
+        return tuple(t.index_select(0, rows) if t is not None else None for t in constraint)
+
+    def advance(self, constraint, beam_bug_ids, tokens, trie, mask=None):
+        """
+        constraint: (beam_lengths, beam_glue, trie_state, trie_joinable) of the rows (trie_state and trie_joinable
+        are None without identifiers), return it after the rows add tokens, only the rows where mask is True
+        """
+        beam_lengths, beam_glue, trie_state, trie_joinable = constraint
+        new_word = self.word[tokens] & ((~self.joiner[tokens] & ~beam_glue) | beam_lengths.eq(0))
+        beam_lengths = beam_lengths + new_word.long()
+        beam_glue = self.joiner[tokens] | self.bpe[tokens]
+        if trie is not None:
+            trie_state, trie_joinable = trie.next_state(trie_state, trie_joinable, beam_bug_ids, tokens)
+        advanced = (beam_lengths, beam_glue, trie_state, trie_joinable)
+        if mask is None:
+            return advanced
+        return tuple(
+            torch.where(mask, new, old) if old is not None else None for new, old in zip(advanced, constraint)
+        )
+
+    def generate(self, sample, encoder_outs):
+        """
+        sample beam_size sequences for each bug, each row stops at eos or at the maximum steps of its bug
+        encoder_outs: the encoder output of each model
+        return a list of hypothesis (sorted by final_score) for each bug, one for each distinct sequence
+        """
+        if self.draft is not None:
+            return self.generate_speculative(sample, encoder_outs)
+        src_tokens = sample['net_input']['src_tokens']
+        identifiers = sample['identifier']
+        bsz = src_tokens.size(0)
+        for model in self.models:
+            model.memory_scale = 1.0
+        sample_size = self.beam_size
+        max_hypothesis = self.max_hypothesis or sample_size
+        eos = self.dictionary.eos()
+        prev_lens, max_steps, prev_tokens = self.get_prev_tokens(sample)
+
+        trie, vocab = None, None
+        if identifiers is not None:
+            trie = IdentifierTrie(identifiers, self.dictionary)
+            if self.sparse_vocab:
+                vocab = self.get_candidate_vocab(sample, identifiers)
+
+        # the best hypothesis of each distinct sequence
+        hypothesis = [{} for _ in range(bsz)]
+        active = list(range(bsz))       # bugs which still have unfinished rows, in the order of their rows
+
+        # state of the rows, at step 0 there is one row for each bug, then sample_size rows for each bug
+        tokens = torch.zeros(bsz, 0).long()
+        scores = torch.zeros(bsz, 0)
+        finished = torch.zeros(bsz, dtype=torch.bool)
+        beam_bug_ids = torch.arange(bsz)
+        beam_prev_lens = torch.LongTensor(prev_lens)
+        incremental_states = self.get_incremental_states(encoder_outs, prev_lens)
+        constraint = self.initial_constraint(beam_bug_ids, trie)
+
+        for step in range(0, self.max_step):
+            if self.incremental and step > 0:
+                prev_tokens_index = torch.ones(beam_bug_ids.size(0), 1).long()
+                decoder_tokens = tokens[:, -1:]
+            else:
+                width = int(beam_prev_lens.max()) + step
+                prev_tokens_index = self.get_prev_tokens_index(beam_prev_lens, step, width)
+                decoder_tokens = prev_tokens.index_select(0, beam_bug_ids)[:, : width]
+                positions = beam_prev_lens.unsqueeze(1) + torch.arange(step).unsqueeze(0)
+                decoder_tokens.scatter_(1, positions, tokens)
+            if self.profiler is not None:
+                self.profiler.step(active)
+            with self.phase('decode'):
+                logits = self.decode(
+                    prev_tokens_index,
+                    encoder_outs,
+                    decoder_tokens,
+                    beam_bug_ids,
+                    incremental_states,
+                    vocab,
+                )
+            beam_tokens = self.get_beam_tokens(vocab, logits.size(0))
+            with self.phase('constrain'):
+                self.constrain_rows(logits, sample, step, beam_bug_ids, constraint, trie, beam_tokens)
+
+            if step == 0:
+                # expand each bug into sample_size rows, each with its own first token
+                with self.phase('topk'):
+                    indices = self.sample_tokens(logits, sample_size).view(-1)
+                rows = torch.arange(len(active)).repeat_interleave(sample_size)
+                lprobs = logits.index_select(0, rows).gather(1, indices.unsqueeze(1)).squeeze(1)
+                beam_tokens = self.get_beam_tokens(vocab, rows.size(0))
+                tokens = tokens.index_select(0, rows)
+                scores = scores.index_select(0, rows)
+                finished = finished.index_select(0, rows)
+                beam_bug_ids = beam_bug_ids.index_select(0, rows)
+                beam_prev_lens = beam_prev_lens.index_select(0, rows)
+                constraint = self.select_constraint(constraint, rows)
+                self.reorder_incremental_state(incremental_states, rows)
+            else:
+                with self.phase('topk'):
+                    indices = self.sample_tokens(logits, 1).squeeze(1)
+                lprobs = logits.gather(1, indices.unsqueeze(1)).squeeze(1)
+            indices = self.column_tokens(indices.unsqueeze(1), beam_tokens).squeeze(1)
+            # the finished rows keep feeding eos until all the rows of their bug are finished
+            indices = indices.masked_fill(finished, eos)
+            lprobs = lprobs.masked_fill(finished, 0)
+            tokens = torch.cat([tokens, indices.unsqueeze(1)], dim=1)
+            scores = torch.cat([scores, lprobs.unsqueeze(1)], dim=1)
+
+            # the rows reaching eos, and the rows reaching the maximum steps of their bug filled with eos
+            with self.phase('eos'):
+                last = torch.BoolTensor([step == max_steps[b] - 1 for b in beam_bug_ids.tolist()])
+                new_finished = ~finished & (indices.eq(eos) | last)
+                for i in new_finished.nonzero().view(-1).tolist():
+                    b = int(beam_bug_ids[i])
+                    hypo = tokens[i].clone()
+                    hypo[-1] = eos
+                    # scored like the hypothesis of the beam search
+                    final_score = float(scores[i].sum()) / (1 + step if indices[i] == eos else max_steps[b])
+                    key = tuple(hypo.tolist())
+                    if key not in hypothesis[b] or hypothesis[b][key]['final_score'] < final_score:
+                        hypothesis[b][key] = {'hypo': hypo, 'score': scores[i, 1:], 'final_score': final_score}
+            finished = finished | new_finished
+
+            with self.phase('constrain'):
+                constraint = self.advance(constraint, beam_bug_ids, indices, trie)
+
+            # drop the bugs all of whose rows are finished
+            bug_finished = finished.view(len(active), sample_size).all(dim=1)
+            if bug_finished.any():
+                alive = (~bug_finished).nonzero().view(-1)
+                active = [active[j] for j in alive.tolist()]
+                if not active:
+                    break
+                rows = (alive.unsqueeze(1) * sample_size + torch.arange(sample_size).unsqueeze(0)).view(-1)
+                tokens = tokens.index_select(0, rows)
+                scores = scores.index_select(0, rows)
+                finished = finished.index_select(0, rows)
+                beam_bug_ids = beam_bug_ids.index_select(0, rows)
+                beam_prev_lens = beam_prev_lens.index_select(0, rows)
+                constraint = self.select_constraint(constraint, rows)
+                self.reorder_incremental_state(incremental_states, rows)
+                self.reorder_incremental_prefix(incremental_states, alive)
+                if vocab is not None:
+                    vocab = {key: value.index_select(0, alive) for key, value in vocab.items()}
+
+        results = []
+        for b in range(bsz):
+            results.append(sorted(hypothesis[b].values(), key=lambda e: e['final_score'], reverse=True))
+            results[-1] = results[-1][: max_hypothesis]
+        return results
+
+    def generate_speculative(self, sample, encoder_outs):
+        """
+        speculative sampling: in each round the draft model samples draft_tokens tokens for every row one by one,
+        the model scores all of them in one decoder call, and each draft token is kept with probability
+        min(1, p / q) (p and q: its probability under the model and under the draft), the first rejected one is
+        replaced by a token sampled from max(0, p - q), and a row keeping all of them samples one more from p.
+        so the samples follow the same distribution as generate, with one model call for several tokens
+        """
+        src_tokens = sample['net_input']['src_tokens']
+        identifiers = sample['identifier']
+        bsz = src_tokens.size(0)
+        model, draft = self.model, self.draft
+        model.memory_scale, draft.memory_scale = 1.0, 1.0
+        sample_size, k = self.beam_size, self.draft_tokens
+        max_hypothesis = self.max_hypothesis or sample_size
+        eos = self.dictionary.eos()
+        prev_lens, max_steps, prev_tokens = self.get_prev_tokens(sample)
+
+        trie, vocab = None, None
+        if identifiers is not None:
+            trie = IdentifierTrie(identifiers, self.dictionary)
+            if self.sparse_vocab:
+                vocab = self.get_candidate_vocab(sample, identifiers)
+        encoder_out = encoder_outs[0]
+        draft_encoder_out = self.encode(draft, sample)
+        state, draft_state = self.get_incremental_states([encoder_out, draft_encoder_out], prev_lens)
+
+        # step 0: one row for each bug reads the last token of prev_context, then sample_size rows for each bug
+        beam_bug_ids = torch.arange(bsz)
+        width = max(prev_lens)
+        prev_tokens_index = self.get_prev_tokens_index(torch.LongTensor(prev_lens), 0, width)
+        logits = model.decode(prev_tokens_index, encoder_out, prev_tokens[:, : width], beam_bug_ids, state, vocab)
+        draft.decode(prev_tokens_index, draft_encoder_out, prev_tokens[:, : width], beam_bug_ids, draft_state, vocab)
+        constraint = self.initial_constraint(beam_bug_ids, trie)
+        self.constrain_rows(logits, sample, 0, beam_bug_ids, constraint, trie, self.get_beam_tokens(vocab, bsz))
+        first = self.sample_tokens(logits, sample_size).view(-1)
+        rows = torch.arange(bsz).repeat_interleave(sample_size)
+        scores = logits.index_select(0, rows).gather(1, first.unsqueeze(1))
+        first = self.column_tokens(first.unsqueeze(1), self.get_beam_tokens(vocab, rows.size(0))).squeeze(1)
+        beam_bug_ids = rows
+        constraint = self.advance(self.select_constraint(constraint, rows), beam_bug_ids, first, trie)
+        model.reorder_incremental_state(state, rows)
+        draft.reorder_incremental_state(draft_state, rows)
+        state = GPTFConvDecoder.get_positional_state(state)
+        draft_state = GPTFConvDecoder.get_positional_state(draft_state)
+        self.sampled_tokens, self.model_calls = rows.size(0), 1
+
+        # the tokens of the rows (N x L, the generated token t at t - 1), the first lengths of them are sampled
+        hypothesis = [{} for _ in range(bsz)]
+        active = list(range(bsz))
+        tokens = first.unsqueeze(1)
+        lengths = torch.ones(rows.size(0)).long()
+        row_max_steps = torch.LongTensor(max_steps).index_select(0, rows)
+        finished = torch.zeros(rows.size(0), dtype=torch.bool)
+        new_finished = first.eq(eos) | lengths.eq(row_max_steps)
+        rounds = 0
+        while True:
+            for i in new_finished.nonzero().view(-1).tolist():
+                # scored like the hypothesis of the beam search
+                b, length = int(beam_bug_ids[i]), int(lengths[i])
+                hypo = tokens[i, : length].clone()
+                hypo[-1] = eos
+                final_score = float(scores[i, : length].sum()) / length
+                key = tuple(hypo.tolist())
+                if key not in hypothesis[b] or hypothesis[b][key]['final_score'] < final_score:
+                    hypothesis[b][key] = {'hypo': hypo, 'score': scores[i, 1: length], 'final_score': final_score}
+            finished = finished | new_finished
+
+            # drop the bugs all of whose rows are finished
+            bug_finished = finished.view(len(active), sample_size).all(dim=1)
+            if bug_finished.any():
+                alive = (~bug_finished).nonzero().view(-1)
+                active = [active[j] for j in alive.tolist()]
+                if not active:
+                    break
+                rows = (alive.unsqueeze(1) * sample_size + torch.arange(sample_size).unsqueeze(0)).view(-1)
+                tokens, scores = tokens.index_select(0, rows), scores.index_select(0, rows)
+                lengths, finished = lengths.index_select(0, rows), finished.index_select(0, rows)
+                beam_bug_ids = beam_bug_ids.index_select(0, rows)
+                row_max_steps = row_max_steps.index_select(0, rows)
+                constraint = self.select_constraint(constraint, rows)
+                for m, m_state in [(model, state), (draft, draft_state)]:
+                    m.reorder_incremental_state(m_state, rows)
+                    m.reorder_incremental_prefix(m_state, alive)
+                if vocab is not None:
+                    vocab = {key: value.index_select(0, alive) for key, value in vocab.items()}
+            row_num = beam_bug_ids.size(0)
+            beam_tokens = self.get_beam_tokens(vocab, row_num)
+
+            # the draft reads the newest token, and the one before it which it has not read if all the draft
+            # tokens of the last round were kept (the finished rows only repeat their positions)
+            fed = 1 if rounds == 0 else 2
+            draft_state['start'] = (lengths - fed + 1).clamp(min=1)
+            index = draft_state['start'].unsqueeze(1) - 1 + torch.arange(fed).unsqueeze(0)
+            index = index.clamp(max=tokens.size(1) - 1)
+            q_logits = draft.decode(
+                torch.ones(row_num, fed).long(), draft_encoder_out, tokens.gather(1, index),
+                beam_bug_ids, draft_state, vocab,
+            )[:, -1, :]
+            draft_columns, draft_tokens, draft_probs, constraints = [], [], [], [constraint]
+            for j in range(k):
+                if j > 0:
+                    draft_state['start'] = lengths + j
+                    q_logits = draft.decode(
+                        torch.ones(row_num, 1).long(), draft_encoder_out, draft_tokens[-1].unsqueeze(1),
+                        beam_bug_ids, draft_state, vocab,
+                    )[:, -1, :]
+                self.constrain_rows(q_logits, sample, 1, beam_bug_ids, constraints[-1], trie, beam_tokens)
+                draft_probs.append(self.get_probs(q_logits))
+                draft_columns.append(torch.multinomial(draft_probs[-1], 1, generator=self.generator))
+                draft_tokens.append(self.column_tokens(draft_columns[-1], beam_tokens).squeeze(1))
+                constraints.append(self.advance(constraints[-1], beam_bug_ids, draft_tokens[-1], trie))
+
+            # the model scores the newest token and the draft tokens in one call
+            state['start'] = lengths
+            round_tokens = torch.cat(
+                [tokens.gather(1, (lengths - 1).unsqueeze(1)), torch.stack(draft_tokens, dim=1)], dim=1
+            )
+            p_logits = model.decode(
+                torch.ones(row_num, k + 1).long(), encoder_out, round_tokens, beam_bug_ids, state, vocab,
+            )
+            self.model_calls += 1
+            for j in range(k + 1):
+                self.constrain_rows(p_logits[:, j], sample, 1, beam_bug_ids, constraints[j], trie, beam_tokens)
+            probs = torch.stack([self.get_probs(p_logits[:, j]) for j in range(k + 1)], dim=1)  # N, k + 1, V
+
+            # the draft tokens kept before the first rejected one
+            kept = torch.zeros(row_num).long()
+            rejected = torch.zeros(row_num, dtype=torch.bool)
+            for j in range(k):
+                d = draft_columns[j]
+                ratio = probs[:, j].gather(1, d).squeeze(1) / draft_probs[j].gather(1, d).squeeze(1)
+                keep = ~rejected & (torch.rand(row_num, generator=self.generator) < ratio)
+                kept += keep.long()
+                rejected |= ~keep
+
+            # the token after the kept ones, from max(0, p - q) where the draft was rejected, from p after all of them
+            draft_probs.append(torch.zeros_like(draft_probs[0]))
+            p = probs[torch.arange(row_num), kept]
+            residual = (p - torch.stack(draft_probs, dim=1)[torch.arange(row_num), kept]).clamp(min=0)
+            residual = torch.where(residual.sum(dim=1, keepdim=True) > 0, residual, p)
+            round_columns = torch.cat(draft_columns + [torch.zeros_like(draft_columns[0])], dim=1)
+            round_columns.scatter_(1, kept.unsqueeze(1), torch.multinomial(residual, 1, generator=self.generator))
+            round_scores = p_logits.gather(2, round_columns.unsqueeze(2)).squeeze(2)  # N, k + 1
+            round_tokens = self.column_tokens(round_columns, beam_tokens)
+
+            # the new tokens of each row end at the first eos and at the maximum steps of its bug
+            positions = torch.arange(k + 1).unsqueeze(0)
+            count = torch.where(finished, torch.zeros_like(kept), kept + 1)
+            is_eos = round_tokens.eq(eos) & (positions < count.unsqueeze(1))
+            count = torch.where(is_eos.any(dim=1), is_eos.long().cumsum(dim=1).eq(0).sum(dim=1) + 1, count)
+            count = torch.min(count, row_max_steps - lengths)
+            tokens = torch.cat([tokens, tokens.new_full((row_num, k + 1), eos)], dim=1)
+            scores = torch.cat([scores, scores.new_zeros(row_num, k + 1)], dim=1)
+            new = positions < count.unsqueeze(1)
+            index = lengths.unsqueeze(1) + positions
+            tokens.scatter_(1, index, torch.where(new, round_tokens, tokens.gather(1, index)))
+            scores.scatter_(1, index, torch.where(new, round_scores, scores.gather(1, index)))
+            for j in range(k + 1):
+                constraint = self.advance(constraint, beam_bug_ids, round_tokens[:, j], trie, mask=new[:, j])
+            lengths = lengths + count
+            self.sampled_tokens += int(count.sum())
+            new_finished = ~finished & ((is_eos & new).any(dim=1) | lengths.eq(row_max_steps))
+            rounds += 1
+
+        print('speculative decoding,', self.sampled_tokens, 'tokens in', self.model_calls, 'model calls')
+        results = []
+        for b in range(bsz):
+            results.append(sorted(hypothesis[b].values(), key=lambda e: e['final_score'], reverse=True))
+            results[-1] = results[-1][: max_hypothesis]
+        return results
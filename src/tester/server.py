@@ -0,0 +1,155 @@
+import io
+import json
+import time
+import queue
+import threading
+import itertools
+import urllib.request
+import sys
+import os
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SERVER_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(SERVER_DIR)
+sys.path.append(SERVER_DIR + '../models/')
+sys.path.append(SERVER_DIR + '../dataloader/')
+from gpt_conut_data_loader import GPTCoNuTDataLoader
+from gpt_fconv_data_loader import GPTFConvDataLoader
+from identifier_data_loader import IdentifierDataLoader
+from dictionary import Dictionary
+from gpt_conut import GPTCoNuTModel
+from export import ExportedModel
+from generator import Generator, load_model
+
+
+class PatchServer():
+    """
+    Keeps the models loaded and generates patches for the bugs submitted by concurrent requests.
+    A worker thread takes the bugs waiting in the queue (up to batch_size, waiting at most max_wait seconds
+    for more after the first one) and decodes them in one beam search batch.
+    """
+    def __init__(self, generator, batch_size=8, max_wait=0.05):
+        self.generator = generator
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.ids = itertools.count()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, bug):
+        """
+        bug: {'input': a line of input_bpe.txt, 'identifier_tokens': a line of identifier_bpe.tokens,
+        'identifier_text': a line of identifier.txt, 'id': optional}
+        return a queue which gets the S-/T-/H-/P- lines of the bug once it is decoded
+        """
+        if 'id' not in bug:
+            bug = dict(bug, id=next(self.ids))
+        result = queue.Queue(maxsize=1)
+        self.queue.put((bug, result))
+        return result
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            bugs = [bug for bug, _ in batch]
+            try:
+                self.generator.data_loader.load_lines(
+                    [bug['input'] for bug in bugs],
+                    [bug['identifier_tokens'] for bug in bugs],
+                    [bug['identifier_text'] for bug in bugs],
+                )
+                results = dict(
+                    (data['id'], hypothesis)
+                    for data, hypothesis in self.generator.try_generate_batch(list(range(len(bugs))))
+                )
+            except:
+                import traceback
+                traceback.print_exc()
+                for bug, result in batch:
+                    result.put('[ERROR] {} FAIL!\n'.format(bug['id']))
+                continue
+            for i, (bug, result) in enumerate(batch):
+                # the bugs which failed only get their S- and T- lines
+                wp = io.StringIO()
+                data = dict(self.generator.data_loader.dataset[i], id=bug['id'])
+                self.generator.write_hypothesis(wp, data, results.get(i, []))
+                result.put(wp.getvalue())
+
+
+def get_handler(patch_server):
+    class PatchRequestHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            # a json bug (see PatchServer.submit) or {'bugs': [bug, ...]}, the result of each bug is
+            # written as soon as it is decoded, in the order of the bugs
+            length = int(self.headers['Content-Length'])
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            bugs = request['bugs'] if 'bugs' in request else [request]
+            results = [patch_server.submit(bug) for bug in bugs]
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.end_headers()
+            for result in results:
+                self.wfile.write(result.get().encode('utf-8'))
+                self.wfile.flush()
+
+    return PatchRequestHandler
+
+
+def serve(vocab_file, model_files, beam_size, batch_size=8, max_wait=0.05, host='127.0.0.1', port=8000,
+          device='cuda', num_threads=None, sparse_vocab=False, memory_budget=None, dedup=False,
+          early_stop=False, max_hypothesis=None, encoder_cache=None):
+    # model_files: one model file, or a list of them decoded as an ensemble (see generate_ensemble)
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    print(len(dictionary))
+    if not isinstance(model_files, (list, tuple)):
+        model_files = [model_files]
+    models = [load_model(dictionary, model_file) for model_file in model_files]
+    identifier_loader = IdentifierDataLoader(dictionary, None, None)
+    if any(isinstance(model, GPTCoNuTModel) or (isinstance(model, ExportedModel) and model.conut) for model in models):
+        data_loader = GPTCoNuTDataLoader(None, dictionary, identifier_loader=identifier_loader)
+    else:
+        data_loader = GPTFConvDataLoader(None, dictionary, identifier_loader=identifier_loader)
+    generator = Generator(
+        models if len(models) > 1 else models[0], dictionary, data_loader, beam_size=beam_size,
+        batch_size=batch_size, device=device, num_threads=num_threads, sparse_vocab=sparse_vocab,
+        memory_budget=memory_budget, dedup=dedup, early_stop=early_stop, max_hypothesis=max_hypothesis,
+        encoder_cache=encoder_cache,
+    )
+    patch_server = PatchServer(generator, batch_size=batch_size, max_wait=max_wait)
+    httpd = ThreadingHTTPServer((host, port), get_handler(patch_server))
+    print('serving on', host, port)
+    httpd.serve_forever()
+
+
+def request_patches(bugs, host='127.0.0.1', port=8000):
+    # send bugs to a running server, yield the S-/T-/H-/P- lines as they come back
+    request = urllib.request.Request(
+        'http://{}:{}/'.format(host, port), data=json.dumps({'bugs': bugs}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    with urllib.request.urlopen(request) as response:
+        for line in response:
+            yield line.decode('utf-8')
+
+
+if __name__ == "__main__":
+    vocab_file = SERVER_DIR + '../../data/vocabulary/vocabulary.txt'
+    model_file = SERVER_DIR + '../../data/models/gpt_conut_1.pt'
+    beam_size = 1000
+    os.environ['CUDA_VISIBLE_DEVICES'] = "0"
+    serve(vocab_file, model_file, beam_size)
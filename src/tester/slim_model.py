@@ -0,0 +1,26 @@
+import sys
+import os
+
+SLIM_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(SLIM_DIR)
+sys.path.append(SLIM_DIR + '../models/')
+sys.path.append(SLIM_DIR + '../dataloader/')
+from dictionary import Dictionary
+from generator import load_model, save_slim_model
+
+
+def slim_model(vocab_file, model_file, slim_file=None):
+    # write the inference weights of a training checkpoint to model_file + '.slim' (by default),
+    # which can then be given as the model_file of generate_gpt_conut / generate_gpt_fconv / generate_ensemble
+    if slim_file is None:
+        slim_file = model_file + '.slim'
+    dictionary = Dictionary(vocab_file, min_cnt=0)
+    model = load_model(dictionary, model_file)
+    save_slim_model(model, slim_file)
+    print('slimmed', model_file, 'to', slim_file)
+
+
+if __name__ == "__main__":
+    vocab_file = SLIM_DIR + '../../data/vocabulary/vocabulary.txt'
+    slim_model(vocab_file, SLIM_DIR + '../../data/models/gpt_conut_1.pt')
+    slim_model(vocab_file, SLIM_DIR + '../../data/models/gpt_fconv_1.pt')
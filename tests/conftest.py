@@ -0,0 +1,8 @@
+import os
+import sys
+
+TESTS_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+sys.path.append(TESTS_DIR)
+sys.path.append(TESTS_DIR + '../src/tester/')
+sys.path.append(TESTS_DIR + '../src/models/')
+sys.path.append(TESTS_DIR + '../src/dataloader/')
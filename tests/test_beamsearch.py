@@ -0,0 +1,143 @@
+import copy
+import json
+import pytest
+import torch
+
+from generator import Generator
+from tiny_models import get_dictionary, build_fconv, build_conut, load_quixbugs, get_patches
+
+BUG_NUM = 4
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_batched_search_equals_batch_1(conut):
+    # the bugs shorter than the longest one of the batch are padded, which must not change their patches
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu')
+    indices = list(range(BUG_NUM))
+    assert get_patches(generator, indices, batch_size=BUG_NUM) == get_patches(generator, indices)
+
+
+def mask_other_tokens(model, vocab):
+    """a copy of model giving no probability to the tokens outside the candidate vocab of one bug (1 x K)"""
+    model = copy.deepcopy(model)
+    other = torch.ones(model.decoder.fc2.out_features, dtype=torch.bool)
+    other[vocab['tokens'][0]] = False
+    with torch.no_grad():
+        model.decoder.fc2.bias[other] = -1e4
+    return model
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_sparse_vocab_keeps_ranking(conut):
+    # the candidates get the dense probabilities renormalized over them, the same if the other tokens get none
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    sparse = Generator(model, dictionary, data_loader, beam_size=5, device='cpu', sparse_vocab=True)
+    indices = list(range(BUG_NUM))
+    assert get_patches(sparse, indices, batch_size=BUG_NUM) == get_patches(sparse, indices)
+
+    for i in indices:
+        sample = data_loader.dataset.collater([data_loader.dataset[i]])
+        masked = mask_other_tokens(model, sparse.beamsearch.get_candidate_vocab(sample, sample['identifier']))
+        dense = Generator(masked, dictionary, data_loader, beam_size=5, device='cpu')
+        masked_sparse = Generator(masked, dictionary, data_loader, beam_size=5, device='cpu', sparse_vocab=True)
+        assert get_patches(masked_sparse, [i]) == get_patches(dense, [i])
+
+
+def scripted_decode(dictionary, word):
+    """
+    log probabilities of a decoder which first generates word, then eos after word, and after any other token
+    neither of them, so the beams not ending at step 1 can never catch up with the patch 'word eos'
+    """
+    torch.manual_seed(0)
+    base = torch.randn(len(dictionary))
+    base[[word, dictionary.eos()]] = -1e4
+
+    def decode(prev_tokens_index, encoder_outs, prev_tokens, beam_bug_ids, incremental_states, vocab):
+        logits = base.unsqueeze(0).repeat(prev_tokens.size(0), 1)
+        if prev_tokens.size(1) > 1:
+            # step 0 reads the whole prev_context
+            logits[:, word] = 30
+        else:
+            logits[prev_tokens[:, -1].eq(word), dictionary.eos()] = 30
+        return torch.log_softmax(logits, dim=1)
+    return decode
+
+
+def test_early_stop_keeps_top_hypothesis():
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, False, 2, identifiers=False)
+    word = dictionary.index(['return'])[0]
+    patches = []
+    for early_stop in [False, True]:
+        generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu', early_stop=early_stop)
+        generator.beamsearch.decode = scripted_decode(dictionary, word)
+        patches.append(get_patches(generator, [0, 1], batch_size=2))
+    # every bug stops after step 1 instead of running to its maximum steps
+    assert all(saved > 90 for saved in generator.beamsearch.saved_steps)
+    full, stopped = patches
+    for full_patches, stopped_patches in zip(full, stopped):
+        assert stopped_patches == full_patches[: len(stopped_patches)] == ['return']
+
+
+def split_decode(dictionary, word, pieces):
+    """
+    log probabilities of a decoder which starts with word or (a little less likely) the first of its pieces,
+    the pieces are followed by the second one and both spellings by eos, so 'pieces eos' ends a step later with
+    the better final_score, the other beams keep generating other tokens
+    """
+    torch.manual_seed(0)
+    eos = dictionary.eos()
+    base = torch.randn(len(dictionary))
+    base[[word, eos] + pieces] = -1e4
+
+    def decode(prev_tokens_index, encoder_outs, prev_tokens, beam_bug_ids, incremental_states, vocab):
+        logits = base.unsqueeze(0).repeat(prev_tokens.size(0), 1)
+        if prev_tokens.size(1) > 1:
+            logits[:, word], logits[:, pieces[0]] = 30, 29.9
+        else:
+            last = prev_tokens[:, -1]
+            logits[last.eq(word) | last.eq(pieces[1]), eos] = 30
+            logits[last.eq(pieces[0]), pieces[1]] = 30
+        return torch.log_softmax(logits, dim=1)
+    return decode
+
+
+def test_dedup_keeps_better_spelling():
+    # 'return' and 're@@ turn' render the same statement, only the better one is a hypothesis
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, False, 1, identifiers=False)
+    word, pieces = dictionary.index(['return'])[0], dictionary.index(['re@@', 'turn'])
+    patches = []
+    for dedup in [False, True]:
+        generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu', dedup=dedup)
+        generator.beamsearch.decode = split_decode(dictionary, word, pieces)
+        patches += get_patches(generator, [0])
+    full, deduped = patches
+    assert full[: 2] == ['re@@ turn', 'return']
+    assert deduped[0] == 're@@ turn' and 'return' not in deduped
+    # the dropped duplicate does not take the place of another hypothesis
+    assert len(deduped) == len(full) == 5 and deduped[1:] == full[2:] + deduped[-1:]
+
+
+def test_early_stop_saved_steps_reported_once(tmp_path, capsys):
+    # generated one bug per batch, the saved steps are printed once for the run and written to the profile
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, False, 0, identifiers=False)
+    profile = str(tmp_path / 'profile.json')
+    generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu', early_stop=True, profile=profile)
+    generator.beamsearch.decode = scripted_decode(dictionary, dictionary.index(['return'])[0])
+    capsys.readouterr()
+    generator.generate(str(tmp_path / 'output.txt'), 0, 2)
+    printed = [line for line in capsys.readouterr().out.splitlines() if line.startswith('early stop saved')]
+    saved_steps = [bug['saved_steps'] for bug in json.load(open(profile, 'r'))['bugs']]
+    assert len(saved_steps) == 2 and all(saved > 90 for saved in saved_steps)
+    assert printed == ['early stop saved {} steps'.format(sum(saved_steps))]
+    assert generator.saved_steps == json.load(open(profile, 'r'))['summary']['saved_steps'] == sum(saved_steps)
@@ -0,0 +1,52 @@
+import copy
+import pytest
+import torch
+import torch.nn as nn
+
+from encoder_cache import EncoderCache, get_model_hash
+from generator import Generator
+from quantization import quantize_model
+from tiny_models import get_dictionary, build_fconv, build_conut, load_quixbugs, get_patches
+
+BUG_NUM = 4
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_cached_search_equals_uncached(conut):
+    # the bugs are cached in one batch and reused in other ones
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    indices = list(range(BUG_NUM))
+    expected = get_patches(Generator(model, dictionary, data_loader, beam_size=5, device='cpu'), indices)
+
+    encoder_cache = EncoderCache()
+    generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu', encoder_cache=encoder_cache)
+    assert get_patches(generator, indices, batch_size=BUG_NUM) == expected
+    assert get_patches(generator, indices[::-1], batch_size=2) == expected[::-1]
+    assert encoder_cache.stats()['memory_hits'] > 0
+
+
+def test_model_hash_of_quantized_weights():
+    # the packed weights are hashed by their values, one changed weight in the middle of fc2 changes the hash
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    changed = copy.deepcopy(model)
+    with torch.no_grad():
+        changed.decoder.fc2.weight[len(dictionary) // 2] += 1
+    hashes = [get_model_hash(quantize_model(copy.deepcopy(m))) for m in [model, model, changed]]
+    assert hashes[0] == hashes[1] != hashes[2]
+
+
+class ExtraState(nn.Module):
+    def get_extra_state(self):
+        return object()
+
+    def set_extra_state(self, state):
+        pass
+
+
+def test_model_hash_rejects_unknown_state():
+    # a state entry without known bytes is an error instead of being hashed by its str
+    with pytest.raises(Exception):
+        get_model_hash(ExtraState())
@@ -0,0 +1,21 @@
+import pytest
+
+from export import ExportedModel, export_model
+from generator import Generator
+from tiny_models import get_dictionary, build_fconv, build_conut, load_quixbugs, get_patches
+
+BUG_NUM = 3
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_exported_search_equals_eager(conut, tmp_path):
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    export_model(model, str(tmp_path))
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    indices = list(range(BUG_NUM))
+    patches = [
+        get_patches(Generator(m, dictionary, data_loader, beam_size=5, device='cpu'), indices)
+        for m in [model, ExportedModel(str(tmp_path))]
+    ]
+    assert patches[0] == patches[1]
@@ -0,0 +1,144 @@
+import os
+import pytest
+import torch
+
+from generator import Generator, load_quantized_model, generate_gpt_conut, generate_gpt_fconv
+from generator import save_slim_model, load_slim_model
+from tiny_models import get_dictionary, build_fconv, build_conut, load_quixbugs, get_patches, VOCAB_FILE, QUIXBUGS_DIR
+
+BUG_NUM = 2
+
+
+def save_checkpoint(model, model_file):
+    # the config and weights of a model like the trainers save them
+    torch.save({'config': model.config(), 'model': model.state_dict()}, model_file)
+
+
+def test_quantized_model_cache_reloads(tmp_path):
+    # the first load quantizes the model and writes the cache, the next one reads the cache
+    dictionary = get_dictionary()
+    model_file = str(tmp_path / 'gpt_fconv.pt')
+    save_checkpoint(build_fconv(dictionary), model_file)
+    data_loader = load_quixbugs(dictionary, False, BUG_NUM)
+    indices = list(range(BUG_NUM))
+
+    quantized = load_quantized_model(dictionary, model_file)
+    assert os.path.exists(model_file + '.int8')
+    cached = load_quantized_model(dictionary, model_file)
+    patches = [
+        get_patches(Generator(m, dictionary, data_loader, beam_size=5, device='cpu'), indices)
+        for m in [quantized, cached]
+    ]
+    assert patches[0] == patches[1]
+
+
+class Interrupted(Exception):
+    pass
+
+
+def test_resume_after_interrupt(tmp_path, monkeypatch):
+    # the run stops after the output of the second bug is written but before it is in the journal,
+    # resuming must cut the output back to the first bug and give the output of an uninterrupted run
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    expected_file, output_file = str(tmp_path / 'expected.txt'), str(tmp_path / 'output.txt')
+    Generator(model, dictionary, load_quixbugs(dictionary, False, 0), beam_size=5, device='cpu').generate(
+        expected_file, 0, 3
+    )
+
+    fsync, calls = os.fsync, []
+
+    def interrupted_fsync(fd):
+        # output and journal of the first bug, then the output of the second one
+        calls.append(fd)
+        if len(calls) == 3:
+            raise Interrupted()
+        fsync(fd)
+    monkeypatch.setattr(os, 'fsync', interrupted_fsync)
+    generator = Generator(model, dictionary, load_quixbugs(dictionary, False, 0), beam_size=5, device='cpu')
+    with pytest.raises(Interrupted):
+        generator.generate(output_file, 0, 3)
+    monkeypatch.setattr(os, 'fsync', fsync)
+    assert Generator.read_journal(output_file + '.journal')[0] == {0}
+    assert os.path.getsize(output_file) > Generator.read_journal(output_file + '.journal')[1]
+    # a crash can also leave the unsynced end of the file as garbage, longer than the bugs still to generate
+    with open(output_file, 'ab') as wp:
+        wp.write(b'\0' * (os.path.getsize(expected_file) * 2))
+
+    generator = Generator(model, dictionary, load_quixbugs(dictionary, False, 0), beam_size=5, device='cpu')
+    generator.generate(output_file, 0, 3, resume=True)
+    assert open(output_file, 'rb').read() == open(expected_file, 'rb').read()
+    assert Generator.read_journal(output_file + '.journal')[0] == {0, 1, 2}
+
+
+def write_inputs(input_dir, bug_num):
+    # the input and identifier files of the first bug_num QuixBugs bugs
+    inputs = []
+    for name in ['quixbugs_bpe.txt', 'identifier.txt', 'identifier.tokens']:
+        lines = open(QUIXBUGS_DIR + name, 'r', encoding='utf-8').readlines()[: bug_num]
+        open(str(input_dir / name), 'w', encoding='utf-8').writelines(lines)
+        inputs.append(str(input_dir / name))
+    return inputs
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_sharded_output_equals_single_process(tmp_path, conut):
+    # 5 bugs in shards [0, 2) and [2, 5), merged in bug id order
+    dictionary = get_dictionary()
+    model_file = str(tmp_path / 'model.pt')
+    save_checkpoint(build_conut(dictionary) if conut else build_fconv(dictionary), model_file)
+    input_file, identifier_txt_file, identifier_token_file = write_inputs(tmp_path, 5)
+    generate = generate_gpt_conut if conut else generate_gpt_fconv
+    outputs = []
+    for shards in [1, 2]:
+        output_file = str(tmp_path / 'output{}.txt'.format(shards))
+        generate(
+            VOCAB_FILE, model_file, input_file, identifier_txt_file, identifier_token_file, output_file, 5,
+            device='cpu', num_threads=1, shards=shards,
+        )
+        outputs.append(open(output_file, 'r', encoding='utf-8').read())
+    single, sharded = outputs
+    ids = [int(line.split('\t')[0][2:]) for line in sharded.splitlines() if line.startswith('S-')]
+    assert ids == list(range(5))
+    assert sharded == single
+    assert sorted(os.listdir(str(tmp_path))) == sorted([
+        'model.pt', 'quixbugs_bpe.txt', 'identifier.txt', 'identifier.tokens',
+        'output1.txt', 'output1.txt.journal', 'output2.txt',
+    ])
+
+
+def get_mapped_ranges(path):
+    # the address ranges of the memory mappings of the file, from /proc/self/maps
+    ranges = []
+    for line in open('/proc/self/maps', 'r').readlines():
+        fields = line.split()
+        if len(fields) >= 6 and fields[5] == path:
+            start, end = fields[0].split('-')
+            ranges.append((int(start, 16), int(end, 16)))
+    return ranges
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_slim_model_round_trip(tmp_path, conut):
+    # every tensor comes back exactly, mapped from the slim file, with the gpt embedding and lm_head still tied
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    slim_file = str(tmp_path / 'model.slim')
+    save_slim_model(model, slim_file)
+    slim = load_slim_model(dictionary, slim_file)
+
+    state, slim_state = model.state_dict(), slim.state_dict()
+    assert list(slim_state.keys()) == list(state.keys())
+    for name, tensor in state.items():
+        assert slim_state[name].dtype == tensor.dtype and torch.equal(slim_state[name], tensor), name
+    assert slim.embed_model.lm_head.weight is slim.embed_model.transformer.tokens_embed.weight
+
+    ranges = get_mapped_ranges(os.path.realpath(slim_file))
+    for name, tensor in slim_state.items():
+        if tensor.numel() > 0:
+            assert any(start <= tensor.data_ptr() < end for start, end in ranges), name
+
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    indices = list(range(BUG_NUM))
+    assert get_patches(Generator(slim, dictionary, data_loader, beam_size=5, device='cpu'), indices) == \
+        get_patches(Generator(model, dictionary, data_loader, beam_size=5, device='cpu'), indices)
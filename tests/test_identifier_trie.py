@@ -0,0 +1,80 @@
+import random
+import torch
+
+from identifier_data_loader import IdentifierDataLoader
+from identifier_trie import IdentifierTrie, JOINERS
+from tiny_models import get_dictionary, QUIXBUGS_DIR
+
+BUG_NUM = 39
+
+
+def get_prefix(token, dictionary):
+    # the walk of the old beam search: the prefixes (and their texts) of the identifier ending at the last token
+    prefixs, texts = [], []
+    prefix, text = '', ''
+    stop = False
+    for i in range(len(token) - 1, -1, -1):
+        cur = dictionary[token[i]]
+        if cur not in JOINERS:
+            if stop and cur[-2:] != '@@':
+                return prefixs, texts
+            stop = True
+            text = cur + text
+        else:
+            stop = False
+            if cur != 'CaMeL':
+                text = cur + text
+        prefix = cur + prefix
+        prefixs.append(prefix)
+        texts.append(text.replace('@@', '') if text[-2:] != '@@' else text)
+    prefixs.append(prefix)
+    texts.append(text.replace('@@', '') if text[-2:] != '@@' else text)
+    return prefixs, texts
+
+
+def get_allowed(token, identifier, dictionary):
+    # the tokens the old beam search gave the bonus to after the generated tokens
+    prefixs, texts = get_prefix(token, dictionary)
+    for prefix, text in zip(reversed(prefixs), reversed(texts)):
+        if prefix in identifier['tokens']:
+            if prefix != '' and prefix[-5:] != 'CaMeL' and prefix[-1] != '_' and text in identifier['text']:
+                return set(identifier['tokens'][prefix]) | set(identifier['tokens'][''])
+            return set(identifier['tokens'][prefix])
+        if text in identifier['text']:
+            break
+    return set(identifier['tokens'][''])
+
+
+def test_trie_mask_equals_old_constraint():
+    # beams mostly following the identifiers, with joiners and other tokens in between
+    dictionary = get_dictionary()
+    identifier_loader = IdentifierDataLoader(
+        dictionary, QUIXBUGS_DIR + 'identifier.tokens', QUIXBUGS_DIR + 'identifier.txt'
+    )
+    identifier_loader.load_data(0, BUG_NUM)
+    specials = {dictionary.pad(), dictionary.unk(), dictionary.eos()}
+    joiners = [dictionary.index(symbol) for symbol in JOINERS]
+    rng = random.Random(0)
+    for identifier in identifier_loader.identifier_list:
+        trie = IdentifierTrie([identifier], dictionary)
+        words = sorted(set(t for tokens in identifier['tokens'].values() for t in tokens))
+        bug_ids = torch.zeros(20).long()
+        state, joinable = trie.initial_state(bug_ids)
+        beams = [[] for _ in range(bug_ids.size(0))]
+        for step in range(12):
+            for beam in beams:
+                r = rng.random()
+                if r < 0.6:
+                    beam.append(rng.choice(sorted(get_allowed(beam, identifier, dictionary))))
+                elif r < 0.8:
+                    beam.append(rng.choice(words))
+                elif r < 0.9:
+                    beam.append(rng.choice(joiners))
+                else:
+                    beam.append(rng.randrange(len(dictionary)))
+            tokens = torch.LongTensor([beam[-1] for beam in beams])
+            state, joinable = trie.next_state(state, joinable, bug_ids, tokens)
+            mask = trie.get_mask(state, bug_ids)
+            for i, beam in enumerate(beams):
+                expected = get_allowed(beam, identifier, dictionary) | specials if identifier['text'] else set()
+                assert set(mask[i].nonzero().view(-1).tolist()) == expected
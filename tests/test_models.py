@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+import gpt_conut
+import gpt_fconv
+from gpt_conut import AttentionLayer
+from tiny_models import get_dictionary, build_fconv, build_conut, load_quixbugs
+
+BUG_NUM = 6
+
+
+def get_loss(model, conut, sample):
+    net_input = sample['net_input']
+    src_inputs = (net_input['src_tokens'], net_input['src_with_prev_context'])
+    if conut:
+        src_inputs += (net_input['ctx_tokens'],)
+    with torch.no_grad():
+        out = model(*src_inputs, sample['target_index'], sample['target_with_prev_context'], labels=sample['target'])
+    return out[2], out[3]
+
+
+@pytest.mark.parametrize('conut', [False, True])
+def test_batched_loss_equals_loss_without_gpt_prefix(conut, monkeypatch):
+    # running gpt over prev_context once for the source and the target must not change the training loss
+    dictionary = get_dictionary()
+    model = build_conut(dictionary) if conut else build_fconv(dictionary)
+    data_loader = load_quixbugs(dictionary, conut, BUG_NUM)
+    sample = data_loader.dataset.collater([data_loader.dataset[i] for i in range(BUG_NUM)])
+    loss, lm_loss = get_loss(model, conut, sample)
+
+    monkeypatch.setattr(gpt_conut if conut else gpt_fconv, 'get_gpt_prefix', lambda *args: None)
+    expected_loss, expected_lm_loss = get_loss(model, conut, sample)
+    assert torch.allclose(loss, expected_loss, atol=1e-5)
+    assert torch.allclose(lm_loss, expected_lm_loss, atol=1e-5)
+
+
+def test_own_length_attention_ignores_padding():
+    # generation attends to a padded bug as if it were alone, training keeps scaling by the padded length
+    torch.manual_seed(0)
+    attention = AttentionLayer(8, 8)
+    x, target_embedding = torch.randn(1, 2, 8), torch.randn(1, 2, 8)
+    encoder_b = torch.randn(1, 3, 8)
+    padded_b = torch.cat([encoder_b, torch.zeros(1, 2, 8)], dim=1)
+    padding_mask = torch.tensor([[False, False, False, True, True]])
+    alone, _ = attention(x, target_embedding, (encoder_b.transpose(1, 2), encoder_b), padding_mask[:, : 3])
+    padded, _ = attention(x, target_embedding, (padded_b.transpose(1, 2), padded_b), padding_mask, own_length=True)
+    trained, _ = attention(x, target_embedding, (padded_b.transpose(1, 2), padded_b), padding_mask)
+    assert torch.allclose(padded, alone, atol=1e-6)
+    assert not torch.allclose(trained, alone, atol=1e-3)
@@ -0,0 +1,60 @@
+import torch
+
+from generator import Generator
+from tiny_models import get_dictionary, build_fconv, load_quixbugs
+
+
+def get_teacher_forced_lprobs(model, sample, hypo):
+    """the log probability of each token of hypo under model, decoding the whole sequence at once"""
+    prev_len = sample['target_index'][0].tolist().index(1) + 1
+    prev_tokens = torch.cat([sample['target_with_prev_context'][0, : prev_len], hypo[: -1]]).unsqueeze(0)
+    prev_tokens_index = torch.zeros_like(prev_tokens)
+    prev_tokens_index[0, prev_len - 1:] = 1
+    logits = model(
+        sample['net_input']['src_tokens'], sample['net_input']['src_with_prev_context'],
+        prev_tokens_index, prev_tokens,
+    )[0]
+    return logits[0].gather(1, hypo.unsqueeze(1)).squeeze(1)
+
+
+def test_speculative_scores_with_rejected_draft_tokens():
+    # a draft different from the model has some of its tokens rejected, the state rolls back to the kept ones
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary, seed=0)
+    draft = build_fconv(dictionary, seed=1, convolutions=((16, 3),))
+    data_loader = load_quixbugs(dictionary, False, 1, identifiers=False)
+    generator = Generator(
+        model, dictionary, data_loader, beam_size=3, device='cpu', sampling=True, draft_model=draft
+    )
+    generator.beamsearch.generator.manual_seed(0)
+    (data, hypothesis), = generator.generate_batch([0])
+    # several tokens are kept by some model calls
+    assert generator.beamsearch.model_calls < max(h['hypo'].size(0) for h in hypothesis)
+
+    sample = data_loader.dataset.collater([data])
+    with torch.no_grad():
+        for h in hypothesis:
+            lprobs = get_teacher_forced_lprobs(model, sample, h['hypo'])
+            # the last token is replaced by eos when a row reaches the maximum steps
+            assert torch.allclose(h['score'][: -1], lprobs[1: -1], atol=1e-3)
+
+
+def test_speculative_sparse_vocab_samples_candidates():
+    # the model and the draft score the candidates of each bug only, the sampled columns map back to them
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary, seed=0)
+    draft = build_fconv(dictionary, seed=1, convolutions=((16, 3),))
+    data_loader = load_quixbugs(dictionary, False, 2)
+    generator = Generator(
+        model, dictionary, data_loader, beam_size=3, device='cpu', sampling=True, draft_model=draft,
+        sparse_vocab=True,
+    )
+    generator.beamsearch.generator.manual_seed(0)
+    results = generator.generate_batch([0, 1])
+    sample = data_loader.dataset.collater([data for data, _ in results])
+    vocab = generator.beamsearch.get_candidate_vocab(sample, sample['identifier'])
+    for b, (data, hypothesis) in enumerate(results):
+        assert hypothesis
+        candidates = set(vocab['tokens'][b][vocab['mask'][b]].tolist())
+        for h in hypothesis:
+            assert set(h['hypo'].tolist()) <= candidates
@@ -0,0 +1,63 @@
+import threading
+from http.server import ThreadingHTTPServer
+
+from generator import Generator
+from gpt_fconv_data_loader import GPTFConvDataLoader
+from identifier_data_loader import IdentifierDataLoader
+from server import PatchServer, get_handler, request_patches
+from tiny_models import get_dictionary, build_fconv, load_quixbugs, QUIXBUGS_DIR
+
+BUG_NUM = 4
+
+
+def read_bugs(bug_num):
+    # the requests of the first bug_num QuixBugs bugs, with their index as id
+    lines = [
+        open(QUIXBUGS_DIR + name, 'r', encoding='utf-8').readlines()[: bug_num]
+        for name in ['quixbugs_bpe.txt', 'identifier.tokens', 'identifier.txt']
+    ]
+    return [
+        {'input': line, 'identifier_tokens': tokens, 'identifier_text': text, 'id': i}
+        for i, (line, tokens, text) in enumerate(zip(*lines))
+    ]
+
+
+def test_server_batches_requests_and_streams_generator_output(tmp_path):
+    # two clients send two bugs each at the same time, the four bugs are decoded in one batch
+    dictionary = get_dictionary()
+    model = build_fconv(dictionary)
+    expected_file = str(tmp_path / 'expected.txt')
+    Generator(model, dictionary, load_quixbugs(dictionary, False, 0), beam_size=5, device='cpu').generate(
+        expected_file, 0, BUG_NUM
+    )
+    expected = open(expected_file, 'r', encoding='utf-8').read()
+
+    data_loader = GPTFConvDataLoader(None, dictionary, identifier_loader=IdentifierDataLoader(dictionary, None, None))
+    generator = Generator(model, dictionary, data_loader, beam_size=5, device='cpu')
+    batches = []
+    generate_batch = generator.generate_batch
+
+    def recorded_generate_batch(indices):
+        batches.append(len(indices))
+        return generate_batch(indices)
+    generator.generate_batch = recorded_generate_batch
+    # a full batch is decoded at once, max_wait only keeps the first bugs waiting for the other client
+    patch_server = PatchServer(generator, batch_size=BUG_NUM, max_wait=10)
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), get_handler(patch_server))
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+
+    bugs = read_bugs(BUG_NUM)
+    outputs = [None, None]
+
+    def client(i):
+        outputs[i] = ''.join(request_patches(bugs[2 * i: 2 * i + 2], port=httpd.server_address[1]))
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(2)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    httpd.shutdown()
+    httpd.server_close()
+
+    assert batches == [BUG_NUM]
+    assert outputs[0] + outputs[1] == expected
@@ -0,0 +1,76 @@
+import os
+import torch
+from transformers import OpenAIGPTConfig, OpenAIGPTLMHeadModel
+
+from dictionary import Dictionary
+from gpt_conut import GPTCoNuTModel
+from gpt_fconv import GPTFConvModel
+from gpt_conut_data_loader import GPTCoNuTDataLoader
+from gpt_fconv_data_loader import GPTFConvDataLoader
+from identifier_data_loader import IdentifierDataLoader
+
+TINY_DIR = os.path.abspath(__file__)[: os.path.abspath(__file__).rindex('/') + 1]
+VOCAB_FILE = TINY_DIR + '../data/vocabulary/vocabulary.txt'
+QUIXBUGS_DIR = TINY_DIR + '../candidate_patches/QuixBugs/'
+
+_dictionary = []
+
+
+def get_dictionary():
+    # read once, the vocabulary has 50k symbols
+    if not _dictionary:
+        _dictionary.append(Dictionary(VOCAB_FILE, min_cnt=0))
+    return _dictionary[0]
+
+
+def build_gpt(dictionary, seed, n_layer=2):
+    torch.manual_seed(seed)
+    config = OpenAIGPTConfig(
+        vocab_size=len(dictionary), n_positions=1024, n_embd=32, n_layer=n_layer, n_head=2,
+        attn_pdrop=0, embd_pdrop=0, resid_pdrop=0,
+    )
+    return OpenAIGPTLMHeadModel(config)
+
+
+def build_fconv(dictionary, seed=0, convolutions=((16, 3),) * 2):
+    """a randomly initialized GPT-FConv model small enough to search with on cpu"""
+    gpt_model = build_gpt(dictionary, seed)
+    torch.manual_seed(seed + 1)
+    return GPTFConvModel(
+        dictionary, embed_dim=32, encoder_convolutions=convolutions, decoder_convolutions=convolutions,
+        dropout=0, embed_model=gpt_model,
+    ).eval()
+
+
+def build_conut(dictionary, seed=0):
+    """a randomly initialized GPT-CoNuT model small enough to search with on cpu"""
+    gpt_model = build_gpt(dictionary, seed)
+    torch.manual_seed(seed + 1)
+    return GPTCoNuTModel(
+        dictionary, embed_dim=32, src_encoder_convolutions=((16, 3),) * 2,
+        ctx_encoder_convolutions=((32, 3),) * 2, decoder_convolutions=((16, 3),) * 2,
+        dropout=0, embed_model=gpt_model,
+    ).eval()
+
+
+def load_quixbugs(dictionary, conut, bug_num, identifiers=True):
+    # the first bug_num QuixBugs bugs, with their identifiers unless identifiers is False
+    identifier_loader = None
+    if identifiers:
+        identifier_loader = IdentifierDataLoader(
+            dictionary, QUIXBUGS_DIR + 'identifier.tokens', QUIXBUGS_DIR + 'identifier.txt'
+        )
+    loader = GPTCoNuTDataLoader if conut else GPTFConvDataLoader
+    data_loader = loader(QUIXBUGS_DIR + 'quixbugs_bpe.txt', dictionary, identifier_loader=identifier_loader)
+    data_loader.load_data(0, bug_num)
+    return data_loader
+
+
+def get_patches(generator, indices, batch_size=1):
+    # the patches of each bug in the order of their final_score, generated batch_size bugs at a time
+    dictionary = generator.dictionary
+    patches = []
+    for i in range(0, len(indices), batch_size):
+        for _, hypothesis in generator.generate_batch(indices[i: i + batch_size]):
+            patches.append([dictionary.string(h['hypo']) for h in hypothesis])
+    return patches